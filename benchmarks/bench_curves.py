@@ -0,0 +1,17 @@
+"""Benchmarks for combining and coloring the images of a MISN."""
+import sntd
+
+
+class CurveTables:
+    number = 1
+    repeat = 10
+
+    def setup(self):
+        self.misn = sntd.load_example_misn()
+
+    def time_combine_curves(self):
+        self.misn.combine_curves(time_delays={'image_1': 0, 'image_2': 50},
+                                 magnifications={'image_1': 1, 'image_2': .5})
+
+    def time_color_table(self):
+        self.misn.color_table(['F110W'], ['F160W'], time_delays={'image_1': 0, 'image_2': 50})
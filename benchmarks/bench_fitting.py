@@ -0,0 +1,31 @@
+"""Benchmarks for fit_data on simulated MISN."""
+import sntd
+
+from .common import simulated_misn, fit_kwargs
+
+
+class FitData:
+    params = (['parallel', 'series', 'color'], [1, 2])
+    param_names = ['method', 'nimages']
+    timeout = 600
+    number = 1
+    repeat = 3
+
+    def setup_cache(self):
+        return {n: simulated_misn(numImages=n) for n in self.params[1]}
+
+    def setup(self, misns, method, nimages):
+        if method != 'parallel' and nimages == 1:
+            # series and color fits need at least two images
+            raise NotImplementedError()
+        # fit_data works on its own copy of the MISN
+        self.misn = misns[nimages]
+        self.kwargs = fit_kwargs(method)
+
+    def time_fit_data(self, misns, method, nimages):
+        sntd.fit_data(self.misn, **self.kwargs)
+
+    def track_ncall(self, misns, method, nimages):
+        fitCurves = sntd.fit_data(self.misn, **self.kwargs)
+        return getattr(fitCurves, method).fit_stats['ncall']
+    track_ncall.unit = 'calls'
@@ -0,0 +1,16 @@
+"""Benchmarks for microlensing light curves from a microcaustic."""
+import numpy as np
+
+from sntd.ml import mu_from_image
+
+from .common import microcaustic
+
+
+class MuFromImage:
+    def setup(self):
+        self.image = microcaustic()
+        self.sizes = np.linspace(1, 200, 50)
+        self.time = np.linspace(0, 100, 50)
+
+    def time_mu_from_image(self):
+        mu_from_image(self.image, (500, 500), self.sizes, 'disk', False, self.time, None, False, True, 10)
@@ -0,0 +1,30 @@
+"""Benchmarks for simulating MISN, with and without microlensing."""
+import numpy as np
+
+import sntd
+
+from .common import simulated_misn, _seed_
+
+
+class CreateMultiplyImagedSN:
+    params = ['none', 'achromatic']
+    param_names = ['microlensing']
+    timeout = 300
+
+    def setup_cache(self):
+        np.random.seed(_seed_)
+        return sntd.realizeMicro(nray=50, kappas=1, kappac=.3, gamma=.4)
+
+    def time_create(self, microcaustic, microlensing):
+        simulated_misn(microlensing_params=None if microlensing == 'none' else microcaustic)
+
+
+class RealizeMicro:
+    timeout = 300
+    number = 1
+
+    def setup(self):
+        np.random.seed(_seed_)
+
+    def time_realize_micro(self):
+        sntd.realizeMicro(nray=50, kappas=1, kappac=.3, gamma=.4)
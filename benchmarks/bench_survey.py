@@ -0,0 +1,15 @@
+"""Benchmarks for cosmology forecasts from a lensed SN survey."""
+from sntd.survey_cosmo import Survey
+
+
+class SurveyForecast:
+    timeout = 300
+
+    def setup(self):
+        self.survey = Survey(N=10, dTL=2, dTT=.1, zl=.5, zs=2)
+
+    def time_survey_grid(self):
+        self.survey.survey_grid(['w', 'Ode0'], {'w': [-1.5, -.5], 'Ode0': [0, 1]}, npoints=100)
+
+    def time_survey_fisher(self):
+        self.survey.survey_fisher(['h', 'Ode0', 'w0', 'wa'])
@@ -0,0 +1,37 @@
+"""Fixed-seed workloads shared by the benchmarks."""
+import numpy as np
+import sntd
+
+_seed_ = 3
+
+
+def simulated_misn(numImages=2, microlensing_params=None):
+    """A Type Ia MISN simulated the same way every time."""
+    np.random.seed(_seed_)
+    kwargs = {}
+    if microlensing_params is not None:
+        kwargs = {'microlensing_type': 'AchromaticMicrolensing',
+                  'microlensing_params': microlensing_params}
+    return sntd.createMultiplyImagedSN(sourcename='salt2-extended', snType='Ia', redshift=1.2, z_lens=.5,
+                                       bands=['bessellb', 'bessellr'], zp=[25, 25], cadence=4., epochs=25.,
+                                       time_delays=[10., 40.][:numImages], magnifications=[7, 3.5][:numImages],
+                                       numImages=numImages, objectName='Benchmark Ia', telescopename='telescope',
+                                       sn_params={'x1': 0., 'c': 0.}, **kwargs)
+
+
+def fit_kwargs(method):
+    """fit_data arguments for a simulated MISN, with a seeded sampler."""
+    kwargs = dict(snType='Ia', models='salt2-extended', bands=['bessellb', 'bessellr'],
+                  params=['x0', 'x1', 't0', 'c'], constants={'z': 1.2},
+                  bounds={'t0': (-15, 15), 'x1': (-2, 2), 'c': (-1, 1), 'td': (-15, 15), 'mu': (.5, 2)},
+                  color_param_ignore=['x1'], method=method, microlensing=None, npoints=50, minsnr=0,
+                  t0_guess={'image_1': 10., 'image_2': 40.}, rstate=np.random.RandomState(_seed_),
+                  npar_cores=1, verbose=False)
+    return kwargs
+
+
+def microcaustic(size=1000):
+    """A lognormal stand-in for a microcaustic magnification map, in the
+    rescaled units realizeMicro writes (1024 is no magnification)."""
+    rng = np.random.RandomState(_seed_)
+    return 1024+256*rng.normal(0, .3, (size, size))
@@ -50,7 +50,7 @@ setup(
     install_requires=['numpy', 'scipy', 'cython', 'sncosmo',
                       'astropy', 'matplotlib', 'nestle', 'pyParz', 'sklearn',
                       'iminuit==1.4.9', 'corner', 'pandas'],
-    packages=['sntd'],
+    packages=['sntd', 'sntd.batch'],
     version=VERSION,
     author=AUTHOR,
     author_email=AUTHOR_EMAIL,
@@ -1,16 +1,45 @@
 import os
+import importlib
 
 from .curve_io import *
-from .simulation import *
-from .fitting import *
 from .ml import *
-from .survey_cosmo import Survey
 from .util import load_example_data, load_example_misn
 from .models import unresolvedMISN
+from . import curve_io, ml, models
 
 import sncosmo
-sncosmo.Model._flux = _mlFlux
 sncosmo.PropagationEffect.propagate = _mlProp
 sncosmo.CCM89Dust = _CCM89Dust
 sncosmo.OD94Dust = _OD94Dust
 sncosmo.F99Dust = _F99Dust
+
+# fitting, simulation and survey_cosmo pull in nestle, pandas, corner and
+# matplotlib, so they are only imported the first time one of their names
+# is used.
+_lazy_names_ = {'fit_data': 'fitting',
+                'createMultiplyImagedSN': 'simulation',
+                'Survey': 'survey_cosmo',
+                'survey_sweep': 'survey_cosmo',
+                'Fisher': 'survey_cosmo'}
+_lazy_modules_ = ('fitting', 'simulation', 'survey_cosmo')
+
+__all__ = curve_io.__all__ + ml.__all__ + \
+    ['load_example_data', 'load_example_misn', 'unresolvedMISN'] + \
+    list(_lazy_names_.keys())
+
+
+def __getattr__(name):
+    if name in _lazy_names_:
+        module = importlib.import_module('.'+_lazy_names_[name], __name__)
+        value = getattr(module, name)
+    elif name in _lazy_modules_:
+        value = importlib.import_module('.'+name, __name__)
+    else:
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys())+list(_lazy_names_.keys())+list(_lazy_modules_))
@@ -0,0 +1,156 @@
+"""Scheduler backends for batch mode.
+
+Each backend runs shards of a job specification written by
+:py:func:`~sntd.batch.worker.write_job_spec`. Sharding and result collection
+(:py:func:`~sntd.util.run_sbatch`) are the same for every backend; only how a
+shard gets started differs.
+"""
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from .worker import run_shard, _spec_file_
+
+__all__ = ['BatchScheduler', 'SlurmScheduler', 'LocalScheduler', 'InProcessScheduler', 'get_scheduler']
+
+
+class BatchScheduler(object):
+    """Base class for batch backends.
+
+    Subclasses implement :py:meth:`submit`, and may override :py:meth:`setup`
+    (called once the batch folder and specification exist), :py:meth:`submit_initial`
+    (the first wave of shards), :py:meth:`check` (called while waiting for results)
+    and :py:meth:`shutdown`.
+    """
+    # seconds between checks for finished shards
+    poll_interval = 10
+
+    def setup(self, folder_name, njobs, njobstotal):
+        self.folder_name = os.path.abspath(folder_name)
+        self.spec_file = os.path.join(self.folder_name, _spec_file_)
+
+    def submit_initial(self, nshards):
+        for shard in range(nshards):
+            self.submit(shard)
+
+    def submit(self, shard):
+        raise NotImplementedError()
+
+    def check(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class SlurmScheduler(BatchScheduler):
+    """Submits shards with sbatch, the first wave as a job array.
+
+    Parameters
+    ----------
+    partition: str
+        The name of the partition for the sbatch command
+    python_path: str
+        Path to the python used by the jobs (default is the current python)
+    parallelize: int
+        Number of cores per job if each shard is fit with multiprocessing
+    microlensing_cores: int
+        Number of cores per job for microlensing uncertainties
+    """
+
+    def __init__(self, partition=None, python_path=None, parallelize=None, microlensing_cores=None,
+                 script_name_init=None, script_name=None):
+        self.partition = partition
+        self.python_path = python_path
+        self.parallelize = parallelize
+        self.microlensing_cores = microlensing_cores
+        self.script_name_init = script_name_init
+        self.script_name = script_name
+
+    def setup(self, folder_name, njobs, njobstotal):
+        from ..util import make_sbatch
+
+        super(SlurmScheduler, self).setup(folder_name, njobs, njobstotal)
+        self.script_name_init, _ = make_sbatch(partition=self.partition, njobs=njobs, njobstotal=njobstotal,
+                                               python_path=self.python_path, init=True, folder=folder_name,
+                                               parallelize=self.parallelize, microlensing_cores=self.microlensing_cores)
+        self.script_name, _ = make_sbatch(partition=self.partition, folder=folder_name, njobs=njobs,
+                                          python_path=self.python_path, init=False, parallelize=self.parallelize,
+                                          microlensing_cores=self.microlensing_cores)
+
+    def submit_initial(self, nshards):
+        subprocess.call(['sbatch', os.path.join(
+            self.folder_name, self.script_name_init)])
+
+    def submit(self, shard):
+        subprocess.call(['sbatch', os.path.join(self.folder_name, self.script_name), str(shard)],
+                        stdout=subprocess.DEVNULL)
+
+
+class LocalScheduler(BatchScheduler):
+    """Runs shards on a local process pool with the same worker as Slurm jobs.
+
+    Parameters
+    ----------
+    ncores: int
+        Size of the process pool (default is the number of batch jobs)
+    """
+    poll_interval = .5
+
+    def __init__(self, ncores=None):
+        self.ncores = ncores
+        self.futures = []
+
+    def setup(self, folder_name, njobs, njobstotal):
+        super(LocalScheduler, self).setup(folder_name, njobs, njobstotal)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.ncores if self.ncores is not None else njobs)
+
+    def submit(self, shard):
+        self.futures.append(self.executor.submit(
+            run_shard, self.spec_file, shard))
+
+    def check(self):
+        # a shard that dies outside of run_shard's own error handling would
+        # otherwise never write its DONE file
+        for future in [x for x in self.futures if x.done()]:
+            self.futures.remove(future)
+            future.result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class InProcessScheduler(BatchScheduler):
+    """Runs each shard immediately in the current process, for testing and
+    profiling batch mode without a scheduler."""
+    poll_interval = 0
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, shard):
+        self.submitted.append(shard)
+        run_shard(self.spec_file, shard)
+
+
+_schedulers_ = {'slurm': SlurmScheduler,
+                'local': LocalScheduler,
+                'inprocess': InProcessScheduler}
+
+
+def get_scheduler(scheduler='slurm', **kwargs):
+    """Returns a scheduler instance from its name ('slurm', 'local' or 'inprocess'),
+    passing the keyword arguments each backend accepts. Scheduler instances are
+    returned unchanged."""
+    if isinstance(scheduler, BatchScheduler):
+        return scheduler
+    if scheduler not in _schedulers_.keys():
+        raise RuntimeError('Batch scheduler must be one of %s.' %
+                           ', '.join(_schedulers_.keys()))
+    if scheduler == 'slurm':
+        return SlurmScheduler(**{k: kwargs[k] for k in ['partition', 'python_path', 'parallelize', 'microlensing_cores']
+                                 if k in kwargs.keys()})
+    elif scheduler == 'local':
+        return LocalScheduler(ncores=kwargs.get('ncores', None))
+    return InProcessScheduler()
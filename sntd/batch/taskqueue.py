@@ -0,0 +1,118 @@
+"""SQLite task queue for batch mode.
+
+Instead of a fixed slice of MISN per job, each worker repeatedly claims the
+next pending MISN from a queue in the batch folder until none are left, so
+slow fits don't hold up the rest of a job's slice. SQLite relies on file
+locking, so the batch folder should be on a filesystem where that works
+(most local and parallel filesystems; some NFS setups don't).
+
+A task whose worker is killed (e.g. at the end of its Slurm walltime) would
+stay claimed forever, so claims older than a timeout are put back in the
+queue for another worker.
+"""
+import os
+import time
+import sqlite3
+
+__all__ = ['init_queue', 'claim_tasks', 'finish_tasks', 'requeue_stale', 'queue_status']
+
+_queue_file_ = 'sntd_queue.sqlite'
+# default seconds before an unfinished claim is assumed to belong to a dead worker
+_stale_after_ = 12*3600.
+
+
+def _connect(filename):
+    # autocommit mode, so transactions are opened explicitly below
+    return sqlite3.connect(filename, timeout=60, isolation_level=None)
+
+
+def init_queue(folder, ntasks):
+    """Creates a queue of tasks 0 to ntasks-1 in folder and returns its path."""
+    filename = os.path.join(os.path.abspath(folder), _queue_file_)
+    if os.path.exists(filename):
+        os.remove(filename)
+    con = _connect(filename)
+    try:
+        con.execute('CREATE TABLE tasks (id INTEGER PRIMARY KEY, status TEXT NOT NULL, '
+                    'worker TEXT, claimed REAL, finished REAL)')
+        con.execute('CREATE INDEX status_index ON tasks (status, id)')
+        con.execute('BEGIN')
+        con.executemany("INSERT INTO tasks (id, status) VALUES (?, 'pending')",
+                        [(i,) for i in range(int(ntasks))])
+        con.execute('COMMIT')
+    finally:
+        con.close()
+    return filename
+
+
+def _requeue_stale(con, stale_after):
+    # must be called inside a transaction
+    if stale_after is None:
+        return 0
+    return con.execute("UPDATE tasks SET status='pending', worker=NULL, claimed=NULL "
+                       "WHERE status='running' AND claimed < ?", (time.time()-float(stale_after),)).rowcount
+
+
+def claim_tasks(filename, worker, n=1, stale_after=None):
+    """Atomically claims up to n pending tasks for worker and returns their ids
+    (an empty list once the queue is exhausted). If stale_after is given, tasks
+    claimed more than stale_after seconds ago that aren't done are put back in
+    the queue first."""
+    con = _connect(filename)
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        _requeue_stale(con, stale_after)
+        ids = [x[0] for x in con.execute(
+            "SELECT id FROM tasks WHERE status='pending' ORDER BY id LIMIT ?", (int(n),))]
+        con.executemany("UPDATE tasks SET status='running', worker=?, claimed=? WHERE id=?",
+                        [(str(worker), time.time(), i) for i in ids])
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+    return ids
+
+
+def finish_tasks(filename, ids, worker=None):
+    """Marks tasks as done and returns the ids that were marked. If worker is
+    given, only tasks still claimed by worker are marked (a stale claim that
+    was requeued belongs to the worker that claimed it next)."""
+    con = _connect(filename)
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        if worker is not None:
+            ids = [i for i in ids if con.execute("SELECT id FROM tasks WHERE id=? AND status='running' "
+                                                 "AND worker=?", (int(i), str(worker))).fetchone() is not None]
+        con.executemany("UPDATE tasks SET status='done', finished=? WHERE id=?",
+                        [(time.time(), int(i)) for i in ids])
+        con.execute('COMMIT')
+    finally:
+        con.close()
+    return list(ids)
+
+
+def requeue_stale(filename, stale_after=_stale_after_):
+    """Puts tasks claimed more than stale_after seconds ago that aren't done
+    back in the queue and returns how many there were."""
+    con = _connect(filename)
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        n = _requeue_stale(con, stale_after)
+        con.execute('COMMIT')
+    finally:
+        con.close()
+    return n
+
+
+def queue_status(filename):
+    """Returns a dictionary with the number of tasks in each status."""
+    con = _connect(filename)
+    try:
+        counts = {'pending': 0, 'running': 0, 'done': 0}
+        counts.update({status: n for status, n in con.execute(
+            'SELECT status, COUNT(*) FROM tasks GROUP BY status')})
+    finally:
+        con.close()
+    return counts
@@ -0,0 +1,277 @@
+"""Generic batch worker for :py:func:`~sntd.fitting.fit_data`.
+
+A batch run is described by a job specification (the fit_data arguments, the
+method chain and how the list of MISN is split into shards) that is pickled
+next to the data. Each job then runs one shard with::
+
+    python -m sntd.batch.worker sntd_spec.pkl shard
+"""
+import os
+import sys
+import pickle
+import traceback
+import numpy as np
+from copy import copy
+
+from .taskqueue import claim_tasks, finish_tasks, _queue_file_
+
+__all__ = ['make_job_spec', 'write_job_spec', 'load_job_spec', 'shard_indices', 'run_shard']
+
+_spec_version_ = 1
+_spec_file_ = 'sntd_spec.pkl'
+_data_file_ = 'sntd_data.pkl'
+_constants_file_ = 'sntd_constants.pkl'
+
+
+def make_job_spec(fit_kwargs, methods, ncurves, n_per_node, parallelize=None, batch_init=None, queue=False,
+                  queue_timeout=None):
+    """Builds and checks a batch job specification.
+
+    Parameters
+    ----------
+    fit_kwargs: dict
+        Keyword arguments passed to :py:func:`~sntd.fitting.fit_data` (everything
+        except curves, which are stored separately)
+    methods: str or list
+        The fitting method, or the chain of methods run one after another
+    ncurves: int
+        Total number of MISN
+    n_per_node: int
+        Number of MISN per shard
+    parallelize: int
+        If not None, each shard fits its MISN together with this many cores
+    batch_init: str
+        Optional code run by each worker before fitting (e.g. extra imports or
+        sncosmo registrations)
+    queue: bool
+        If True, the shards are workers pulling MISN from a task queue
+        (:py:mod:`~sntd.batch.taskqueue`) instead of fixed slices of n_per_node,
+        and n_per_node is only used for the number of workers
+    queue_timeout: float
+        With a task queue, seconds after which a claimed MISN that isn't done
+        is given to another worker (None never reclaims them)
+
+    Returns
+    -------
+    spec: dict
+    """
+    methods = [methods] if isinstance(methods, str) else [str(x) for x in methods]
+    if len(methods) == 0 or not np.all([x in ['parallel', 'series', 'color'] for x in methods]):
+        raise RuntimeError(
+            'Parameter "method" must be "parallel","series", or "color".')
+    if n_per_node is None or int(n_per_node) < 1:
+        raise RuntimeError('Batch mode needs at least one MISN per node.')
+    if parallelize is not None and int(parallelize) < 1:
+        raise RuntimeError('parallelize must be a positive number of cores.')
+    if batch_init is not None and not isinstance(batch_init, str):
+        raise RuntimeError('batch_init must be a string.')
+    fit_kwargs = {k: v for k, v in fit_kwargs.items() if k != 'curves'}
+    try:
+        pickle.dumps(fit_kwargs)
+    except Exception as e:
+        raise RuntimeError(
+            'The fit_data arguments could not be pickled for batch mode: %s' % e)
+
+    return {'version': _spec_version_,
+            'fit_kwargs': fit_kwargs,
+            'methods': methods,
+            'ncurves': int(ncurves),
+            'n_per_node': int(n_per_node),
+            'nshards': int(np.ceil(ncurves/int(n_per_node))),
+            'parallelize': None if parallelize is None else int(parallelize),
+            'batch_init': batch_init,
+            'queue': bool(queue),
+            'queue_timeout': None if queue_timeout is None else float(queue_timeout)}
+
+
+def write_job_spec(spec, folder, curves=None, constants=None):
+    """Writes the specification (and optionally the data and constants) into folder,
+    and returns the path to the specification file."""
+    folder = os.path.abspath(folder)
+    if curves is not None:
+        with open(os.path.join(folder, _data_file_), 'wb') as f:
+            pickle.dump(curves, f)
+    if constants is not None or not os.path.exists(os.path.join(folder, _constants_file_)):
+        with open(os.path.join(folder, _constants_file_), 'wb') as f:
+            pickle.dump(constants, f)
+    filename = os.path.join(folder, _spec_file_)
+    with open(filename, 'wb') as f:
+        pickle.dump(spec, f)
+    return filename
+
+
+def load_job_spec(filename):
+    """Reads a specification written by :py:func:`write_job_spec`."""
+    with open(filename, 'rb') as f:
+        spec = pickle.load(f)
+    if not isinstance(spec, dict) or spec.get('version') != _spec_version_:
+        raise RuntimeError('%s is not an SNTD batch job specification.' % filename)
+    return spec
+
+
+def shard_indices(spec, shard):
+    """The [start, stop) range of MISN indices in a shard."""
+    shard = int(shard)
+    if shard < 0 or shard >= spec['nshards']:
+        raise RuntimeError('Shard %i is outside of 0-%i.' %
+                           (shard, spec['nshards']-1))
+    return shard*spec['n_per_node'], min((shard+1)*spec['n_per_node'], spec['ncurves'])
+
+
+def _constants_for(all_const, i):
+    constants = {}
+    if all_const is not None:
+        for c in all_const.keys():
+            if isinstance(all_const[c], (list, tuple, np.ndarray)):
+                constants[c] = all_const[c][i]
+            else:
+                constants[c] = all_const[c]
+    return constants
+
+
+def _run_chain(spec, curves, constants):
+    from sntd.fitting import fit_data
+
+    fitCurves = None
+    chain = len(spec['methods']) > 1
+    for step, method in enumerate(spec['methods']):
+        kwargs = copy(spec['fit_kwargs'])
+        kwargs.update(curves=curves if step == 0 else fitCurves, method=method,
+                      constants=constants, batch_init=None)
+        if spec['parallelize'] is not None:
+            kwargs['par_or_batch'] = 'parallel'
+            kwargs['npar_cores'] = spec['parallelize']
+        if chain:
+            if spec['fit_kwargs'].get('identify_micro', False):
+                kwargs['identify_micro'] = step == 0
+                if step == 0:
+                    kwargs['bands'] = None
+                elif spec['parallelize'] is None:
+                    kwargs['bands'] = fitCurves.micro_color_bands if method == 'color' else fitCurves.micro_bands
+                else:
+                    raise RuntimeError(
+                        'identify_micro with several methods is not implemented for parallelized batch jobs.')
+            elif method == 'color' and kwargs.get('color_bands', None) is not None:
+                kwargs['bands'] = kwargs['color_bands']
+            if step > 0 and method != 'parallel' and kwargs.get('fit_prior', None) not in [None, False]:
+                kwargs['fit_prior'] = fitCurves if spec['parallelize'] is None else True
+        fitCurves = fit_data(**kwargs)
+        if fitCurves is None:
+            break
+    return fitCurves
+
+
+def _write_output(folder, name, results):
+    done_file = os.path.join(folder, 'sntd_fit%s.DONE' % name)
+    np.savetxt(done_file, ['FALSE'], fmt='%s')
+    for i, res in enumerate(results):
+        with open(os.path.join(folder, 'sntd_fit%s_%i.pkl' % (name, i)), 'wb') as f:
+            pickle.dump(res, f)
+    np.savetxt(done_file, ['TRUE'], fmt='%s')
+
+
+def _fit_inputs(spec, all_dat, all_const, inds):
+    inputs = []
+    const_list = []
+    for i in inds:
+        curve = all_dat[i]
+        if isinstance(curve, str):
+            with open(curve, 'rb') as f:
+                curve = pickle.load(f)
+        curve.constants = _constants_for(all_const, i)
+        inputs.append(curve)
+        const_list.append(curve.constants)
+
+    if spec['parallelize'] is None:
+        results = []
+        for curve in inputs:
+            try:
+                results.append(copy(_run_chain(spec, curve, curve.constants)))
+            except Exception:
+                print('Failed')
+                print(traceback.format_exc())
+                results.append(None)
+    else:
+        try:
+            results = _run_chain(spec, inputs, const_list)
+        except Exception:
+            print('Failed')
+            print(traceback.format_exc())
+            results = [traceback.format_exc()]*len(inputs)
+    return results
+
+
+def run_shard(spec_file, shard, folder=None):
+    """Fits one shard of a batch job and writes one pickle per MISN
+    (sntd_fit<shard>_<i>.pkl) to folder, which defaults to the folder
+    holding the specification. If the specification uses a task queue,
+    the shard is instead a worker that keeps claiming MISN from the queue
+    (parallelize at a time) and writes sntd_fitq<task>_<i>.pkl for each
+    claim, until the queue is empty.
+
+    Parameters
+    ----------
+    spec_file: str
+        Path to the specification file
+    shard: int
+        The shard to run, or with a task queue any id for the worker (a
+        replacement worker's id is beyond the initial shards)
+    folder: str
+        Where the data are read from and results are written
+
+    Returns
+    -------
+    results: list
+        The fitted MISN (None for failed fits, or the traceback if a
+        parallelized shard failed)
+    """
+    spec = load_job_spec(spec_file)
+    folder = os.path.dirname(os.path.abspath(spec_file)) if folder is None else os.path.abspath(folder)
+    shard = int(shard)
+
+    if spec['batch_init'] is not None:
+        exec(spec['batch_init'], {'__name__': '__sntd_batch__'})
+    else:
+        print("Nothing to initialize...")
+
+    with open(os.path.join(folder, _data_file_), 'rb') as f:
+        all_dat = pickle.load(f)
+    with open(os.path.join(folder, _constants_file_), 'rb') as f:
+        all_const = pickle.load(f)
+
+    if not spec.get('queue', False):
+        start, stop = shard_indices(spec, shard)
+        results = _fit_inputs(spec, all_dat, all_const, range(start, stop))
+        _write_output(folder, shard, results)
+        return results
+
+    queue_file = os.path.join(folder, _queue_file_)
+    nclaim = 1 if spec['parallelize'] is None else spec['parallelize']
+    results = []
+    while True:
+        inds = claim_tasks(queue_file, shard, nclaim,
+                           stale_after=spec.get('queue_timeout', None))
+        if len(inds) == 0:
+            break
+        temp_results = _fit_inputs(spec, all_dat, all_const, inds)
+        # if this worker was slow enough for its claim to be requeued, the
+        # MISN are left to the worker that claimed them again
+        owned = finish_tasks(queue_file, inds, worker=shard)
+        temp_results = [res for ind, res in zip(inds, temp_results) if ind in owned]
+        if len(owned) > 0:
+            _write_output(folder, 'q%i' % owned[0], temp_results)
+        results += temp_results
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        print('Usage: python -m sntd.batch.worker spec_file shard')
+        sys.exit(1)
+    # anything after the shard (e.g. the slurm job id) is ignored
+    run_shard(argv[0], argv[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,17 @@ import os
 import string
 import sncosmo
 import sys
-import corner
 import math
-from collections import OrderedDict as odict
+import json
+import re
+import shutil
+import glob
+from collections import OrderedDict as odict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from astropy.io import ascii
 from astropy.table import Table, vstack, Column
-from scipy.stats import mode
 from copy import deepcopy, copy
-import matplotlib.pyplot as plt
 from sncosmo.snanaio import read_snana_fits
-from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
-import matplotlib.gridspec as gridspec
 
 try:
     import pickle
@@ -21,8 +21,9 @@ except:
     import cPickle
 
 from .util import *
+from .util import _cast_str, _isfloat
 
-__all__ = ['image_lc', 'MISN', 'read_data', 'write_data', 'table_factory']
+__all__ = ['image_lc', 'MISN', 'read_data', 'read_data_bulk', 'write_data', 'table_factory']
 
 _comment_char = {'#', '='}
 _meta__ = {'@', '$', '%', '!', '&'}
@@ -660,6 +661,8 @@ class MISN(dict):
         -------
         figure object: :class:`~matplotlib.pyplot.figure`
         """
+        import matplotlib.pyplot as plt
+        import matplotlib.gridspec as gridspec
 
         if len(self.images['image_1'].microlensing) == 0:
             print('Have not yet run microlensing fit.')
@@ -754,6 +757,8 @@ class MISN(dict):
         -------
         figure object: :class:`~matplotlib.pyplot.figure`
         """
+        import corner
+
         if method == 'parallel':
             if par_image is None:
                 par_image = self.parallel.fitOrder[0]
@@ -867,6 +872,8 @@ class MISN(dict):
         figure : `~matplotlib.pyplot.figure`
 
         """
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 
         colors = ['r', 'g', 'b', 'k', 'm']
         colors3d = ['red', 'green', 'blue', 'black', 'purple']
@@ -1397,14 +1404,17 @@ def table_factory(tables, telescopename="Unknown", object_name='Unknown'):
 
 def _switch(ext):
     switcher = {
-        '.pkl': _read_pickle
+        '.pkl': _read_pickle,
+        _sntd_ext_: _read_sntd
     }
     return switcher.get(ext, _read_data)
 
 
 def write_data(curves, filename=None, protocol=-1):
-    """Used to write a MISN object to a pickle
-        to be read later
+    """Used to write a MISN object to disk to be read later. If
+        the filename ends in ".sntd" the MISN is written in the SNTD binary
+        format (a directory of npy arrays described by a JSON manifest, see
+        :func:`~sntd.read_data`), otherwise it is pickled.
 
     Parameters
     ----------
@@ -1412,7 +1422,8 @@ def write_data(curves, filename=None, protocol=-1):
     filename : str
         Name of output file
     protocol : int
-        Pickling protocol
+        Pickling protocol (also used for the objects in an SNTD binary
+        file that have no array representation, like sncosmo models)
 
     Returns
     -------
@@ -1420,6 +1431,9 @@ def write_data(curves, filename=None, protocol=-1):
     """
     if not filename:
         filename = curves.object
+    if os.path.splitext(filename.rstrip(os.sep))[1] == _sntd_ext_:
+        _write_sntd(curves, filename.rstrip(os.sep), protocol=protocol)
+        return
     with open(filename, 'wb') as handle:
         try:
             pickle.dump(curves, handle, protocol=protocol)
@@ -1435,13 +1449,21 @@ def read_data(filename, **kwargs):
     Parameters
     ----------
     filename : str
-        Name of the file to be read (ascii or pickle)
+        Name of the file to be read (ascii, pickle, or SNTD binary)
+    groups : list
+        For SNTD binary (".sntd") files only, the groups to load out of
+        'photometry', 'fits', 'microlensing', and 'sim'. Default is all of them,
+        and anything not loaded is left at its empty default.
+    mmap : bool
+        For SNTD binary (".sntd") files only, if True (default) arrays are
+        memory-mapped (copy-on-write) so that large arrays like posterior
+        samples are only read from disk when accessed.
 
     Returns
     -------
     curve : :class:`~sntd.curve` or :class:`~sntd.MISN`
     """
-    return(_switch(os.path.splitext(filename)[1])(filename, **kwargs))
+    return(_switch(os.path.splitext(filename.rstrip(os.sep))[1])(filename.rstrip(os.sep), **kwargs))
 
 
 def _read_pickle(filename, telescopename="Unknown", object="Unknown", **kwargs):
@@ -1451,6 +1473,165 @@ def _read_pickle(filename, telescopename="Unknown", object="Unknown", **kwargs):
         return (cPickle.load(open(filename, 'rb')))
 
 
+_sntd_ext_ = '.sntd'
+_sntd_format_version_ = 1
+_sntd_groups_ = ['photometry', 'fits', 'microlensing', 'sim']
+# the group each attribute of a MISN or image_lc is stored under, anything
+# else is small metadata that lives in the manifest
+_sntd_attr_groups_ = {'table': 'photometry', 'fits': 'fits', 'param_quantiles': 'fits',
+                      'parallel': 'fits', 'series': 'fits', 'color': 'fits',
+                      'microlensing': 'microlensing', 'simMeta': 'sim'}
+_sntd_max_inline_ = 16
+
+
+def _sntd_node_types():
+    return {'MISN': MISN, 'image_lc': image_lc, 'newDict': newDict, 'dict': dict,
+            'OrderedDict': odict, 'Result': sncosmo.utils.Result}
+
+
+def _is_json_scalar(value):
+    return value is None or isinstance(value, (bool, int, float, str))
+
+
+def _to_json_scalar(value):
+    if isinstance(value, np.generic) and value.dtype.kind in 'biufU?':
+        return value.item()
+    return value
+
+
+def _write_sntd(curves, filename, protocol=-1):
+    if os.path.isdir(filename):
+        if not os.path.isfile(os.path.join(filename, 'misn.json')):
+            print('%s exists and is not an SNTD binary file, not overwriting.' % filename)
+            sys.exit(1)
+        shutil.rmtree(filename)
+    os.makedirs(filename)
+    manifest = {'format': 'sntd', 'version': _sntd_format_version_,
+                'groups': _sntd_groups_,
+                'object': _encode_sntd(curves, filename, 'misn', None, protocol)}
+    with open(os.path.join(filename, 'misn.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def _sntd_file(root, group, path, ext):
+    rel = os.path.join(group if group is not None else 'meta', path+ext)
+    if not os.path.isdir(os.path.dirname(os.path.join(root, rel))):
+        os.makedirs(os.path.dirname(os.path.join(root, rel)))
+    return rel
+
+
+def _encode_sntd(value, root, path, group, protocol):
+    """
+    Writes anything that can't live in the JSON manifest to disk
+    under root/group/path, and returns the manifest entry describing value.
+    """
+    value = _to_json_scalar(value)
+    if _is_json_scalar(value):
+        return {'kind': 'json', 'value': value}
+
+    if isinstance(value, (list, tuple, set)):
+        items = [_to_json_scalar(x) for x in value]
+        if all([_is_json_scalar(x) for x in items]):
+            if isinstance(value, set):
+                try:
+                    items = sorted(items)
+                except TypeError:
+                    pass
+            return {'kind': 'json', 'value': items, 'type': type(value).__name__}
+
+    if isinstance(value, np.ndarray) and not isinstance(value, np.ma.MaskedArray) \
+            and value.dtype.kind in 'biufcSU?':
+        if value.size <= _sntd_max_inline_ and value.dtype.kind in 'biuf?':
+            return {'kind': 'array', 'value': value.tolist(), 'dtype': value.dtype.str,
+                    'shape': list(value.shape)}
+        rel = _sntd_file(root, group, path, '.npy')
+        np.save(os.path.join(root, rel), value)
+        return {'kind': 'npy', 'file': rel}
+
+    if isinstance(value, Table) and \
+            not any([value[col].dtype.kind == 'O' for col in value.colnames]):
+        arr = value.as_array()
+        rel = _sntd_file(root, group, path, '.npy')
+        entry = {'kind': 'table', 'file': rel, 'masked': bool(value.masked),
+                 'units': {col: str(value[col].unit) for col in value.colnames
+                           if value[col].unit is not None},
+                 'meta': _encode_sntd(dict(value.meta), root, path+'_meta', group, protocol)}
+        if isinstance(arr, np.ma.MaskedArray):
+            entry['mask'] = _sntd_file(root, group, path+'_mask', '.npy')
+            np.save(os.path.join(root, entry['mask']), np.ma.getmaskarray(arr))
+            arr = arr.data
+        np.save(os.path.join(root, rel), arr)
+        return entry
+
+    node_types = _sntd_node_types()
+    type_name = type(value).__name__
+    if type_name in node_types and isinstance(value, node_types[type_name]) and \
+            all([_is_json_scalar(k) for k in value.keys()]):
+        entries = []
+        for key in value.keys():
+            # unpickling MISN/image_lc objects leaves a self-reference here
+            if key == '__dict__':
+                continue
+            key_group = _sntd_attr_groups_.get(key, group) if type_name in ['MISN', 'image_lc']\
+                else group
+            sub_path = os.path.join(path, re.sub(r'[^\w.-]', '_', str(key)))
+            entry = _encode_sntd(value[key], root, sub_path, key_group, protocol)
+            if key_group != group:
+                entry['group'] = key_group
+            entries.append([key, entry])
+        return {'kind': 'node', 'type': type_name, 'entries': entries}
+
+    rel = _sntd_file(root, group, path, '.pkl')
+    with open(os.path.join(root, rel), 'wb') as handle:
+        pickle.dump(value, handle, protocol=protocol)
+    return {'kind': 'pickle', 'file': rel}
+
+
+def _read_sntd(filename, groups=None, mmap=True, **kwargs):
+    with open(os.path.join(filename, 'misn.json'), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format', None) != 'sntd':
+        print('%s is not an SNTD binary file.' % filename)
+        sys.exit(1)
+    if groups is None:
+        groups = manifest['groups']
+    elif isinstance(groups, str):
+        groups = [groups]
+    return _decode_sntd(manifest['object'], filename, groups, 'c' if mmap else None)
+
+
+def _decode_sntd(entry, root, groups, mmap_mode):
+    kind = entry['kind']
+    if kind == 'json':
+        value = entry['value']
+        return {'tuple': tuple, 'set': set}.get(entry.get('type', None), lambda x: x)(value)
+    if kind == 'array':
+        return np.array(entry['value'], dtype=entry['dtype']).reshape(entry['shape'])
+    if kind == 'npy':
+        return np.load(os.path.join(root, entry['file']), mmap_mode=mmap_mode)
+    if kind == 'table':
+        arr = np.load(os.path.join(root, entry['file']), mmap_mode=mmap_mode)
+        if 'mask' in entry:
+            arr = np.ma.MaskedArray(arr, mask=np.load(
+                os.path.join(root, entry['mask'])))
+        table = Table(arr, masked=entry['masked'], copy=False,
+                      meta=_decode_sntd(entry['meta'], root, groups, mmap_mode))
+        for col in entry['units']:
+            table[col].unit = entry['units'][col]
+        return table
+    if kind == 'node':
+        node = _sntd_node_types()[entry['type']]()
+        for key, sub_entry in entry['entries']:
+            if sub_entry.get('group', None) is not None and sub_entry['group'] not in groups:
+                if key not in node:
+                    node[key] = None
+                continue
+            node[key] = _decode_sntd(sub_entry, root, groups, mmap_mode)
+        return node
+    with open(os.path.join(root, entry['file']), 'rb') as handle:
+        return pickle.load(handle)
+
+
 def standardize_table_colnames(table):
     for col in table.colnames:
         if isinstance(table[col][0],str):
@@ -1484,7 +1665,7 @@ def _read_data(filename, **kwargs):
     with anyOpen(filename) as f:
         lines = f.readlines()
         # uses the most common line length as the correct length
-        length = mode([len(l.split()) for l in lines])[0][0]
+        length = _common_line_length(lines)
         for i, line in enumerate(lines):
             if np.any([x in line for x in _comment_char]):
                 continue
@@ -1540,12 +1721,7 @@ def _read_data(filename, **kwargs):
     for band in bnds:
         if _isfloat(band[0]):
             band = 'band_'+band
-        try:
-            if band[0:5] == 'band_':
-                sncosmo.get_bandpass(band[5:])
-            else:
-                sncosmo.get_bandpass(band)
-        except:
+        if not _band_in_registry(band[5:] if band[0:5] == 'band_' else band):
             print('Skipping band %s, not in registry.' % band)
             table.mask[table[get_default_prop_name('band')] == band] = True
             continue
@@ -1556,6 +1732,218 @@ def _read_data(filename, **kwargs):
     return myCurve
 
 
+def read_data_bulk(files, object_col='object', image_col='image', group_func=None,
+                   telescopename='Unknown', nworkers=1, parallel='thread', verbose=False, **kwargs):
+    """Reads many light curves into MISN objects, yielding them one at a
+    time as they are read. The file format is determined once from the
+    first file and reused for the rest.
+
+    Parameters
+    ----------
+    files : str, list, or :class:`~astropy.table.Table`
+        A directory, a glob pattern, a filename, or a list of these. May also
+        be a single table holding many objects (see object_col).
+    object_col : str
+        If a table has this column, it is split into one MISN per unique value
+        (so one file may hold many objects). Otherwise each file (or group
+        of files, see group_func) is one MISN named after the file.
+    image_col : str
+        Column used to split each object's rows into images. If it isn't
+        present, each file is a single image.
+    group_func : function
+        If given, called on each filename and files returning the same value
+        are combined into one MISN of that name (e.g. one file per image).
+    telescopename : str
+        Name of the telescope that the data were gathered from
+    nworkers : int
+        Number of workers reading files at once
+    parallel : str
+        'thread' or 'process' workers
+    verbose : bool
+        Print which format was found and any skipped files
+
+    Returns
+    -------
+    generator of :class:`~sntd.MISN`
+    """
+    if isinstance(files, Table):
+        groups = [(None, files)]
+        fmt = None
+    else:
+        filenames = _expand_filenames(files)
+        if len(filenames) == 0:
+            print('No files found to read.')
+            return
+        lc_files = [f for f in filenames if os.path.splitext(
+            f.rstrip(os.sep))[1] not in ['.pkl', _sntd_ext_]]
+        if group_func is None:
+            groups = [(os.path.splitext(os.path.basename(f))[0], [f])
+                      for f in filenames]
+        else:
+            grouped = odict()
+            for f in filenames:
+                grouped.setdefault(group_func(f), []).append(f)
+            groups = list(grouped.items())
+        fmt = _sniff_format(lc_files[0], **kwargs) if len(lc_files) > 0 else None
+        if verbose:
+            print('Reading %i files as %s...' % (len(filenames), fmt))
+    tasks = [[name, group, fmt, object_col, image_col, telescopename, verbose, kwargs]
+             for name, group in groups]
+
+    if nworkers <= 1:
+        for task in tasks:
+            for misn in _read_bulk_group(task):
+                yield misn
+        return
+
+    executor = ProcessPoolExecutor if parallel == 'process' else ThreadPoolExecutor
+    with executor(max_workers=nworkers) as pool:
+        # only keep a few groups in flight so results stream out in order
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(_read_bulk_group, task))
+            if len(pending) >= 2*nworkers:
+                for misn in pending.popleft().result():
+                    yield misn
+        while pending:
+            for misn in pending.popleft().result():
+                yield misn
+
+
+_bulk_ascii_formats_ = ['ecsv', 'commented_header', 'basic', 'csv', 'tab']
+_valid_bands_ = set()
+
+
+def _band_in_registry(band):
+    if band not in _valid_bands_:
+        try:
+            sncosmo.get_bandpass(band)
+        except:
+            return False
+        _valid_bands_.add(band)
+    return True
+
+
+def _common_line_length(lines):
+    lengths = [len(l.split()) for l in lines]
+    return np.argmax(np.bincount(lengths))
+
+
+def _expand_filenames(files):
+    if isinstance(files, str):
+        files = [files]
+    filenames = []
+    for f in files:
+        if os.path.isdir(f) and os.path.splitext(f.rstrip(os.sep))[1] != _sntd_ext_:
+            filenames += sorted([x for x in glob.glob(os.path.join(f, '*'))
+                                 if os.path.isfile(x) or x.endswith(_sntd_ext_)])
+        elif os.path.exists(f):
+            filenames.append(f)
+        else:
+            filenames += sorted(glob.glob(f))
+    return filenames
+
+
+def _sniff_format(filename, **kwargs):
+    try:
+        table = sncosmo.read_lc(filename, **kwargs)
+        if 'band' in [get_default_prop_name(x.lower()) for x in table.colnames]:
+            return 'sncosmo'
+    except:
+        pass
+    for fmt in _bulk_ascii_formats_:
+        try:
+            table = ascii.read(filename, format=fmt, guess=False)
+        except:
+            continue
+        if 'band' in [get_default_prop_name(x.lower()) for x in table.colnames]:
+            return fmt
+    return 'sntd'
+
+
+def _read_lc_table(filename, fmt, **kwargs):
+    if fmt == 'sntd':
+        return _read_data(filename, **kwargs).table
+    try:
+        if fmt == 'sncosmo':
+            table = sncosmo.read_lc(filename, **kwargs)
+        else:
+            table = ascii.read(filename, format=fmt, guess=False)
+    except:
+        # not like the first file, so figure this one out on its own
+        return _read_data(filename, **kwargs).table
+    for col in table.colnames:
+        if col != get_default_prop_name(col.lower()):
+            table.rename_column(col, get_default_prop_name(col.lower()))
+    for col in [get_default_prop_name(x) for x in ['band', 'zp', 'zpsys']]:
+        if col not in table.colnames:
+            temp = kwargs.get(col, None)
+            if temp is None:
+                raise RuntimeError(
+                    'Column "%s" is not in %s and you did not define it in kwargs.' % (col, filename))
+            table[col] = temp
+    return table
+
+
+def _read_bulk_group(task):
+    name, group, fmt, object_col, image_col, telescopename, verbose, kwargs = task
+    misn_read = []
+    if isinstance(group, Table):
+        tables = [group]
+    else:
+        tables = []
+        for f in group:
+            try:
+                if os.path.splitext(f)[1] in ['.pkl', _sntd_ext_]:
+                    # already a MISN, nothing to build
+                    misn = read_data(f)
+                    if isinstance(misn, MISN):
+                        misn_read.append(misn)
+                    continue
+                tables.append(_read_lc_table(f, fmt, **kwargs))
+            except Exception as e:
+                if verbose:
+                    print('Skipping %s: %s' % (f, e))
+        if len(tables) == 0:
+            return misn_read
+
+    if object_col in tables[0].colnames:
+        table = vstack(tables, metadata_conflicts='silent') if len(
+            tables) > 1 else tables[0]
+        objects = [(str(obj), [table[table[object_col] == obj]])
+                   for obj in np.unique(table[object_col])]
+    else:
+        objects = [(name if name is not None else 'Unknown', tables)]
+
+    all_misn = misn_read
+    for obj_name, obj_tables in objects:
+        image_tables = []
+        for table in obj_tables:
+            table = _clean_bulk_table(table, verbose)
+            if len(table) == 0:
+                continue
+            if image_col in table.colnames:
+                image_tables += [table[table[image_col] == im]
+                                 for im in np.unique(table[image_col])]
+            else:
+                image_tables.append(table)
+        if len(image_tables) > 0:
+            all_misn.append(table_factory(
+                image_tables, telescopename=telescopename, object_name=obj_name))
+    return all_misn
+
+
+def _clean_bulk_table(table, verbose=False):
+    bands = table[get_default_prop_name('band')]
+    keep = ~np.ma.getmaskarray(bands)
+    for band in np.unique(np.asarray(bands)[keep]):
+        if not _band_in_registry(band):
+            if verbose:
+                print('Skipping band %s, not in registry.' % band)
+            keep[np.asarray(bands) == band] = False
+    return _norm_flux_mag(table[keep])
+
+
 def _norm_flux_mag(table):
     if 'mag' not in table.colnames:
         if 'flux' not in table.colnames:
@@ -1569,20 +1957,20 @@ def _norm_flux_mag(table):
 
 
 def _flux_to_mag(table):
-    table[get_default_prop_name('mag')] = np.asarray(map(lambda x, y: -2.5 * np.log10(x) + y, table[get_default_prop_name('flux')],
-                                                         table[get_default_prop_name('zp')]))
-    table[get_default_prop_name('magerr')] = np.asarray(map(lambda x, y: 2.5 * np.log10(np.e) * y / x, table[get_default_prop_name('flux')],
-                                                            table[get_default_prop_name('fluxerr')]))
+    flux = np.asarray(table[get_default_prop_name('flux')], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table[get_default_prop_name('mag')] = -2.5 * np.log10(flux) + \
+            np.asarray(table[get_default_prop_name('zp')], dtype=float)
+        table[get_default_prop_name('magerr')] = 2.5 * np.log10(np.e) * \
+            np.asarray(table[get_default_prop_name('fluxerr')], dtype=float) / flux
     table[get_default_prop_name('magerr')][np.isnan(
         table[get_default_prop_name('mag')])] = np.nan
     return table
 
 
 def _mag_to_flux(table):
-    table[get_default_prop_name('flux')] = np.asarray(
-        map(lambda x, y: 10 ** (-.4 * (x - y)), table[get_default_prop_name('mag')],
-            table[get_default_prop_name('zp')]))
-    table[get_default_prop_name('fluxerr')] = np.asarray(
-        map(lambda x, y: x * y / (2.5 * np.log10(np.e)), table[get_default_prop_name('magerr')],
-            table[get_default_prop_name('flux')]))
+    table[get_default_prop_name('flux')] = 10 ** (-.4 * (np.asarray(table[get_default_prop_name('mag')], dtype=float) -
+                                                         np.asarray(table[get_default_prop_name('zp')], dtype=float)))
+    table[get_default_prop_name('fluxerr')] = np.asarray(table[get_default_prop_name('magerr')], dtype=float) * \
+        np.asarray(table[get_default_prop_name('flux')]) / (2.5 * np.log10(np.e))
     return table
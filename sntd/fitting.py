@@ -9,26 +9,29 @@ import glob
 import math
 import time
 import tarfile
+import multiprocessing
 import numpy as np
-import matplotlib.pyplot as plt
 from copy import copy
 from scipy import stats
 from astropy.table import Table
 import nestle
-from sklearn.gaussian_process import GaussianProcessRegressor
-from sklearn.gaussian_process.kernels import RBF
 import scipy
 import itertools
 from sncosmo import nest_lc
+from sncosmo.photdata import photometric_data
 from itertools import combinations
 from collections import OrderedDict
 
 
 from .util import *
-from .util import _filedir_, _current_dir_
+from .util import _filedir_, _current_dir_, _PosteriorDensity, _FitStats
 from .curve_io import _sntd_deepcopy
-from .models import BazinSource
+from .batch.worker import make_job_spec, write_job_spec
+from .batch.scheduler import get_scheduler
+from .batch.taskqueue import init_queue, _stale_after_
+from .models import BazinSource, KarpenkaSource, NewlingSource, _model_for_source
 from .ml import *
+from .ml import _use_sntd_flux
 
 __all__ = ['fit_data']
 
@@ -40,6 +43,14 @@ _thetaL_ = ['t0', 'amplitude', 'screenebv', 'dt0',
 
 _needs_bounds = {'z'}
 
+# process-wide caches of resolved snType model lists and of template models,
+# so sources are read from disk once per process and copied for each fit
+_model_lists_ = {}
+_template_models_ = {}
+
+# default minimum number of candidate models for a pool of trial fits
+_model_selection_pool_ = 10
+
 
 def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bounds={}, ignore=None, constants={}, ignore_models=[],
              method='parallel', t0_guess=None, effect_names=[], effect_frames=[], batch_init=None, cut_time=None, force_positive_param=[],
@@ -48,7 +59,7 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
              fit_prior=None, par_or_batch='parallel', batch_partition=None, nbatch_jobs=None, batch_python_path=None, n_per_node=None, fast_model_selection=True,
              wait_for_batch=False, band_order=None, set_from_simMeta={}, guess_amplitude=True, trial_fit=False, clip_data=False, use_MLE=False,
              kernel='RBF', refImage='image_1', nMicroSamples=100, color_curve=None, warning_supress=True,
-             micro_fit_bands='all', verbose=True, **kwargs):
+             micro_fit_bands='all', verbose=True, batch_scheduler='slurm', batch_queue=False, **kwargs):
     """The main high-level fitting function.
 
     Parameters
@@ -81,7 +92,7 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
     effect_frames: :class:`~list` of :class:`~str`
         List of the frames (e.g. obs or rest) that correspond to the effects in effect_names
     batch_init: :class:`~str`
-        A string to be pasted into the batch python file (e.g. extra imports or filters added to sncosmo.)
+        Code run by each batch worker before fitting (e.g. extra imports or filters added to sncosmo.)
     cut_time: :class:`~list`
         The start and end (rest frame) phase that you want to fit in, default accept all phases. 
     force_positive_param: :class:`~list`
@@ -134,6 +145,15 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
         If you are providing a list of models and want the best fit, turning this on will make the fitter choose based
         on a simple minuit fit before moving to the full sntd fitting. If false, each model will be fitted with the full
         sntd fitting and the best will be chosen. 
+    model_prune: int
+        (keyword) With fast_model_selection, only the model_prune models with the lowest chi-square on a quick
+        amplitude and t0 grid screen of the highest S/N epochs get a minuit fit. Default is None (no pruning).
+    model_prune_npoints: int
+        (keyword) Number of epochs used in the model_prune screen (default 20)
+    model_selection_pool: int
+        (keyword) With fast_model_selection, the trial fits are spread over npar_cores processes only if there
+        are at least this many candidate models (default 10). Smaller sets are fit serially, which is faster
+        than starting a pool.
     wait_for_batch: bool
         if false, submits job in the background. If true, waits for job to finish (shows progress bar) and returns output.
     band_order: :class:`~list`
@@ -164,13 +184,30 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
         Turns on or off warnings
     micro_fit_bands: str or list of str
         The band(s) to fit microlensing. All assumes achromatic, and will fit all bands together.
+    prior_density: str
+        (keyword) How the reference image's posterior is turned into a prior on the other images
+        for the parallel method, 'kde' (default) or 'gaussian'
     verbose: bool
         Turns on/off the verbosity flag
+    batch_scheduler: str or :class:`~sntd.batch.scheduler.BatchScheduler`
+        How batch jobs are run: 'slurm' (default, sbatch), 'local' (a process pool on this machine) or
+        'inprocess' (one job at a time in this process, for testing)
+    batch_queue: bool
+        If True, batch jobs pull MISN one at a time (n_cores_per_node at a time when parallelized) from a shared
+        SQLite queue in the batch folder until it's empty, instead of fitting fixed slices of n_per_node. This
+        balances jobs when fit times vary a lot (e.g. with microlensing or many models).
+    batch_queue_timeout: float
+        (keyword) With batch_queue, seconds after which MISN claimed by a job that hasn't finished them (e.g. it was
+        killed at the end of its walltime) are given to another job (default 43200, i.e. 12 hours)
     Returns
     -------
     fitted_MISN: :class:`~sntd.curve_io.MISN` or :class:`~list`
         The same MISN that was passed to fit_data, but with new fits and time delay measurements included. List
         if list was provided.
+        Each method's results (e.g. fitted_MISN.parallel) also hold fit_time and fit_stats, a dictionary of
+        the wall time spent in each stage (quality, model_selection, trial_fit, nested_sampling, microlensing,
+        micro_uncertainty), the total likelihood calls (ncall), sampler iterations (niter) and their ratio
+        (efficiency) over the nsampler nested sampling runs.
     Examples
     --------
     >>> fitCurves=sntd.fit_data(myMISN,snType='Ia', models='salt2-extended',bands=['F110W','F125W'],
@@ -209,31 +246,13 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
             args['bands'] = list(curves.bands) if not isinstance(
                 curves, (list, tuple, np.ndarray)) and not isinstance(args['curves'][0], str) else None
 
-    args['bands'] = _bandCheck(args['curves'],args['bands'])
+    if not args['parlist']:
+        args['bands'] = _bandCheck(args['curves'], args['bands'])
     # get together the model(s) needed for fitting
     models = [models] if models is not None and not isinstance(
         models, (tuple, list, np.ndarray)) else models
     if models is None:
-        mod, types = np.loadtxt(os.path.join(
-            _filedir_, 'data', 'sncosmo', 'models.ref'), dtype='str', unpack=True)
-        modDict = {mod[i]: types[i] for i in range(len(mod))}
-        if isinstance(snType, str):
-            if snType != 'Ia':
-                mods = [x[0] for x in sncosmo.models._SOURCES._loaders.keys(
-                ) if x[0] in modDict.keys() and modDict[x[0]][:len(snType)] == snType]
-            elif snType == 'Ia':
-                mods = [x[0] for x in sncosmo.models._SOURCES._loaders.keys()
-                        if 'salt2' in x[0]]
-        else:
-            mods = []
-            for t in snType:
-                if t != 'Ia':
-                    mods = np.append(mods, [x[0] for x in sncosmo.models._SOURCES._loaders.keys(
-                    ) if x[0] in modDict.keys() and modDict[x[0]][:len(t)] == t])
-                elif t == 'Ia':
-                    mods = np.append(
-                        mods, [x[0] for x in sncosmo.models._SOURCES._loaders.keys() if 'salt2' in x[0]])
-
+        mods = _models_for_type(snType)
     else:
         mods = models
     mods = np.unique(mods)
@@ -276,136 +295,7 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
                 sys.exit(1)
             else:
 
-                if n_cores_per_node > 1:
-                    parallelize = n_cores_per_node
-                    n_per_node = max(n_per_node, n_cores_per_node)
-                    micro_par = None
-                elif microlensing is not None:
-                    parallelize = None
-                    micro_par = npar_cores
-                else:
-                    parallelize = None
-                    micro_par = None
-                total_jobs = math.ceil(len(args['curves'])/n_per_node)
-                if nbatch_jobs is None:
-                    nbatch_jobs = min(total_jobs, max_batch_jobs)
-                script_name_init, folder_name = make_sbatch(partition=batch_partition,
-                                                            njobs=min(total_jobs, nbatch_jobs), njobstotal=min(total_jobs, max_batch_jobs), python_path=batch_python_path, init=True, parallelize=parallelize, microlensing_cores=micro_par)
-                script_name, folder_name = make_sbatch(partition=batch_partition, folder=folder_name,
-                                                       njobs=min(total_jobs, nbatch_jobs), python_path=batch_python_path, init=False, parallelize=parallelize, microlensing_cores=micro_par)
-
-                pickle.dump(constants, open(os.path.join(
-                    folder_name, 'sntd_constants.pkl'), 'wb'))
-                pickle.dump(args['curves'], open(
-                    os.path.join(folder_name, 'sntd_data.pkl'), 'wb'))
-                pyfiles = ['run_sntd_init.py', 'run_sntd.py'] if parallelize is None else [
-                    'run_sntd_init_par.py', 'run_sntd_par.py']
-                for pyfile in pyfiles:
-                    with open(os.path.join(_filedir_, 'batch', pyfile)) as f:
-                        batch_py = f.read()
-                    if 'init' in pyfile:
-                        batch_py = batch_py.replace('nlcsreplace', str(
-                            min(int(n_per_node*min(total_jobs, max_batch_jobs)), len(args['curves']))))
-                        batch_py = batch_py.replace(
-                            'njobsreplace', str(min(total_jobs, max_batch_jobs)))
-                    else:
-                        batch_py = batch_py.replace(
-                            'nlcsreplace', str(n_per_node))
-                    if batch_init is None:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', 'print("Nothing to initialize...")')
-                    else:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', batch_init)
-                    batch_py = batch_py.replace(
-                        'ncores', str(n_cores_per_node))
-
-                    indent1 = batch_py.find('fitCurves=')
-                    indent = batch_py.find('try:')+len('try:')+1
-
-                    sntd_command = ''
-                    for i in range(len(method)):
-                        fit_method = method[i]
-                        sntd_command += 'sntd.fit_data('
-                        for par, val in locs.items():
-                            if par == 'curves':
-                                if i == 0:
-                                    if parallelize is None:
-                                        sntd_command += 'curves=all_dat[i],'
-                                    else:
-                                        sntd_command += 'curves=all_input,'
-                                else:
-                                    sntd_command += 'curves=fitCurves,'
-                            elif par == 'constants':
-                                if parallelize is None:
-                                    sntd_command += 'constants=all_dat[i].constants,'
-                                else:
-                                    sntd_command += 'constants={'+'},'
-                            elif par == 'batch_init':
-                                sntd_command += 'batch_init=None,'
-
-                            elif par == 'identify_micro' and identify_micro:
-                                if i > 0:
-                                    sntd_command += 'identify_micro=False,'
-                                else:
-                                    sntd_command += 'identify_micro=True,'
-                            elif par == 'bands' and identify_micro:
-                                if i > 0:
-                                    if parallelize is None:
-                                        if fit_method != 'color':
-                                            sntd_command += 'bands=fitCurves.micro_bands,'
-                                        else:
-                                            sntd_command += 'bands=fitCurves.micro_color_bands,'
-                                    else:
-                                        print('Have not implemented this yet.')
-                                        sys.exit(1)
-
-                                else:
-                                    sntd_command += 'bands=None,'
-                            elif fit_method == 'color' and par == 'bands':
-                                if color_bands is not None:
-                                    sntd_command += 'bands=' + \
-                                        str(color_bands)+','
-
-                                else:
-                                    sntd_command += 'bands='+str(val)+','
-
-                            elif par == 'method':
-                                sntd_command += 'method="'+fit_method+'",'
-                            elif par == 'fit_prior' and fit_method != 'parallel' and (fit_prior is not None and fit_prior is not False):
-                                if parallelize is None:
-                                    sntd_command += 'fit_prior=fitCurves,'
-                                else:
-                                    sntd_command += 'fit_prior=True,'
-                            elif par == 'par_or_batch' and parallelize is not None:
-                                sntd_command += 'par_or_batch="parallel",'
-                            elif par == 'npar_cores' and parallelize is not None:
-                                sntd_command += 'npar_cores=%i,' % n_cores_per_node
-                            elif isinstance(val, str):
-                                sntd_command += str(par)+'="'+str(val)+'",'
-                            elif par == 'kwargs':
-
-                                for par2, val2 in val.items():
-                                    if isinstance(val, str):
-                                        sntd_command += str(par2) + \
-                                            '="'+str(val2)+'",'
-                                    else:
-                                        sntd_command += str(par2) + \
-                                            '='+str(val2)+','
-                            else:
-                                sntd_command += str(par)+'='+str(val)+','
-
-                        sntd_command = sntd_command[:-1]+')\n'
-                        if i < len(method)-1:
-                            sntd_command += ' '*(indent1-indent)+'fitCurves='
-
-                    batch_py = batch_py.replace(
-                        'sntdcommandreplace', sntd_command)
-
-                    with open(os.path.join(os.path.abspath(folder_name), pyfile), 'w') as f:
-                        f.write(batch_py)
-
-                return run_sbatch(folder_name, script_name_init, script_name, total_jobs, max_batch_jobs, n_per_node, wait_for_batch, parallelize, len(args['curves']), verbose)
+                return _batch_fit(args, locs, method, n_per_node)
 
         else:
             initBounds = copy(args['bounds'])
@@ -469,100 +359,12 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
                                 pass
                     par_arg_vals.append([args['curves'][i], temp_args])
 
+                _warm_models(args['models'])
+
                 curves = pyParz.foreach(par_arg_vals, _fitparallel, [
                                         args], numThreads=min(npar_cores, len(par_arg_vals)))
             else:
-                if n_cores_per_node > 1:
-                    parallelize = n_cores_per_node
-                    n_per_node = max(n_per_node, n_cores_per_node)
-                    micro_par = None
-                elif microlensing is not None:
-                    parallelize = None
-                    micro_par = npar_cores
-                else:
-                    parallelize = None
-                    micro_par = None
-                total_jobs = math.ceil(len(args['curves'])/n_per_node)
-                if nbatch_jobs is None:
-                    nbatch_jobs = min(total_jobs, max_batch_jobs)
-                script_name_init, folder_name = make_sbatch(partition=batch_partition,
-                                                            njobs=min(total_jobs, nbatch_jobs), njobstotal=min(total_jobs, max_batch_jobs), python_path=batch_python_path, init=True, parallelize=parallelize, microlensing_cores=micro_par)
-                script_name, folder_name = make_sbatch(partition=batch_partition, folder=folder_name,
-                                                       njobs=min(total_jobs, nbatch_jobs), python_path=batch_python_path, init=False, parallelize=parallelize, microlensing_cores=micro_par)
-
-                pickle.dump(constants, open(os.path.join(
-                    folder_name, 'sntd_constants.pkl'), 'wb'))
-                pickle.dump(args['curves'], open(
-                    os.path.join(folder_name, 'sntd_data.pkl'), 'wb'))
-                pyfiles = ['run_sntd_init.py', 'run_sntd.py'] if parallelize is None else [
-                    'run_sntd_init_par.py', 'run_sntd_par.py']
-                for pyfile in pyfiles:
-                    with open(os.path.join(_filedir_, 'batch', pyfile)) as f:
-                        batch_py = f.read()
-                    if 'init' in pyfile:
-                        batch_py = batch_py.replace('nlcsreplace', str(
-                            min(int(n_per_node*min(total_jobs, max_batch_jobs)), len(args['curves']))))
-                        batch_py = batch_py.replace(
-                            'njobsreplace', str(min(total_jobs, max_batch_jobs)))
-                    else:
-                        batch_py = batch_py.replace(
-                            'nlcsreplace', str(n_per_node))
-                    if batch_init is None:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', 'print("Nothing to initialize...")')
-                    else:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', batch_init)
-                    batch_py = batch_py.replace(
-                        'ncores', str(n_cores_per_node))
-
-                    indent1 = batch_py.find('fitCurves=')
-                    indent = batch_py.find('try:')+len('try:')+1
-
-                    sntd_command = 'sntd.fit_data('
-                    for par, val in locs.items():
-
-                        if par == 'curves':
-                            if parallelize is None:
-                                sntd_command += 'curves=all_dat[i],'
-                            else:
-                                sntd_command += 'curves=all_input,'
-                        elif par == 'batch_init':
-                            sntd_command += 'batch_init=None,'
-                        elif par == 'constants':
-                            if parallelize is None:
-                                sntd_command += 'constants=all_dat[i].constants,'
-                            else:
-                                sntd_command += 'constants=const_list,'
-                        elif par == 'method':
-                            sntd_command += 'method="parallel",'
-                        elif par == 'par_or_batch' and parallelize is not None:
-                            sntd_command += 'par_or_batch="parallel",'
-                        elif par == 'npar_cores' and parallelize is not None:
-                            sntd_command += 'npar_cores=%i,' % n_cores_per_node
-                        elif isinstance(val, str):
-                            sntd_command += str(par)+'="'+str(val)+'",'
-                        elif par == 'kwargs':
-
-                            for par2, val2 in val.items():
-                                if isinstance(val, str):
-                                    sntd_command += str(par2) + \
-                                        '="'+str(val2)+'",'
-                                else:
-                                    sntd_command += str(par2)+'='+str(val2)+','
-
-                        else:
-                            sntd_command += str(par)+'='+str(val)+','
-
-                    sntd_command = sntd_command[:-1]+')'
-
-                    batch_py = batch_py.replace(
-                        'sntdcommandreplace', sntd_command)
-
-                    with open(os.path.join(os.path.abspath(folder_name), pyfile), 'w') as f:
-                        f.write(batch_py)
-
-                return run_sbatch(folder_name, script_name_init, script_name, total_jobs, max_batch_jobs, n_per_node, wait_for_batch, parallelize, len(args['curves']), verbose)
+                return _batch_fit(args, locs, method, n_per_node)
 
         else:
             curves = _fitparallel(args)
@@ -582,97 +384,11 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
                     except:
                         pass
                     par_arg_vals.append([args['curves'][i], temp_args])
+                _warm_models(args['models'])
                 curves = pyParz.foreach(par_arg_vals, _fitseries, [
                                         args], numThreads=min(npar_cores, len(par_arg_vals)))
             else:
-                if n_cores_per_node > 1:
-                    parallelize = n_cores_per_node
-                    n_per_node = max(n_per_node, n_cores_per_node)
-                    micro_par = None
-                elif microlensing is not None:
-                    parallelize = None
-                    micro_par = npar_cores
-                else:
-                    parallelize = None
-                    micro_par = None
-                total_jobs = math.ceil(len(args['curves'])/n_per_node)
-                if nbatch_jobs is None:
-                    nbatch_jobs = min(total_jobs, max_batch_jobs)
-                script_name_init, folder_name = make_sbatch(partition=batch_partition,
-                                                            njobs=min(total_jobs, nbatch_jobs), njobstotal=min(total_jobs, max_batch_jobs), python_path=batch_python_path, init=True, parallelize=parallelize, microlensing_cores=micro_par)
-                script_name, folder_name = make_sbatch(partition=batch_partition, folder=folder_name,
-                                                       njobs=min(total_jobs, nbatch_jobs), python_path=batch_python_path, init=False, parallelize=parallelize, microlensing_cores=micro_par)
-
-                pickle.dump(constants, open(os.path.join(
-                    folder_name, 'sntd_constants.pkl'), 'wb'))
-                pickle.dump(args['curves'], open(
-                    os.path.join(folder_name, 'sntd_data.pkl'), 'wb'))
-                pyfiles = ['run_sntd_init.py', 'run_sntd.py'] if parallelize is None else [
-                    'run_sntd_init_par.py', 'run_sntd_par.py']
-                for pyfile in pyfiles:
-                    with open(os.path.join(_filedir_, 'batch', pyfile)) as f:
-                        batch_py = f.read()
-                    if 'init' in pyfile:
-                        batch_py = batch_py.replace('nlcsreplace', str(
-                            min(int(n_per_node*min(total_jobs, max_batch_jobs)), len(args['curves']))))
-                        batch_py = batch_py.replace(
-                            'njobsreplace', str(min(total_jobs, max_batch_jobs)))
-                    else:
-                        batch_py = batch_py.replace(
-                            'nlcsreplace', str(n_per_node))
-                    if batch_init is None:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', 'print("Nothing to initialize...")')
-                    else:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', batch_init)
-                    batch_py = batch_py.replace(
-                        'ncores', str(n_cores_per_node))
-
-                    indent1 = batch_py.find('fitCurves=')
-                    indent = batch_py.find('try:')+len('try:')+1
-                    sntd_command = 'sntd.fit_data('
-                    for par, val in locs.items():
-                        if par == 'curves':
-                            if parallelize is None:
-                                sntd_command += 'curves=all_dat[i],'
-                            else:
-                                sntd_command += 'curves=all_input,'
-                        elif par == 'batch_init':
-                            sntd_command += 'batch_init=None,'
-                        elif par == 'constants':
-                            if parallelize is None:
-                                sntd_command += 'constants=all_dat[i].constants,'
-                            else:
-                                sntd_command += 'constants={'+'},'
-                        elif par == 'method':
-                            sntd_command += 'method="series",'
-                        elif par == 'par_or_batch' and parallelize is not None:
-                            sntd_command += 'par_or_batch="parallel",'
-                        elif par == 'npar_cores' and parallelize is not None:
-                            sntd_command += 'npar_cores=%i,' % n_cores_per_node
-                        elif isinstance(val, str):
-                            sntd_command += str(par)+'="'+str(val)+'",'
-                        elif par == 'kwargs':
-
-                            for par2, val2 in val.items():
-                                if isinstance(val, str):
-                                    sntd_command += str(par2) + \
-                                        '="'+str(val2)+'",'
-                                else:
-                                    sntd_command += str(par2)+'='+str(val2)+','
-                        else:
-                            sntd_command += str(par)+'='+str(val)+','
-
-                    sntd_command = sntd_command[:-1]+')'
-
-                    batch_py = batch_py.replace(
-                        'sntdcommandreplace', sntd_command)
-
-                    with open(os.path.join(os.path.abspath(folder_name), pyfile), 'w') as f:
-                        f.write(batch_py)
-
-                return run_sbatch(folder_name, script_name_init, script_name, total_jobs, max_batch_jobs, n_per_node, wait_for_batch, parallelize, len(args['curves']), verbose)
+                return _batch_fit(args, locs, method, n_per_node)
         else:
             curves = _fitseries(args)
 
@@ -692,97 +408,11 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
                     except:
                         pass
                     par_arg_vals.append([args['curves'][i], temp_args])
+                _warm_models(args['models'])
                 curves = pyParz.foreach(par_arg_vals, _fitColor, [
                                         args], numThreads=min(npar_cores, len(par_arg_vals)))
             else:
-                if n_cores_per_node > 1:
-                    parallelize = n_cores_per_node
-                    n_per_node = max(n_per_node, n_cores_per_node)
-                    micro_par = None
-                elif microlensing is not None:
-                    parallelize = None
-                    micro_par = npar_cores
-                else:
-                    parallelize = None
-                    micro_par = None
-                total_jobs = math.ceil(len(args['curves'])/n_per_node)
-                if nbatch_jobs is None:
-                    nbatch_jobs = min(total_jobs, max_batch_jobs)
-                script_name_init, folder_name = make_sbatch(partition=batch_partition,
-                                                            njobs=min(total_jobs, nbatch_jobs), njobstotal=min(total_jobs, max_batch_jobs), python_path=batch_python_path, init=True, parallelize=parallelize, microlensing_cores=micro_par)
-                script_name, folder_name = make_sbatch(partition=batch_partition, folder=folder_name,
-                                                       njobs=min(total_jobs, nbatch_jobs), python_path=batch_python_path, init=False, parallelize=parallelize, microlensing_cores=micro_par)
-
-                pickle.dump(constants, open(os.path.join(
-                    folder_name, 'sntd_constants.pkl'), 'wb'))
-                pickle.dump(args['curves'], open(
-                    os.path.join(folder_name, 'sntd_data.pkl'), 'wb'))
-                pyfiles = ['run_sntd_init.py', 'run_sntd.py'] if parallelize is None else [
-                    'run_sntd_init_par.py', 'run_sntd_par.py']
-                for pyfile in pyfiles:
-                    with open(os.path.join(_filedir_, 'batch', pyfile)) as f:
-                        batch_py = f.read()
-                    if 'init' in pyfile:
-                        batch_py = batch_py.replace('nlcsreplace', str(
-                            min(int(n_per_node*min(total_jobs, max_batch_jobs)), len(args['curves']))))
-                        batch_py = batch_py.replace(
-                            'njobsreplace', str(min(total_jobs, max_batch_jobs)))
-                    else:
-                        batch_py = batch_py.replace(
-                            'nlcsreplace', str(n_per_node))
-                    if batch_init is None:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', 'print("Nothing to initialize...")')
-                    else:
-                        batch_py = batch_py.replace(
-                            'batchinitreplace', batch_init)
-                    batch_py = batch_py.replace(
-                        'ncores', str(n_cores_per_node))
-
-                    indent1 = batch_py.find('fitCurves=')
-                    indent = batch_py.find('try:')+len('try:')+1
-                    sntd_command = 'sntd.fit_data('
-                    for par, val in locs.items():
-                        if par == 'curves':
-                            if parallelize is None:
-                                sntd_command += 'curves=all_dat[i],'
-                            else:
-                                sntd_command += 'curves=all_input,'
-                        elif par == 'batch_init':
-                            sntd_command += 'batch_init=None,'
-                        elif par == 'constants':
-                            if parallelize is None:
-                                sntd_command += 'constants=all_dat[i].constants,'
-                            else:
-                                sntd_command += 'constants={'+'},'
-                        elif par == 'method':
-                            sntd_command += 'method="color",'
-                        elif par == 'par_or_batch' and parallelize is not None:
-                            sntd_command += 'par_or_batch="parallel",'
-                        elif par == 'npar_cores' and parallelize is not None:
-                            sntd_command += 'npar_cores=%i,' % n_cores_per_node
-                        elif isinstance(val, str):
-                            sntd_command += str(par)+'="'+str(val)+'",'
-                        elif par == 'kwargs':
-
-                            for par2, val2 in val.items():
-                                if isinstance(val, str):
-                                    sntd_command += str(par2) + \
-                                        '="'+str(val2)+'",'
-                                else:
-                                    sntd_command += str(par2)+'='+str(val2)+','
-                        else:
-                            sntd_command += str(par)+'='+str(val)+','
-
-                    sntd_command = sntd_command[:-1]+')'
-
-                    batch_py = batch_py.replace(
-                        'sntdcommandreplace', sntd_command)
-
-                    with open(os.path.join(os.path.abspath(folder_name), pyfile), 'w') as f:
-                        f.write(batch_py)
-
-                return run_sbatch(folder_name, script_name_init, script_name, total_jobs, max_batch_jobs, n_per_node, wait_for_batch, parallelize, len(args['curves']), verbose)
+                return _batch_fit(args, locs, method, n_per_node)
         else:
 
             if args['color_bands'] is not None:
@@ -792,6 +422,190 @@ def fit_data(curves=None, snType='Ia', bands=None, models=None, params=None, bou
 
     return curves
 
+def _models_for_type(snType):
+    types_key = (snType,) if isinstance(snType, str) else tuple(snType)
+    # the registry length is part of the key in case sources are registered later
+    key = (types_key, len(sncosmo.models._SOURCES._loaders))
+    if key not in _model_lists_:
+        mod, types = np.loadtxt(os.path.join(
+            _filedir_, 'data', 'sncosmo', 'models.ref'), dtype='str', unpack=True)
+        modDict = {mod[i]: types[i] for i in range(len(mod))}
+        names = [x[0] for x in sncosmo.models._SOURCES._loaders.keys()]
+        mods = []
+        for t in types_key:
+            if t == 'Ia':
+                mods = np.append(mods, [x for x in names if 'salt2' in x])
+            else:
+                mods = np.append(mods, [x for x in names if x in modDict.keys()
+                                        and modDict[x][:len(t)] == t])
+        _model_lists_[key] = np.unique(mods)
+    return copy(_model_lists_[key])
+
+
+def _template_model(source, effects=None, effect_names=None, effect_frames=None):
+    """
+    Returns a model for a registered source name, loading the source only
+    the first time it's requested. Only the effect-free model is cached, as
+    effects can hold settings outside of their parameters (e.g. r_v).
+    """
+    if not isinstance(source, str):
+        return _model_for_source(source=source, effects=effects, effect_names=effect_names,
+                                 effect_frames=effect_frames)
+    # keep the registered instance, so a source registered again under the
+    # same name (register(..., force=True)) replaces the cached model
+    registered = sncosmo.models._SOURCES.retrieve(source)
+    if source not in _template_models_ or _template_models_[source][0] is not registered:
+        _template_models_[source] = (registered, _model_for_source(
+            source=sncosmo.get_source(source)))
+    template = _template_models_[source][1]
+    if not effects:
+        return copy(template)
+    return _model_for_source(source=template._source, effects=effects,
+                             effect_names=effect_names, effect_frames=effect_frames)
+
+
+def _warm_models(models):
+    # load sources before forking so that pyParz workers inherit them
+    for mod in np.array(models).flatten():
+        if isinstance(mod, str) and mod.upper() not in ['BAZIN', 'BAZINSOURCE']:
+            try:
+                sncosmo.get_source(mod)
+            except Exception:
+                pass
+
+
+def _chisq_screen(model, data, npoints=20):
+    """
+    A cheap goodness of fit for pruning candidate models, using the
+    highest S/N epochs, a coarse t0 grid and the best linear amplitude.
+    """
+    data = photometric_data(data)
+    keep = np.argsort(data.flux/data.fluxerr)[::-1][:npoints]
+    data = data[keep[np.argsort(data.time[keep], kind='stable')]]
+    weights = 1./data.fluxerr**2
+    model = copy(model)
+    model.set(**{model.param_names[2]: 1.})
+    t_peak = data.time[np.argmax(data.flux/data.fluxerr)]
+    best = np.inf
+    for t0 in t_peak+np.arange(-20, 22, 2.)*(1+model.get('z')):
+        model.set(t0=t0)
+        try:
+            model_flux = model.bandflux(
+                data.band, data.time, zp=data.zp, zpsys=data.zpsys)
+        except Exception:
+            continue
+        denom = np.sum(weights*model_flux**2)
+        if not denom > 0:
+            continue
+        amp = max(np.sum(weights*data.flux*model_flux)/denom, 0)
+        best = min(best, np.sum(weights*(data.flux-amp*model_flux)**2))
+    return best/len(data)
+
+
+def _trial_fit(all_args):
+    (ind, mod, model, data), (params, bounds, minsnr) = all_args
+    vparams = [x for x in params if x in model.param_names]
+    try:
+        res, fit = sncosmo.fit_lc(data, model, vparams,
+                                  bounds={b: bounds[b] for b in bounds if b not in [
+                                      't0', model.param_names[2]]},
+                                  minsnr=minsnr)
+    except Exception:
+        return [ind, mod, None, None, np.inf]
+    return [ind, mod, fit, res, res.chisq/(len(data)+len(vparams)-1)]
+
+
+def _fast_model_selection(args, table, candidates):
+    """
+    Runs a quick sncosmo.fit_lc for each candidate [mod, model, inds], over
+    a pool of npar_cores processes if there are at least model_selection_pool
+    candidates, and returns the name of the model with the lowest reduced
+    chi-square along with a dictionary of all the trial fits.
+    """
+    if args.get('model_prune', None) is not None and len(candidates) > args['model_prune']:
+        screen = [_chisq_screen(model, table[inds], args.get('model_prune_npoints', 20))
+                  for _, model, inds in candidates]
+        candidates = [candidates[i]
+                      for i in np.argsort(screen, kind='stable')[:args['model_prune']]]
+        if args['verbose']:
+            print('Kept %s after the chi-square screen...' %
+                  ', '.join([str(x[0]) for x in candidates]))
+
+    jobs = [[i, mod, model, table[inds]]
+            for i, (mod, model, inds) in enumerate(candidates)]
+    fit_args = [args['params'], args['bounds'], args.get('minsnr', 0)]
+    ncores = min(args.get('npar_cores', 1), len(jobs))
+    # starting a pool and pickling the models costs more than a few trial
+    # fits, and daemonic pyParz workers (lists of MISN) can't start one
+    if ncores > 1 and len(jobs) >= args.get('model_selection_pool', _model_selection_pool_) and \
+            not multiprocessing.current_process().daemon:
+        results = [x for x in pyParz.foreach(
+            jobs, _trial_fit, fit_args, numThreads=ncores) if x is not None]
+    else:
+        results = [_trial_fit([job, fit_args]) for job in jobs]
+    results.sort(key=lambda x: x[0])
+
+    bestmodname = None
+    minchisq = np.inf
+    all_fit_dict = {}
+    for _, mod, fit, res, chisq in results:
+        if fit is None:
+            if args['verbose']:
+                print('Issue with %s, skipping...' % mod)
+            continue
+        if chisq < minchisq:
+            minchisq = chisq
+            bestmodname = copy(mod)
+        all_fit_dict[mod] = [fit, res]
+    return bestmodname, all_fit_dict
+
+
+def _batch_fit(args, locs, method, n_per_node):
+    if args['n_cores_per_node'] > 1:
+        parallelize = args['n_cores_per_node']
+        n_per_node = max(n_per_node, parallelize)
+        micro_par = None
+    elif args['microlensing'] is not None:
+        parallelize = None
+        micro_par = args['npar_cores']
+    else:
+        parallelize = None
+        micro_par = None
+    max_batch_jobs = args['max_batch_jobs']
+    total_jobs = math.ceil(len(args['curves'])/n_per_node)
+    nbatch_jobs = args['nbatch_jobs'] if args['nbatch_jobs'] is not None else min(
+        total_jobs, max_batch_jobs)
+
+    if args['batch_queue']:
+        # the jobs become workers pulling from a shared queue, so there are only
+        # as many as can run at once and none are submitted later
+        total_jobs = min(total_jobs, nbatch_jobs, max_batch_jobs)
+        n_per_node = math.ceil(len(args['curves'])/total_jobs)
+        total_jobs = math.ceil(len(args['curves'])/n_per_node)
+
+    fit_kwargs = {k: v for k, v in locs.items() if k not in [
+        'curves', 'kwargs', 'batch_scheduler']}
+    fit_kwargs.update(locs['kwargs'])
+    queue_timeout = args.get('batch_queue_timeout', _stale_after_) if args['batch_queue'] else None
+    spec = make_job_spec(fit_kwargs, method, len(args['curves']), n_per_node,
+                         parallelize=parallelize, batch_init=args['batch_init'], queue=args['batch_queue'],
+                         queue_timeout=queue_timeout)
+    scheduler = get_scheduler(args['batch_scheduler'], partition=args['batch_partition'],
+                              python_path=args['batch_python_path'], parallelize=parallelize,
+                              microlensing_cores=micro_par)
+
+    folder_name = make_batch_folder()
+    write_job_spec(spec, folder_name, curves=args['curves'],
+                   constants=locs['constants'])
+    if args['batch_queue']:
+        init_queue(folder_name, len(args['curves']))
+    scheduler.setup(folder_name, njobs=min(total_jobs, nbatch_jobs),
+                    njobstotal=min(total_jobs, max_batch_jobs))
+
+    return run_sbatch(folder_name, None, None, total_jobs, max_batch_jobs, n_per_node, args['wait_for_batch'], parallelize,
+                      len(args['curves']), args['verbose'], scheduler=scheduler, queue_timeout=queue_timeout)
+
+
 def _bandCheck(curves,bands):
     final_bands = []
     for b in bands:
@@ -810,6 +624,7 @@ def _bandCheck(curves,bands):
 
 def _fitColor(all_args):
     fit_start = time.time()
+    stats = _FitStats()
     # Check if parallelized or single fit
     if isinstance(all_args, (list, tuple, np.ndarray)):
         curves, args = all_args
@@ -969,9 +784,9 @@ def _fitColor(all_args):
         args['models'] = args['fit_prior'].images[args['fit_prior'].parallel.fitOrder[0]
                                                   ].fits.model._source.name
 
-    if not args['curves'].quality_check(min_n_bands=2,
-                                        min_n_points_per_band=args['min_points_per_band'],
-                                        clip=False, method='parallel'):
+    if not stats.time('quality', args['curves'].quality_check, min_n_bands=2,
+                      min_n_points_per_band=args['min_points_per_band'],
+                      clip=False, method='parallel'):
         if args['verbose']:
             print("Curve(s) not passing quality check.")
         return
@@ -984,7 +799,7 @@ def _fitColor(all_args):
             else:
                 args['bounds'][b] = np.array([0, np.inf])
 
-        minchisq = np.inf
+        candidates = []
         init_inds = copy(inds)
         for mod in np.array(args['models']).flatten():
             inds = copy(init_inds)
@@ -999,11 +814,11 @@ def _fitColor(all_args):
                     source = BazinSource(
                         data=args['curves'].images[ref].table[inds], colorCurve=args['color_curve'])
                 else:
-                    source = sncosmo.get_source(mod)
-                tempMod = sncosmo.Model(
+                    source = mod
+                tempMod = _template_model(
                     source=source, effects=effects, effect_names=effect_names, effect_frames=effect_frames)
             else:
-                tempMod = copy(mod)
+                tempMod = _use_sntd_flux(copy(mod))
 
             tempMod.set(**{k: args['constants'][k]
                            for k in args['constants'].keys() if k in tempMod.param_names})
@@ -1012,38 +827,23 @@ def _fitColor(all_args):
 
             if mod == 'BAZINSOURCE':
                 tempMod.set(z=0)
-            try:
-                res, fit = sncosmo.fit_lc(args['curves'].images[ref].table[inds], tempMod, [x for x in args['params'] if x in tempMod.param_names],
-                                          bounds={b: args['bounds'][b] for b in args['bounds'] if b not in [
-                                              't0', tempMod.param_names[2]]},
-                                          minsnr=args.get('minsnr', 0))
-            except:
-                if args['verbose']:
-                    print('Issue with %s, skipping...' % mod)
-                continue
-            tempchisq = res.chisq / \
-                (len(inds)+len([x for x in args['params']
-                                if x in tempMod.param_names])-1)
-            if tempchisq < minchisq:
-                minchisq = tempchisq
-                bestres = copy(res)
-                bestfit = copy(fit)
-                bestmodname = copy(mod)
-            all_fit_dict[mod] = [copy(fit), copy(res)]
-        try:
-            args['models'] = [bestmodname]
-        except:
+            candidates.append([mod, tempMod, inds])
+        bestmodname, trial_fits = stats.time('model_selection', _fast_model_selection,
+                                             args, args['curves'].images[ref].table, candidates)
+        all_fit_dict.update(trial_fits)
+        if bestmodname is None:
             print('Every model had an error.')
             sys.exit(1)
+        args['models'] = [bestmodname]
     finallogz = -np.inf
     for mod in np.array(args['models']).flatten():
 
         if isinstance(mod, str):
-            source = sncosmo.get_source(mod)
-            tempMod = sncosmo.Model(source=source, effects=effects,
-                                    effect_names=effect_names, effect_frames=effect_frames)
+            source = mod
+            tempMod = _template_model(source=source, effects=effects,
+                                      effect_names=effect_names, effect_frames=effect_frames)
         else:
-            tempMod = copy(mod)
+            tempMod = _use_sntd_flux(copy(mod))
         tempMod.set(**{k: args['constants'][k]
                        for k in args['constants'].keys() if k in tempMod.param_names})
         tempMod.set(**{k: args['curves'].images[args['refImage']].simMeta[args['set_from_simMeta'][k]]
@@ -1085,12 +885,12 @@ def _fitColor(all_args):
                         temp_bands = np.append(temp_bands, np.where(
                             args['curves'].images[im].table['band'] == b)[0])
                     temp_inds = temp_bands.astype(int)
-                    res, fit = sncosmo.fit_lc(copy(args['curves'].images[im].table[temp_inds]), tempMod,
-                                              [x for x in args['params'] if x in tempMod.param_names and x in args['bounds'].keys()] +
-                                              [tempMod.param_names[2]],
-                                              bounds={b: args['bounds'][b] for b in args['bounds'].keys() if b not in [
-                                                  't0', tempMod.param_names[2]]},
-                                              minsnr=args.get('minsnr', 0))
+                    res, fit = stats.time('trial_fit', sncosmo.fit_lc, copy(args['curves'].images[im].table[temp_inds]), tempMod,
+                                          [x for x in args['params'] if x in tempMod.param_names and x in args['bounds'].keys()] +
+                                          [tempMod.param_names[2]],
+                                          bounds={b: args['bounds'][b] for b in args['bounds'].keys() if b not in [
+                                              't0', tempMod.param_names[2]]},
+                                          minsnr=args.get('minsnr', 0))
                     temp_delays[im] = fit.get('t0')
                 for param in args['color_param_ignore']:
                     if param not in args['constants']:
@@ -1182,18 +982,19 @@ def _fitColor(all_args):
             else:
                 args['bounds'][b] = np.array([0, np.inf])
 
-        if not args['curves'].quality_check(min_n_bands=args['min_n_bands'],
-                                            min_n_points_per_band=args['min_points_per_band'], clip=args['clip_data'], method='color'):
+        if not stats.time('quality', args['curves'].quality_check, min_n_bands=args['min_n_bands'],
+                          min_n_points_per_band=args['min_points_per_band'], clip=args['clip_data'], method='color'):
             print("Error: Did not pass quality check.")
             return
 
-        params, res, model = nest_color_lc(args['curves'].color.table, tempMod, nimage, colors=colors_to_fit,
-                                           bounds=args['bounds'], use_MLE=args['use_MLE'],
-                                           vparam_names=[x for x in all_vparam_names if x in tempMod.param_names or x in snParams], ref=par_ref,
-                                           minsnr=args.get('minsnr', 5.), priors=args.get('priors', None), ppfs=args.get('ppfs', None),
-                                           method=args.get('nest_method', 'single'), maxcall=args.get('maxcall', None),
-                                           modelcov=args.get('modelcov', None), rstate=args.get('rstate', None),
-                                           maxiter=args.get('maxiter', None), npoints=args.get('npoints', 100))
+        params, res, model = stats.time('nested_sampling', nest_color_lc, args['curves'].color.table, tempMod, nimage, colors=colors_to_fit,
+                                        bounds=args['bounds'], use_MLE=args['use_MLE'],
+                                        vparam_names=[x for x in all_vparam_names if x in tempMod.param_names or x in snParams], ref=par_ref,
+                                        minsnr=args.get('minsnr', 5.), priors=args.get('priors', None), ppfs=args.get('ppfs', None),
+                                        method=args.get('nest_method', 'single'), maxcall=args.get('maxcall', None),
+                                        modelcov=args.get('modelcov', None), rstate=args.get('rstate', None),
+                                        maxiter=args.get('maxiter', None), npoints=args.get('npoints', 100))
+        stats.add_sampler(res)
         if finallogz < res.logz:
             finallogz = res.logz
             finalres, finalmodel = res, model
@@ -1322,6 +1123,7 @@ def _fitColor(all_args):
     args['curves'].color.fits['res'] = finalres
     fit_end = time.time()
     args['curves'].color.fit_time = fit_end - fit_start
+    args['curves'].color.fit_stats = stats.summary()
     return args['curves']
 
 
@@ -1503,8 +1305,8 @@ def nest_color_lc(data, model, nimage, colors, vparam_names, bounds, ref='image_
         params = [[res.samples[best_ind, i]-res.errors[vparam_names[i]], res.samples[best_ind, i], res.samples[best_ind, i]+res.errors[vparam_names[i]]]
                   for i in range(len(vparam_names))]
     else:
-        params = [weighted_quantile(
-            res.samples[:, i], [.16, .5, .84], res.weights) for i in range(len(vparam_names))]
+        params = list(weighted_quantiles(
+            res.samples, [.16, .5, .84], res.weights))
 
     model.set(**{model_param_names[k]: params[model_idx[k]][1]
                  for k in range(len(model_idx))})
@@ -1513,6 +1315,7 @@ def nest_color_lc(data, model, nimage, colors, vparam_names, bounds, ref='image_
 
 def _fitseries(all_args):
     fit_start = time.time()
+    stats = _FitStats()
     if isinstance(all_args, (list, tuple, np.ndarray)):
         curves, args = all_args
         if isinstance(args, list):
@@ -1664,8 +1467,8 @@ def _fitseries(all_args):
         args['models'] = [x for x in np.array(
             args['models']).flatten() if x not in to_ignore]
     all_fit_dict = {}
-    if not args['curves'].quality_check(min_n_bands=args['min_n_bands'],
-                                        min_n_points_per_band=args['min_points_per_band'], clip=False, method='parallel'):
+    if not stats.time('quality', args['curves'].quality_check, min_n_bands=args['min_n_bands'],
+                      min_n_points_per_band=args['min_points_per_band'], clip=False, method='parallel'):
         return
     if args['fast_model_selection'] and len(np.array(args['models']).flatten()) > 1:
         for b in args['force_positive_param']:
@@ -1675,7 +1478,7 @@ def _fitseries(all_args):
             else:
                 args['bounds'][b] = np.array([0, np.inf])
 
-        minchisq = np.inf
+        candidates = []
         init_inds = copy(inds)
         for mod in np.array(args['models']).flatten():
             inds = copy(init_inds)
@@ -1690,11 +1493,11 @@ def _fitseries(all_args):
                     source = BazinSource(
                         data=args['curves'].images[ref].table[inds], colorCurve=args['color_curve'])
                 else:
-                    source = sncosmo.get_source(mod)
-                tempMod = sncosmo.Model(
+                    source = mod
+                tempMod = _template_model(
                     source=source, effects=effects, effect_names=effect_names, effect_frames=effect_frames)
             else:
-                tempMod = copy(mod)
+                tempMod = _use_sntd_flux(copy(mod))
 
             tempMod.set(**{k: args['constants'][k]
                            for k in args['constants'].keys() if k in tempMod.param_names})
@@ -1706,29 +1509,14 @@ def _fitseries(all_args):
                 continue
             if mod == 'BAZINSOURCE':
                 tempMod.set(z=0)
-            try:
-                res, fit = sncosmo.fit_lc(args['curves'].images[ref].table[inds], tempMod, [x for x in args['params'] if x in tempMod.param_names],
-                                          bounds={b: args['bounds'][b] for b in args['bounds'] if b not in [
-                                              't0', tempMod.param_names[2]]},
-                                          minsnr=args.get('minsnr', 0))
-            except:
-                if args['verbose']:
-                    print('Issue with %s, skipping...' % mod)
-                continue
-            tempchisq = res.chisq / \
-                (len(inds)+len([x for x in args['params']
-                                if x in tempMod.param_names])-1)
-            if tempchisq < minchisq:
-                minchisq = tempchisq
-                bestres = copy(res)
-                bestfit = copy(fit)
-                bestmodname = copy(mod)
-            all_fit_dict[mod] = [copy(fit), copy(res)]
-        try:
-            args['models'] = [bestmodname]
-        except:
+            candidates.append([mod, tempMod, inds])
+        bestmodname, trial_fits = stats.time('model_selection', _fast_model_selection,
+                                             args, args['curves'].images[ref].table, candidates)
+        all_fit_dict.update(trial_fits)
+        if bestmodname is None:
             print('Every model had an error.')
             sys.exit(1)
+        args['models'] = [bestmodname]
 
     for mod in np.array(args['models']).flatten():
 
@@ -1737,12 +1525,12 @@ def _fitseries(all_args):
                 source = BazinSource(
                     data=args['curves'].images[args['fitOrder'][0]].table)
             else:
-                source = sncosmo.get_source(mod)
+                source = mod
 
-            tempMod = sncosmo.Model(source=source, effects=effects,
-                                    effect_names=effect_names, effect_frames=effect_frames)
+            tempMod = _template_model(source=source, effects=effects,
+                                      effect_names=effect_names, effect_frames=effect_frames)
         else:
-            tempMod = copy(mod)
+            tempMod = _use_sntd_flux(copy(mod))
         tempMod.set(**{k: args['constants'][k]
                        for k in args['constants'].keys() if k in tempMod.param_names})
         tempMod.set(**{k: args['curves'].images[args['refImage']].simMeta[args['set_from_simMeta'][k]]
@@ -1792,10 +1580,10 @@ def _fitseries(all_args):
                             args['curves'].images[im].table['band'] == b)[0])
                     temp_inds = temp_bands.astype(int)
 
-                    res, fit = sncosmo.fit_lc(copy(args['curves'].images[im].table[temp_inds]), tempMod, [x for x in args['params'] if x in tempMod.param_names],
-                                              bounds={b: args['bounds'][b] for b in args['bounds'].keys() if b not in [
-                                                  't0', tempMod.param_names[2]]},
-                                              minsnr=args.get('minsnr', 0))
+                    res, fit = stats.time('trial_fit', sncosmo.fit_lc, copy(args['curves'].images[im].table[temp_inds]), tempMod, [x for x in args['params'] if x in tempMod.param_names],
+                                          bounds={b: args['bounds'][b] for b in args['bounds'].keys() if b not in [
+                                              't0', tempMod.param_names[2]]},
+                                          minsnr=args.get('minsnr', 0))
                     temp_delays[im] = fit.get('t0')
 
                     temp_mags[im] = fit.parameters[2]
@@ -1915,20 +1703,21 @@ def _fitseries(all_args):
 
         for b in [x for x in np.unique(args['curves'].series.table['band']) if x not in args['curves'].series.bands]:
             args['curves'].series.table = args['curves'].series.table[args['curves'].series.table['band'] != b]
-        if not args['curves'].quality_check(min_n_bands=args['min_n_bands'],
-                                            min_n_points_per_band=args['min_points_per_band'], clip=args['clip_data'], method='series'):
+        if not stats.time('quality', args['curves'].quality_check, min_n_bands=args['min_n_bands'],
+                          min_n_points_per_band=args['min_points_per_band'], clip=args['clip_data'], method='series'):
             print('Error: Did not pass quality check.')
             return
 
         vparam_names_final = [
             x for x in all_vparam_names if x in tempMod.param_names or x in np.array(snParams).flatten()]
 
-        params, res, model = nest_series_lc(args['curves'].series.table, tempMod, nimage, bounds=args['bounds'], use_MLE=args['use_MLE'],
-                                            vparam_names=vparam_names_final, ref=par_ref,
-                                            minsnr=args.get('minsnr', 5.), priors=args.get('priors', None), ppfs=args.get('ppfs', None),
-                                            method=args.get('nest_method', 'single'), maxcall=args.get('maxcall', None),
-                                            modelcov=args.get('modelcov', None), rstate=args.get('rstate', None),
-                                            maxiter=args.get('maxiter', None), npoints=args.get('npoints', 100))
+        params, res, model = stats.time('nested_sampling', nest_series_lc, args['curves'].series.table, tempMod, nimage, bounds=args['bounds'], use_MLE=args['use_MLE'],
+                                        vparam_names=vparam_names_final, ref=par_ref,
+                                        minsnr=args.get('minsnr', 5.), priors=args.get('priors', None), ppfs=args.get('ppfs', None),
+                                        method=args.get('nest_method', 'single'), maxcall=args.get('maxcall', None),
+                                        modelcov=args.get('modelcov', None), rstate=args.get('rstate', None),
+                                        maxiter=args.get('maxiter', None), npoints=args.get('npoints', 100))
+        stats.add_sampler(res)
         if finallogz < res.logz:
             finallogz = res.logz
             final_param_quantiles, finalres, finalmodel = params, res, model
@@ -2163,9 +1952,9 @@ def _fitseries(all_args):
 
     if args['microlensing'] is not None:
         tempTable = copy(args['curves'].series.table)
-        micro, sigma, x_pred, y_pred, samples, x_resid, y_resid, err_resid = fit_micro(args['curves'].series.fits.model, tempTable,
-                                                                                       tempTable['zpsys'][0], args['nMicroSamples'],
-                                                                                       micro_type=args['microlensing'], kernel=args['kernel'])
+        micro, sigma, x_pred, y_pred, samples, x_resid, y_resid, err_resid = stats.time('microlensing', fit_micro, args['curves'].series.fits.model, tempTable,
+                                                                                        tempTable['zpsys'][0], args['nMicroSamples'],
+                                                                                        micro_type=args['microlensing'], kernel=args['kernel'])
 
         temp_vparam_names = args['curves'].series.fits.res.vparam_names + \
             [finalmodel.param_names[2]]+['t0']
@@ -2194,10 +1983,10 @@ def _fitseries(all_args):
         args['curves'].series.microlensing.resid_err = err_resid
 
         try:
-            t0s = pyParz.foreach(samples.T, _micro_uncertainty,
-                                 [args['curves'].series.fits.model, np.array(tempTable), tempTable.colnames,
-                                  x_pred, temp_vparam_names,
-                                  temp_bounds, None, args.get('minsnr', 0), args.get('maxcall', None), args['npoints']])
+            t0s = stats.time('micro_uncertainty', pyParz.foreach, samples.T, _micro_uncertainty,
+                             [args['curves'].series.fits.model, np.array(tempTable), tempTable.colnames,
+                              x_pred, temp_vparam_names,
+                              temp_bounds, None, args.get('minsnr', 0), args.get('maxcall', None), args['npoints']])
         except:
             if args['verbose']:
                 print('Issue with series microlensing identification, skipping...')
@@ -2210,6 +1999,7 @@ def _fitseries(all_args):
                                                                  + sigma**2)
     fit_end = time.time()
     args['curves'].series.fit_time = fit_end - fit_start
+    args['curves'].series.fit_stats = stats.summary()
 
     return args['curves']
 
@@ -2381,8 +2171,8 @@ def nest_series_lc(data, model, nimage, vparam_names, bounds, ref='image_1', use
         params = [[res.samples[best_ind, i]-res.errors[vparam_names[i]], res.samples[best_ind, i], res.samples[best_ind, i]+res.errors[vparam_names[i]]]
                   for i in range(len(vparam_names))]
     else:
-        params = [weighted_quantile(
-            res.samples[:, i], [.16, .5, .84], res.weights) for i in range(len(vparam_names))]
+        params = list(weighted_quantiles(
+            res.samples, [.16, .5, .84], res.weights))
 
     model.set(**{model_param_names[k]: params[model_idx[k]][1]
                  for k in range(len(model_idx))})
@@ -2422,6 +2212,7 @@ def getBandSNR(curves, bands, min_points_per_band):
 
 def _fitparallel(all_args):
     fit_start = time.time()
+    stats = _FitStats()
     if isinstance(all_args, (list, tuple, np.ndarray)):
         curves, args = all_args
         if isinstance(args, list):
@@ -2528,8 +2319,8 @@ def _fitparallel(all_args):
             to_ignore = [to_ignore]
         args['models'] = [x for x in np.array(
             args['models']).flatten() if x not in to_ignore]
-    if not args['curves'].quality_check(min_n_bands=args['min_n_bands'],
-                                        min_n_points_per_band=args['min_points_per_band'], clip=args['clip_data']):
+    if not stats.time('quality', args['curves'].quality_check, min_n_bands=args['min_n_bands'],
+                      min_n_points_per_band=args['min_points_per_band'], clip=args['clip_data']):
         return
     all_fit_dict = {}
     if args['fast_model_selection'] and len(np.array(args['models']).flatten()) > 1:
@@ -2540,7 +2331,7 @@ def _fitparallel(all_args):
             else:
                 args['bounds'][b] = np.array([0, np.inf])
 
-        minchisq = np.inf
+        candidates = []
         init_inds = copy(inds)
         for mod in np.array(args['models']).flatten():
             inds = copy(init_inds)
@@ -2563,11 +2354,11 @@ def _fitparallel(all_args):
                     source = BazinSource(
                         data=args['curves'].images[args['fitOrder'][0]].table[inds], colorCurve=args['color_curve'])
                 else:
-                    source = sncosmo.get_source(mod)
-                tempMod = sncosmo.Model(
+                    source = mod
+                tempMod = _template_model(
                     source=source, effects=effects, effect_names=effect_names, effect_frames=effect_frames)
             else:
-                tempMod = copy(mod)
+                tempMod = _use_sntd_flux(copy(mod))
 
             tempMod.set(**{k: args['constants'][k]
                            for k in args['constants'].keys() if k in tempMod.param_names})
@@ -2579,29 +2370,14 @@ def _fitparallel(all_args):
                 continue
             if mod == 'BAZINSOURCE':
                 tempMod.set(z=0)
-            try:
-                res, fit = sncosmo.fit_lc(args['curves'].images[args['fitOrder'][0]].table[inds], tempMod, [x for x in args['params'] if x in tempMod.param_names],
-                                          bounds={b: args['bounds'][b] for b in args['bounds'] if b not in [
-                                              't0', tempMod.param_names[2]]},
-                                          minsnr=args.get('minsnr', 0))
-            except:
-                if args['verbose']:
-                    print('Issue with %s, skipping...' % mod)
-                continue
-            tempchisq = res.chisq / \
-                (len(inds)+len([x for x in args['params']
-                                if x in tempMod.param_names])-1)
-            if tempchisq < minchisq:
-                minchisq = tempchisq
-                bestres = copy(res)
-                bestfit = copy(fit)
-                bestmodname = copy(mod)
-            all_fit_dict[mod] = [copy(fit), copy(res)]
-        try:
-            args['models'] = [bestmodname]
-        except:
+            candidates.append([mod, tempMod, inds])
+        bestmodname, trial_fits = stats.time('model_selection', _fast_model_selection,
+                                             args, args['curves'].images[args['fitOrder'][0]].table, candidates)
+        all_fit_dict.update(trial_fits)
+        if bestmodname is None:
             print('Every model had an error.')
             return None
+        args['models'] = [bestmodname]
     for mod in np.array(args['models']).flatten():
         if isinstance(mod, str):
             if mod.upper() in ['BAZIN', 'BAZINSOURCE']:
@@ -2622,11 +2398,11 @@ def _fitparallel(all_args):
                 source = BazinSource(
                     data=args['curves'].images[args['fitOrder'][0]].table[inds], colorCurve=args['color_curve'])
             else:
-                source = sncosmo.get_source(mod)
-            tempMod = sncosmo.Model(source=source, effects=effects,
-                                    effect_names=effect_names, effect_frames=effect_frames)
+                source = mod
+            tempMod = _template_model(source=source, effects=effects,
+                                      effect_names=effect_names, effect_frames=effect_frames)
         else:
-            tempMod = copy(mod)
+            tempMod = _use_sntd_flux(copy(mod))
         
         tempMod.set(**{k: args['constants'][k]
                        for k in args['constants'].keys() if k in tempMod.param_names})
@@ -2654,10 +2430,10 @@ def _fitparallel(all_args):
             else:
                 temp_inds = copy(inds)
 
-            res, fit = sncosmo.fit_lc(args['curves'].images[args['fitOrder'][0]].table[temp_inds], tempMod, [x for x in args['params'] if x in tempMod.param_names],
-                                      bounds={b: args['bounds'][b]+(args['bounds'][b]-np.median(
-                                          args['bounds'][b]))*2 for b in args['bounds'].keys() if b not in ['t0', tempMod.param_names[2]]},
-                                      minsnr=args.get('minsnr', 0))
+            res, fit = stats.time('trial_fit', sncosmo.fit_lc, args['curves'].images[args['fitOrder'][0]].table[temp_inds], tempMod, [x for x in args['params'] if x in tempMod.param_names],
+                                  bounds={b: args['bounds'][b]+(args['bounds'][b]-np.median(
+                                      args['bounds'][b]))*2 for b in args['bounds'].keys() if b not in ['t0', tempMod.param_names[2]]},
+                                  minsnr=args.get('minsnr', 0))
 
             for b in args['bounds'].keys():
                 if b in res.param_names:
@@ -2722,14 +2498,15 @@ def _fitparallel(all_args):
                     [max([args['bounds'][b][0], 0]), max([args['bounds'][b][1], 0])])
             else:
                 args['bounds'][b] = np.array([0, np.inf])
-        res, fit = sncosmo.nest_lc(fit_table, tempMod, [x for x in args['params'] if x in tempMod.param_names],
-                                   bounds=args['bounds'],
-                                   priors=args.get('priors', None), ppfs=args.get('ppfs', None),
-                                   minsnr=args.get('minsnr', 5.0), method=args.get('nest_method', 'single'),
-                                   maxcall=args.get('maxcall', None), modelcov=args.get('modelcov', False),
-                                   rstate=args.get('rstate', None), guess_amplitude_bound=False,
-                                   zpsys=args['curves'].images[args['fitOrder'][0]].zpsys,
-                                   maxiter=args.get('maxiter', None), npoints=args.get('npoints', 100))
+        res, fit = stats.time('nested_sampling', sncosmo.nest_lc, fit_table, tempMod, [x for x in args['params'] if x in tempMod.param_names],
+                              bounds=args['bounds'],
+                              priors=args.get('priors', None), ppfs=args.get('ppfs', None),
+                              minsnr=args.get('minsnr', 5.0), method=args.get('nest_method', 'single'),
+                              maxcall=args.get('maxcall', None), modelcov=args.get('modelcov', False),
+                              rstate=args.get('rstate', None), guess_amplitude_bound=False,
+                              zpsys=args['curves'].images[args['fitOrder'][0]].zpsys,
+                              maxiter=args.get('maxiter', None), npoints=args.get('npoints', 100))
+        stats.add_sampler(res)
 
         all_fit_dict[mod] = [copy(fit), copy(res)]
 
@@ -2737,8 +2514,8 @@ def _fitparallel(all_args):
             first_res = [args['fitOrder'][0], copy(fit), copy(res)]
             finallogz = res.logz
     if not args['use_MLE']:
-        first_params = [weighted_quantile(first_res[2].samples[:, i], [.16, .5, .84], first_res[2].weights)
-                        for i in range(len(first_res[2].vparam_names))]
+        first_params = list(weighted_quantiles(
+            first_res[2].samples, [.16, .5, .84], first_res[2].weights))
     else:
         best_ind = first_res[2].logl.argmax()
         first_params = [[first_res[2].samples[best_ind, i]-first_res[2].errors[first_res[2].vparam_names[i]],
@@ -2811,10 +2588,10 @@ def _fitparallel(all_args):
                 temp_inds = temp_bands.astype(int)
             else:
                 temp_inds = copy(inds)
-            res, fit = sncosmo.fit_lc(args['curves'].images[d].table[temp_inds], args['curves'].images[args['fitOrder'][0]].fits['model'],
-                                      ['t0', args['curves'].images[args['fitOrder']
-                                                                   [0]].fits['model'].param_names[2]],
-                                      minsnr=args.get('minsnr', 0))
+            res, fit = stats.time('trial_fit', sncosmo.fit_lc, args['curves'].images[d].table[temp_inds], args['curves'].images[args['fitOrder'][0]].fits['model'],
+                                  ['t0', args['curves'].images[args['fitOrder']
+                                                               [0]].fits['model'].param_names[2]],
+                                  minsnr=args.get('minsnr', 0))
             image_bounds = {b: initial_bounds[b] if b != 't0' else initial_bounds['t0']+fit.get(
                 't0') for b in initial_bounds.keys()}
             guess_t0_start = False
@@ -2826,18 +2603,20 @@ def _fitparallel(all_args):
                 guess_t0_start = False
 
 
-        par_output = nest_parallel_lc(fit_table, first_res[1], first_res[2], image_bounds, min_n_bands=args['min_n_bands'],
-                                      min_n_points_per_band=args[
-                                          'min_points_per_band'], guess_t0_start=guess_t0_start, use_MLE=args['use_MLE'],
-                                      guess_amplitude_bound=True, priors=args.get('priors', None), ppfs=args.get('None'),
-                                      method=args.get('nest_method', 'single'), cut_time=args['cut_time'], snr_band_inds=inds,
-                                      maxcall=args.get('maxcall', None), modelcov=args.get('modelcov', False),
-                                      rstate=args.get('rstate', None), minsnr=args.get('minsnr', 5),
-                                      maxiter=args.get('maxiter', None), npoints=args.get('npoints', 1000))
+        par_output = stats.time('nested_sampling', nest_parallel_lc, fit_table, first_res[1], first_res[2], image_bounds, min_n_bands=args['min_n_bands'],
+                                min_n_points_per_band=args[
+                                    'min_points_per_band'], guess_t0_start=guess_t0_start, use_MLE=args['use_MLE'],
+                                guess_amplitude_bound=True, priors=args.get('priors', None), ppfs=args.get('None'),
+                                method=args.get('nest_method', 'single'), cut_time=args['cut_time'], snr_band_inds=inds,
+                                maxcall=args.get('maxcall', None), modelcov=args.get('modelcov', False),
+                                rstate=args.get('rstate', None), minsnr=args.get('minsnr', 5),
+                                maxiter=args.get('maxiter', None), npoints=args.get('npoints', 1000),
+                                prior_density=args.get('prior_density', 'kde'))
 
         if par_output is None:
             return
         params, args['curves'].images[d].fits['model'], args['curves'].images[d].fits['res'] = par_output
+        stats.add_sampler(args['curves'].images[d].fits['res'])
 
     sample_dict = {args['fitOrder'][0]: [
         first_res[2].samples[:, t0ind], first_res[2].samples[:, ampind]]}
@@ -2915,12 +2694,12 @@ def _fitparallel(all_args):
     if args['microlensing'] is not None:
         for k in args['curves'].images.keys():
             tempTable = copy(args['curves'].images[k].table)
-            micro, sigma, x_pred, y_pred, samples, x_resid, y_resid, err_resid = fit_micro(args['curves'].images[k].fits.model,
-                                                                                           tempTable, args['curves'].images[
-                                                                                               k].zpsys, args['nMicroSamples'],
-                                                                                           micro_type=args[
-                                                                                               'microlensing'], kernel=args['kernel'],
-                                                                                           bands=args['micro_fit_bands'])
+            micro, sigma, x_pred, y_pred, samples, x_resid, y_resid, err_resid = stats.time('microlensing', fit_micro, args['curves'].images[k].fits.model,
+                                                                                            tempTable, args['curves'].images[
+                                                                                                k].zpsys, args['nMicroSamples'],
+                                                                                            micro_type=args[
+                                                                                                'microlensing'], kernel=args['kernel'],
+                                                                                            bands=args['micro_fit_bands'])
             args['curves'].images[k].microlensing.micro_propagation_effect = micro
             args['curves'].images[k].microlensing.micro_x = x_pred
             args['curves'].images[k].microlensing.micro_y = y_pred
@@ -2932,13 +2711,13 @@ def _fitparallel(all_args):
 
             try:
 
-                t0s = pyParz.foreach(samples.T, _micro_uncertainty,
-                                     [args['curves'].images[k].fits.model, np.array(tempTable), tempTable.colnames,
-                                      x_pred, args['curves'].images[k].fits.res.vparam_names,
-                                      {p: args['curves'].images[k].param_quantiles[p][[0, 2]]
-                                         for p in args['curves'].images[k].fits.res.vparam_names if p !=
-                                         args['curves'].images[k].fits.model.param_names[2]}, None,
-                                      args.get('minsnr', 0), args.get('maxcall', None), args['npoints']], numThreads=args['npar_cores'])
+                t0s = stats.time('micro_uncertainty', pyParz.foreach, samples.T, _micro_uncertainty,
+                                 [args['curves'].images[k].fits.model, np.array(tempTable), tempTable.colnames,
+                                  x_pred, args['curves'].images[k].fits.res.vparam_names,
+                                  {p: args['curves'].images[k].param_quantiles[p][[0, 2]]
+                                     for p in args['curves'].images[k].fits.res.vparam_names if p !=
+                                     args['curves'].images[k].fits.model.param_names[2]}, None,
+                                  args.get('minsnr', 0), args.get('maxcall', None), args['npoints']], numThreads=args['npar_cores'])
             except RuntimeError:
                 if args['verbose']:
                     print('Issue with microlensing identification, skipping...')
@@ -2950,6 +2729,7 @@ def _fitparallel(all_args):
                                                                         + sigma**2)
     fit_end = time.time()
     args['curves'].parallel.fit_time = fit_end - fit_start
+    args['curves'].parallel.fit_stats = stats.summary()
     return args['curves']
 
 
@@ -2958,7 +2738,7 @@ def nest_parallel_lc(data, model, prev_res, bounds, guess_amplitude_bound=False,
                      min_n_bands=1, min_n_points_per_band=3,
                      minsnr=5., priors=None, ppfs=None, npoints=100, method='single',
                      maxiter=None, maxcall=None, modelcov=False, rstate=None,
-                     verbose=False, warn=True, **kwargs):
+                     verbose=False, warn=True, prior_density='kde', **kwargs):
 
     # Taken from SNCosmo nest_lc
     # experimental parameters
@@ -3026,9 +2806,8 @@ def nest_parallel_lc(data, model, prev_res, bounds, guess_amplitude_bound=False,
             doPrior = False
         else:
             doPrior = True
-            prior_dist = NDposterior('temp')
-            prior_func = prior_dist._logpdf([tuple(prev_res.samples[i, prior_inds]) for i in range(prev_res.samples.shape[0])],
-                                            prev_res.weights)
+            prior_func = _PosteriorDensity(prev_res.samples[:, prior_inds], prev_res.weights,
+                                           method=prior_density)
 
     else:
         doPrior = False
@@ -3123,8 +2902,8 @@ def nest_parallel_lc(data, model, prev_res, bounds, guess_amplitude_bound=False,
         params = [[res.samples[best_ind, i]-res.errors[vparam_names[i]], res.samples[best_ind, i], res.samples[best_ind, i]+res.errors[vparam_names[i]]]
                   for i in range(len(vparam_names))]
     else:
-        params = [weighted_quantile(
-            res.samples[:, i], [.16, .5, .84], res.weights) for i in range(len(vparam_names))]
+        params = list(weighted_quantiles(
+            res.samples, [.16, .5, .84], res.weights))
 
     model.set(**{vparam_names[k]: params[k][1]
                  for k in range(len(vparam_names))})
@@ -3155,6 +2934,8 @@ def _micro_uncertainty(args):
 
 
 def fit_micro(fit, dat, zpsys, nsamples, micro_type='achromatic', kernel='RBF', bands='all'):
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import RBF
     t0 = fit.get('t0')
     fit.set(t0=t0)
     data = copy(dat)
@@ -3246,11 +3027,15 @@ def fit_micro(fit, dat, zpsys, nsamples, micro_type='achromatic', kernel='RBF',
 
 
 def param_fit(args, modName, fit=False):
-    sources = {'BazinSource': BazinSource}
+    sources = {'BazinSource': BazinSource, 'KarpenkaSource': KarpenkaSource,
+               'NewlingSource': NewlingSource}
 
-    source = sources[modName](
-        args['curve'].table, colorCurve=args['color_curve'])
-    mod = sncosmo.Model(source)
+    if modName == 'BazinSource':
+        source = sources[modName](
+            args['curve'].table, colorCurve=args['color_curve'])
+    else:
+        source = sources[modName](args['curve'].table)
+    mod = _model_for_source(source)
     if args['constants']:
         mod.set(**args['constants'])
     if not fit:
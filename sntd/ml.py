@@ -4,7 +4,10 @@ import math
 import subprocess
 import sncosmo
 import abc
+import inspect
 from textwrap import dedent
+from functools import wraps
+from collections import OrderedDict
 
 import numpy as np
 from astropy.io import fits
@@ -12,12 +15,6 @@ from astropy.io import fits
 from astropy import units as u
 from astropy import constants as const
 from astropy.cosmology import WMAP9 as cosmo
-import matplotlib.pyplot as plt
-from matplotlib import cm
-from matplotlib.patches import Circle
-import matplotlib.colors as colors
-from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
-import matplotlib.mlab as mlab
 from scipy.interpolate import interp1d, interp2d
 from sncosmo.models import _ModelBase
 import extinction
@@ -194,6 +191,7 @@ def createCircularMask(h, w, center=None, radius=None):
 
 
 def createGaussMask(h, w, center=None, radius=None):
+    import matplotlib.mlab as mlab
     if center is None:  # use the middle of the image
         center = [int(w/2), int(h/2)]
     if radius is None:  # use the smallest distance between the center and image walls
@@ -218,22 +216,37 @@ def createGaussMask(h, w, center=None, radius=None):
     # plt.show()
 
 
-class MidpointNormalize(colors.Normalize):
-    """
-    Normalise the colorbar so that diverging bars work there way either side from a prescribed midpoint value)
+def _midpoint_normalize():
+    # defined on first use so that importing sntd doesn't import matplotlib
+    if 'MidpointNormalize' in globals():
+        return globals()['MidpointNormalize']
+    import matplotlib.colors as colors
 
-    e.g. im=ax1.imshow(array, norm=MidpointNormalize(midpoint=0.,vmin=-100, vmax=100))
-    """
+    class MidpointNormalize(colors.Normalize):
+        """
+        Normalise the colorbar so that diverging bars work there way either side from a prescribed midpoint value)
+
+        e.g. im=ax1.imshow(array, norm=MidpointNormalize(midpoint=0.,vmin=-100, vmax=100))
+        """
+
+        def __init__(self, vmin=None, vmax=None, midpoint=None, clip=False):
+            self.midpoint = midpoint
+            colors.Normalize.__init__(self, vmin, vmax, clip)
 
-    def __init__(self, vmin=None, vmax=None, midpoint=None, clip=False):
-        self.midpoint = midpoint
-        colors.Normalize.__init__(self, vmin, vmax, clip)
+        def __call__(self, value, clip=None):
+            # I'm ignoring masked values and all kinds of edge cases to make a
+            # simple example...
+            x, y = [self.vmin, self.midpoint, self.vmax], [0, 0.5, 1]
+            return np.ma.masked_array(np.interp(value, x, y), np.isnan(value))
 
-    def __call__(self, value, clip=None):
-        # I'm ignoring masked values and all kinds of edge cases to make a
-        # simple example...
-        x, y = [self.vmin, self.midpoint, self.vmax], [0, 0.5, 1]
-        return np.ma.masked_array(np.interp(value, x, y), np.isnan(value))
+    globals()['MidpointNormalize'] = MidpointNormalize
+    return MidpointNormalize
+
+
+def __getattr__(name):
+    if name == 'MidpointNormalize':
+        return _midpoint_normalize()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 def mu_from_image(image, center, sizes, brightness, plot, time, ax, showCurve, rescale, width_in_einstein_radii):
@@ -242,6 +255,11 @@ def mu_from_image(image, center, sizes, brightness, plot, time, ax, showCurve, r
     if rescale:
         image = 10**(.4*(image-1024)/256.)
     if plot:
+        import matplotlib.pyplot as plt
+        from matplotlib import cm
+        from matplotlib.patches import Circle
+        from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
+        MidpointNormalize = _midpoint_normalize()
         if ax is None:
             fig = plt.figure(figsize=(10, 10))
 
@@ -267,10 +285,10 @@ def mu_from_image(image, center, sizes, brightness, plot, time, ax, showCurve, r
     for r in sizes:
         if r in [sizes[int(len(sizes)/5)], sizes[int(len(sizes)/2)], sizes[int(len(sizes)-1)]]:
 
-            circle = Circle(center, r, color='#004949', alpha=alphas[i])
-            i += 1
             if plot:
+                circle = Circle(center, r, color='#004949', alpha=alphas[i])
                 ax.add_patch(circle)
+            i += 1
         if brightness == 'disk':
             mask = createCircularMask(h, w, center=center, radius=r)
             try:
@@ -333,6 +351,39 @@ def mu_from_image(image, center, sizes, brightness, plot, time, ax, showCurve, r
     return(mu)
 
 
+def _either_propagate(propagate):
+    """
+    SNTD effects are written as propagate(phase, wave, flux). This lets them
+    also be called the way sncosmo.Model does, propagate(wave, flux, phase=phase).
+    """
+    @wraps(propagate)
+    def wrapper(self, *args, **kwargs):
+        if len(args) == 3:
+            return propagate(self, *args)
+        wave, flux = args
+        return propagate(self, kwargs.get('phase'), wave, flux)
+    wrapper._sncosmo_signature = True
+    return wrapper
+
+
+_grid_cache_size_ = 32
+
+
+def _cached_grid(effect, func, *grids):
+    """
+    Returns func(*grids), reusing the result if the effect has already been
+    evaluated on the same grid (e.g. the same epochs in every fit iteration).
+    """
+    grids = [np.asarray(grid, dtype=float) for grid in grids]
+    key = tuple((grid.shape, grid.tobytes()) for grid in grids)
+    cache = effect.__dict__.setdefault('_grid_cache', {})
+    if key not in cache:
+        if len(cache) >= _grid_cache_size_:
+            cache.clear()
+        cache[key] = func(*grids)
+    return cache[key]
+
+
 class AchromaticMicrolensing(sncosmo.PropagationEffect):
     """
     An achromatic microlensing object, defined filter to filter.
@@ -365,11 +416,12 @@ class AchromaticMicrolensing(sncosmo.PropagationEffect):
             data={'phase': time, 'magnification': dmag}, magformat=magformat)
         self.mu = mldata.magnification_interpolator()  # Now always a multiplicative mu
 
+    @_either_propagate
     def propagate(self, phase, wave, flux):
         """
         Propagate the magnification onto the model's flux output.
         """
-        mu = np.expand_dims(self.mu(phase), 1)
+        mu = _cached_grid(self, lambda p: np.expand_dims(self.mu(p), 1), phase)
         return flux * mu
 
 
@@ -442,16 +494,22 @@ class ChromaticFilterMicrolensing(sncosmo.PropagationEffect):
         self.mu = interp2d(self.phase, self.wave, np.array(
             all_mu).T, fill_value=1, bounds_error=True)
 
+    @_either_propagate
     def propagate(self, phase, wave, flux):
         """
         Propagate the magnification onto the model's flux output.
         """
 
-        return flux * self.mu(phase, wave).T
+        return flux * _cached_grid(self, lambda p, w: self.mu(p, w).T, phase, wave)
 
 
 def _mlFlux(self, time, wave):
-    """Replacement for sncosmo Array flux function."""
+    """
+    sncosmo Array flux function for effects that only take the SNTD
+    propagate(phase, wave, flux) signature. SNTD's own effects work with
+    the normal sncosmo.Model flux function, so this is only used by models
+    that _use_sntd_flux switches to _SNTDFluxModel.
+    """
     a = 1. / (1. + self._parameters[0])
     phase = (time - self._parameters[1]) * a
     minphase = (self.mintime() - self._parameters[1]) * a
@@ -460,8 +518,7 @@ def _mlFlux(self, time, wave):
     # Note that below we multiply by the scale factor to conserve
     # bolometric luminosity.
 
-    f = a * self._source._flux(np.round(phase, 1).astype(np.double),
-                               np.round(restwave, 1).astype(np.double))
+    f = a * self._source._flux(phase, restwave)
 
     # Pass the flux through the PropagationEffects.
     for effect, frame, zindex in zip(self._effects, self._effect_frames,
@@ -477,11 +534,57 @@ def _mlFlux(self, time, wave):
             effect_wave = wave * effect_a
             effect_phase = phase/a*(1.+self._parameters[zindex])
 
-        f = effect.propagate(effect_phase, effect_wave, f)
+        if _sntd_signature(effect):
+            f = effect.propagate(effect_phase, effect_wave, f)
+        else:
+            f = effect.propagate(effect_wave, f, phase=effect_phase)
 
     return f
 
 
+class _SNTDFluxModel(sncosmo.Model):
+    """An sncosmo Model using the _mlFlux flux function."""
+    _flux = _mlFlux
+
+    def __copy__(self):
+        new = _SNTDFluxModel(self._source, effects=self._effects,
+                             effect_names=self._effect_names, effect_frames=self._effect_frames)
+        new._parameters[:] = self._parameters
+        return new
+
+
+_signature_cache_ = {}
+
+
+def _sntd_signature(effect):
+    # True for effects written as propagate(phase, wave, flux) that can't
+    # also be called as propagate(wave, flux, phase=phase), cached by type
+    key = type(effect)
+    if key not in _signature_cache_:
+        propagate = getattr(effect, 'propagate', None)
+        if propagate is None or getattr(propagate, '_sncosmo_signature', False):
+            _signature_cache_[key] = False
+        else:
+            try:
+                names = list(inspect.signature(propagate).parameters.keys())
+            except (TypeError, ValueError):
+                names = []
+            _signature_cache_[key] = names[:3] == ['phase', 'wave', 'flux']
+    return _signature_cache_[key]
+
+
+def _use_sntd_flux(model):
+    """
+    Switches a model to _mlFlux if any of its effects only take the SNTD
+    propagate(phase, wave, flux) signature, and returns the model. Models
+    with their own flux function (e.g. unresolvedMISN) are left alone.
+    """
+    if type(model)._flux is sncosmo.Model._flux and \
+            np.any([_sntd_signature(effect) for effect in model._effects]):
+        model.__class__ = _SNTDFluxModel
+    return model
+
+
 def _mlProp(_ModelBase):
     """Abstract base class for propagation effects.
 
@@ -508,8 +611,36 @@ def _mlProp(_ModelBase):
         return dedent(summary)
 
 
+_extinction_cache_ = OrderedDict()
+_extinction_cache_size_ = 64
+
+
+def _unit_extinction(law, r_v, wave, func):
+    """
+    Extinction curve for A_V=1 (the laws are linear in A_V), cached by law,
+    R_V and wavelength grid with a small LRU.
+    """
+    wave = np.asarray(wave, dtype=float)
+    key = (law, float(r_v), wave.shape, wave.tobytes())
+    if key in _extinction_cache_:
+        _extinction_cache_.move_to_end(key)
+        return _extinction_cache_[key]
+    ext = np.reshape(func(np.ravel(wave), 1., r_v), wave.shape)
+    _extinction_cache_[key] = ext
+    if len(_extinction_cache_) > _extinction_cache_size_:
+        _extinction_cache_.popitem(last=False)
+    return ext
+
+
+def _apply_dust(law, ebv, r_v, wave, flux, func):
+    if ebv == 0:
+        return flux
+    return flux * 10.**(-0.4 * ebv * r_v * _unit_extinction(law, r_v, wave, func))
+
+
 class _CCM89Dust(sncosmo.PropagationEffect):
     """Cardelli, Clayton, Mathis (1989) extinction model dust."""
+    _phase_independent = True
     _param_names = ['ebv', 'r_v']
     param_names_latex = ['E(B-V)', 'R_V']
     _minwave = 1000.
@@ -518,14 +649,16 @@ class _CCM89Dust(sncosmo.PropagationEffect):
     def __init__(self):
         self._parameters = np.array([0., 3.1])
 
+    @_either_propagate
     def propagate(self, phase, wave, flux):
         """Propagate the flux."""
         ebv, r_v = self._parameters
-        return extinction.apply(extinction.ccm89(wave, ebv * r_v, r_v), flux)
+        return _apply_dust('ccm89', ebv, r_v, wave, flux, extinction.ccm89)
 
 
 class _OD94Dust(sncosmo.PropagationEffect):
     """O'Donnell (1994) extinction model dust."""
+    _phase_independent = True
     _param_names = ['ebv', 'r_v']
     param_names_latex = ['E(B-V)', 'R_V']
     _minwave = 909.09
@@ -534,15 +667,16 @@ class _OD94Dust(sncosmo.PropagationEffect):
     def __init__(self):
         self._parameters = np.array([0., 3.1])
 
+    @_either_propagate
     def propagate(self, phase, wave, flux):
         """Propagate the flux."""
         ebv, r_v = self._parameters
-        return extinction.apply(extinction.odonnell94(wave, ebv * r_v, r_v),
-                                flux)
+        return _apply_dust('odonnell94', ebv, r_v, wave, flux, extinction.odonnell94)
 
 
 class _F99Dust(sncosmo.PropagationEffect):
     """Fitzpatrick (1999) extinction model dust with fixed R_V."""
+    _phase_independent = True
     _minwave = 909.09
     _maxwave = 60000.
 
@@ -553,7 +687,9 @@ class _F99Dust(sncosmo.PropagationEffect):
         self._r_v = r_v
         self._f = extinction.Fitzpatrick99(r_v=r_v)
 
+    @_either_propagate
     def propagate(self, phase, wave, flux):
         """Propagate the flux."""
         ebv = self._parameters[0]
-        return extinction.apply(self._f(wave, ebv * self._r_v), flux)
+        return _apply_dust('fitzpatrick99', ebv, self._r_v, wave, flux,
+                           lambda w, a_v, r_v: self._f(w, a_v))
@@ -1,14 +1,16 @@
 import sncosmo
 import numpy as np
 from copy import copy
+from collections import OrderedDict
 from astropy.table import Table
 from scipy.interpolate import CubicSpline, interp1d
 from sncosmo.utils import integration_grid
 from sncosmo.constants import HC_ERG_AA, MODEL_BANDFLUX_SPACING
 from scipy.stats import exponnorm
-from collections import Counter
 
-__all__ = ['unresolvedMISN']
+from .ml import _use_sntd_flux, _sntd_signature
+
+__all__ = ['unresolvedMISN', 'ParametricModel']
 
 
 class unresolvedSource(sncosmo.Source):
@@ -29,6 +31,11 @@ class unresolvedSource(sncosmo.Source):
             pass
 
     def _flux(self, phase, wave):
+        if _shared_source(self.source_list):
+            # images only differ by amplitude, so evaluate the source once
+            amplitudes = np.array([source._parameters[0]
+                                   for source in self.source_list])
+            return(self.source_list[0]._flux(phase, wave)*np.sum(amplitudes)/amplitudes[0])
         return(np.sum([source._flux(phase, wave) for source in self.source_list], axis=0))
 
 
@@ -65,27 +72,82 @@ class unresolvedMISN(sncosmo.Model):
         self._parameters = np.append(self._parameters,[[0,1] for i in range(len(curve_models))]).flatten()
         self.model_list = curve_models
         self._source = unresolvedSource(self.model_list)
+        self.nparams = len(self.param_names)
+        self._build_parameter_store()
+        self.delays = None
+        self.magnifications = None
         if delays is not None:
             self.set_delays(delays)
         if magnifications is not None:
             self.set_magnifications(magnifications)
-        self.delays = delays
-        self.magnifications = magnifications
-        self.nparams = len(self.param_names)
-        self.current_parameters = np.array(list(self._parameters))
-        self.param_indices = {p: self.param_names.index(
-            p) for p in self.param_names}
-        
+
     def __copy__(self):
         new = unresolvedMISN(
             [copy(model) for model in self.model_list])
-        new._parameters = self._parameters.copy()
-        new.current_parameters = np.array(list(new._parameters))
-        new.set_delays(self.delays,base_t0=self.parameters[1])
-        new.set_magnifications(self.magnifications,base_x0=self.parameters[2])
+        new.update({p: self._parameters[self.param_indices[p]]
+                    for p in self.param_indices if p in new.param_indices})
+        new.delays = self.delays
+        new.magnifications = self.magnifications
+        new._sync_parameters()
         return new
 
-    def set_delays(self, delays, base_t0=0):
+    def _build_parameter_store(self):
+        """
+        Puts the parameters of every image model in one array (one row per
+        image) that the models, their sources and their effects all view,
+        and maps each parameter of this model onto the image parameters it sets.
+        """
+        nparams = [len(model._parameters) for model in self.model_list]
+        self._image_parameters = np.zeros((self.nimages, max(nparams)))
+        for i, model in enumerate(self.model_list):
+            row = self._image_parameters[i, :nparams[i]]
+            row[:] = model._parameters
+            _view_model_parameters(model, row)
+
+        self.param_indices = {p: self.param_names.index(
+            p) for p in self.param_names}
+        self._dt_inds = np.array([self.param_indices['dt_%i' % (i+1)]
+                                  for i in range(self.nimages)])
+        self._mu_inds = np.array([self.param_indices['mu_%i' % (i+1)]
+                                  for i in range(self.nimages)])
+        rows, cols, inds = [], [], []
+        for p, k in self.param_indices.items():
+            if k in [1, 2] or k in self._dt_inds or k in self._mu_inds:
+                continue
+            for i, model in enumerate(self.model_list):
+                if p in model.param_names:
+                    rows.append(i)
+                    cols.append(model.param_names.index(p))
+                    inds.append(k)
+        self._shared_rows = np.array(rows, dtype=int)
+        self._shared_cols = np.array(cols, dtype=int)
+        self._shared_inds = np.array(inds, dtype=int)
+
+        # nan so that everything is out of date
+        self.current_parameters = np.full(len(self._parameters), np.nan)
+        self._sync_parameters()
+
+    def _sync_parameters(self):
+        """
+        Updates the image parameters that depend on parameters that have
+        changed since the last update.
+        """
+        dirty = self._parameters != self.current_parameters
+        if not np.any(dirty):
+            return
+        update = dirty[self._shared_inds]
+        if np.any(update):
+            self._image_parameters[self._shared_rows[update], self._shared_cols[update]] = \
+                self._parameters[self._shared_inds[update]]
+        if dirty[1] or np.any(dirty[self._dt_inds]):
+            self._image_parameters[:, 1] = self._parameters[1] + \
+                self._parameters[self._dt_inds]
+        if dirty[2] or np.any(dirty[self._mu_inds]):
+            self._image_parameters[:, 2] = self._parameters[2] * \
+                self._parameters[self._mu_inds]
+        self.current_parameters[:] = self._parameters
+
+    def set_delays(self, delays, base_t0=None):
         """
         Set the relative delays between blended image models. 
 
@@ -93,17 +155,19 @@ class unresolvedMISN(sncosmo.Model):
         ----------
         delays: list of float
             A list of relative delays between models
+        base_t0: float
+            If given, also sets t0 (the delays are relative to t0)
         """
         if len(delays) != len(self.model_list):
             print('Cannot set delays, must match length of model list.')
-        for i in range(len(delays)):
-            self.model_list[i].parameters[1] = delays[i] + base_t0
-            self.parameters[self.param_indices['dt_%i'%(i+1)]] = delays[i]
-            self.current_parameters[self.param_indices['dt_%i'%(i+1)]] = delays[i]
+            return
+        if base_t0 is not None:
+            self._parameters[1] = base_t0
+        self._parameters[self._dt_inds] = delays
+        self._sync_parameters()
         self.delays = delays
 
-
-    def set_magnifications(self, magnifications,base_x0=1):
+    def set_magnifications(self, magnifications, base_x0=None):
         """
         Set the relative magnifications between blended image models. 
 
@@ -111,53 +175,29 @@ class unresolvedMISN(sncosmo.Model):
         ----------
         magnifications: list of float
             A list of relative magnifications between models
+        base_x0: float
+            If given, also sets the amplitude (the magnifications are relative
+            to the amplitude)
         """
         if len(magnifications) != len(self.model_list):
             print('Cannot set magnifications, must match length of model list.')
-        for i in range(len(magnifications)):
-            self.model_list[i].parameters[2] = magnifications[i] * base_x0
-            self.parameters[self.param_indices['mu_%i'%(i+1)]] = magnifications[i]
-            self.current_parameters[self.param_indices['mu_%i'%(i+1)]] = magnifications[i]
+            return
+        if base_x0 is not None:
+            self._parameters[2] = base_x0
+        self._parameters[self._mu_inds] = magnifications
+        self._sync_parameters()
         self.magnifications = magnifications
 
     def _flux(self, phase, wave):
-        param_dict = {self.param_names[i]: self.parameters[i]
-                    for i in range(self.nparams) if self.parameters[i] != self.current_parameters[i]}
-        if len(param_dict) > 0:
-            self.set(**param_dict)
+        self._sync_parameters()
+        if _shared_source([model._source for model in self.model_list]) and \
+                len(set([model._parameters[0] for model in self.model_list])) == 1:
+            return(_unresolved_flux(self.model_list, phase, wave))
         return(np.sum([model._flux(phase, wave) for model in self.model_list], axis=0))
 
     def set(self, **param_dict):
-        do_delays = False
-        do_mags = False
-        for key in param_dict.keys():
-            if key == 't0':
-                for model in self.model_list:
-                    model.parameters[1] += (param_dict[key] -
-                                            self.current_parameters[self.param_indices[key]])
-            elif key == self.param_names[2]:
-                for model in self.model_list:
-                    model.parameters[2] *= (param_dict[key] /
-                                            self.current_parameters[self.param_indices[key]])
-            elif 'dt_' in key:
-                do_delays = True
-                pass
-            elif 'mu_' in key:
-                do_mags = True
-                pass
-            else:
-                for model in self.model_list:
-                    if key in model.param_names:
-                        model.update({key: param_dict[key]})
-            self.current_parameters[self.param_indices[key]] = param_dict[key]
-        if do_delays:
-            self.set_delays([param_dict['dt_%i'%(i+1)] if 'dt_%i'%(i+1) in param_dict.keys() else 0 for i in range(self.nimages)],
-                        base_t0=self.current_parameters[1])
-        if do_mags:
-            self.set_magnifications([param_dict['mu_%i'%(i+1)] if 'mu_%i'%(i+1) in param_dict.keys() else 0 for i in range(self.nimages)],
-                                base_x0=self.current_parameters[2])
-        
         self.update(param_dict)
+        self._sync_parameters()
 
     def add_effect(self, effect, name, frame):
         """
@@ -174,11 +214,11 @@ class unresolvedMISN(sncosmo.Model):
         self._add_effect_partial(effect, name, frame)
         self._sync_parameter_arrays_effects()
         self._update_description()
-        self.current_parameters = np.array(list(self._parameters))
-        self.param_indices = {p: self.param_names.index(
-            p) for p in self.param_names}
+        self.nparams = len(self.param_names)
         for model in self.model_list:
             model.add_effect(effect, name, frame)
+            _use_sntd_flux(model)
+        self._build_parameter_store()
 
     def _sync_parameter_arrays_effects(self):
         # save a reference to old parameter values, in case there are
@@ -191,7 +231,7 @@ class unresolvedMISN(sncosmo.Model):
 
         # allocate new array (zeros so that new 'free' effects redshifts
         # initialize to 0)
-        self._parameters = np.zeros(l, dtype=np.float)
+        self._parameters = np.zeros(l, dtype=float)
 
         # copy old parameters: we do this to make sure we copy
         # non-default values of any parameters that the model alone
@@ -229,6 +269,120 @@ class unresolvedMISN(sncosmo.Model):
         
 
 
+def _view_model_parameters(model, parameters):
+    # point a model (and its source and effects) at a new parameter array,
+    # using the same layout as sncosmo.Model
+    model._parameters = parameters
+    pos = 2
+    l = len(model._source._parameters)
+    model._source._parameters = parameters[pos:pos+l]
+    pos += l
+    for effect, frame in zip(model._effects, model._effect_frames):
+        if frame == 'free':
+            pos += 1
+        l = len(effect._parameters)
+        effect._parameters = parameters[pos:pos+l]
+        pos += l
+
+
+def _same_attributes(obj, other):
+    # True if obj and other are the same type and share every attribute but
+    # their parameters, as copies of one source or effect do
+    if type(obj) is not type(other) or obj.__dict__.keys() != other.__dict__.keys():
+        return False
+    return not np.any([obj.__dict__[k] is not other.__dict__[k] for k in other.__dict__.keys()
+                       if k != '_parameters'])
+
+
+def _shared_source(sources):
+    # True if the sources are copies of one source differing only by
+    # amplitude (the first parameter), which the flux is proportional to.
+    # The parameterized sources below aren't linear in amplitude.
+    first = sources[0]
+    if hasattr(first, '_param_flux') or first._parameters[0] == 0:
+        return False
+    for source in sources[1:]:
+        if not _same_attributes(source, first):
+            return False
+        if not np.array_equal(source._parameters[1:], first._parameters[1:]):
+            return False
+    return True
+
+
+def _shared_effects(models):
+    # indices of the effects that are identical for every model and don't
+    # depend on phase, so they can be applied once to the summed flux
+    first = models[0]
+    if np.any([model._effect_frames != first._effect_frames for model in models[1:]]):
+        return []
+    shared = []
+    for i, (effect, frame, zindex) in enumerate(zip(first._effects, first._effect_frames,
+                                                    first._effect_zindicies)):
+        if not getattr(effect, '_phase_independent', False):
+            continue
+        same = True
+        for model in models[1:]:
+            other = model._effects[i]
+            if not _same_attributes(other, effect) or not np.array_equal(other._parameters, effect._parameters) or \
+                    (frame == 'free' and model._parameters[zindex] != first._parameters[zindex]):
+                same = False
+                break
+        if same:
+            shared.append(i)
+    return shared
+
+
+def _propagate_effects(model, effect_inds, flux, time, wave):
+    # the effect loop of the model flux function, for a subset of effects
+    a = 1. / (1. + model._parameters[0])
+    obsphase = time - model._parameters[1]
+    for i in effect_inds:
+        frame, zindex = model._effect_frames[i], model._effect_zindicies[i]
+        if frame == 'obs':
+            effect_wave = wave
+            effect_phase = obsphase
+        elif frame == 'rest':
+            effect_wave = wave * a
+            effect_phase = obsphase * a
+        else:  # frame == 'free'
+            effect_a = 1. / (1. + model._parameters[zindex])
+            effect_wave = wave * effect_a
+            effect_phase = obsphase * effect_a
+        if _sntd_signature(model._effects[i]):
+            flux = model._effects[i].propagate(effect_phase, effect_wave, flux)
+        else:
+            flux = model._effects[i].propagate(
+                effect_wave, flux, phase=effect_phase)
+    return flux
+
+
+def _unresolved_flux(model_list, time, wave):
+    """
+    Summed flux of image models that share a source and redshift, evaluating
+    the source once on the union of every image's phases.
+    """
+    ref = model_list[0]
+    a = 1. / (1. + ref._parameters[0])
+    time = np.atleast_1d(time)
+    wave = np.atleast_1d(wave)
+    phases, inverse = np.unique(np.concatenate([(time - model._parameters[1]) * a
+                                                for model in model_list]), return_inverse=True)
+    flux = a * ref._source._flux(phases, wave * a)
+    shared = _shared_effects(model_list)
+
+    total = np.zeros((len(time), len(wave)))
+    for i, model in enumerate(model_list):
+        f = flux[inverse[i*len(time):(i+1)*len(time)]] * \
+            (model._source._parameters[0]/ref._source._parameters[0])
+        total += _propagate_effects(model, [j for j in range(len(model._effects))
+                                            if j not in shared], f, time, wave)
+    return _propagate_effects(ref, shared, total, time, wave)
+
+
+_param_source_cache_ = OrderedDict()
+_param_source_cache_size_ = 32
+
+
 def _param_to_source(source, wave, color_curve=None, band1=None, band2=None, ref_color=False):
     band = None
     for b in np.unique(source.lc['band']):
@@ -239,6 +393,16 @@ def _param_to_source(source, wave, color_curve=None, band1=None, band2=None, ref
         raise RuntimeError(
             "Hmm, your data do not contain the band you want to fit.")
     finalPhase = source._phase
+    zp = source.lc['zp'][np.array([x.lower()
+                                   for x in source.lc['band']]) == band.name][0]
+    # without a color curve the source only depends on the band and phase grid,
+    # so it can be shared between every source built on the same data
+    cache_key = (band.name, float(zp), source.lc['zpsys'][0], finalPhase[0], finalPhase[-1],
+                 len(finalPhase))
+    if (color_curve is None or ref_color) and cache_key in _param_source_cache_:
+        _param_source_cache_.move_to_end(cache_key)
+        return _param_source_cache_[cache_key]
+
     if color_curve is not None and not ref_color:
         zp1 = source.lc['zp'][source.lc['band'] == band1][0]
         zp2 = source.lc['zp'][source.lc['band'] == band2][0]
@@ -250,8 +414,7 @@ def _param_to_source(source, wave, color_curve=None, band1=None, band2=None, ref
     else:
         temp_flux = np.ones(len(finalPhase))
 
-    zpnorm = 10.**(0.4 * source.lc['zp'][np.array([x.lower()
-                                                   for x in source.lc['band']]) == band.name][0])
+    zpnorm = 10.**(0.4 * zp)
 
     wave, dwave = integration_grid(band.minwave(), band.maxwave(),
                                    MODEL_BANDFLUX_SPACING)
@@ -260,21 +423,32 @@ def _param_to_source(source, wave, color_curve=None, band1=None, band2=None, ref
     zpnorm = zpnorm / ms.zpbandflux(band)
     flux = temp_flux*HC_ERG_AA/(dwave*np.sum(wave*band(wave))*zpnorm)
     finalWave = np.arange(wave[0]-dwave*10, wave[-1]+dwave*10, dwave)
-    finalFlux = np.zeros((len(finalPhase), len(finalWave)))
-
-    for i in range(len(finalPhase)):
-        # if finalPhase[i]>= np.min(timeArr) and finalPhase[i] <= np.max(timeArr):
-        for j in range(len(finalWave)):
-            if finalWave[j] >= wave[0] and finalWave[j] <= wave[-1]:
-                finalFlux[i][j] = flux[i]
-
-    # offset=np.zeros(len(finalPhase))
+    in_band = (finalWave >= wave[0]) & (finalWave <= wave[-1])
+    finalFlux = flux[:, None]*in_band[None, :]
 
     out = sncosmo.TimeSeriesSource(np.array(finalPhase), np.array(
         finalWave), np.array(finalFlux), zero_before=False)
+    if color_curve is None or ref_color:
+        _param_source_cache_[cache_key] = out
+        if len(_param_source_cache_) > _param_source_cache_size_:
+            _param_source_cache_.popitem(last=False)
     return (out)
 
 
+def _band_ranges(lc):
+    return [(b, sncosmo.get_bandpass(b).wave[0], sncosmo.get_bandpass(b).wave[-1])
+            for b in np.unique(lc['band'])]
+
+
+def _band_for_wave(source, wave):
+    # the band whose bandpass covers this wave grid, cached by grid edges
+    key = (wave[0], wave[-1])
+    if key not in source._band_cache:
+        source._band_cache[key] = [b for b, minwave, maxwave in source._band_ranges
+                                   if minwave <= wave[0] and maxwave >= wave[-1]][0]
+    return source._band_cache[key]
+
+
 class PierelSource(sncosmo.Source):
     _param_names = ['amplitude', 'k', 'sigma', 's']
     param_names_latex = ['A', 'K', '\sigma', 'Shift']
@@ -292,12 +466,14 @@ class PierelSource(sncosmo.Source):
         wave = np.append([.99*wave[0]], wave)
         wave = np.append(wave, [1.01*wave[-1]])
         self._wave = wave
+        self._band_ranges, self._band_cache = _band_ranges(self.lc), {}
+        self._analytic, self._unit_bandflux = True, {}
         # self._phase=np.arange(0,np.max(data['time'])-np.min(data['time']),1)
         # self._phase=np.arange(-(np.max(data['time'])-np.min(data['time'])),np.max(data['time'])-np.min(data['time']),tstep)
         self._phase = np.arange(-800, 800, 1)
         self._parameters = np.array([1., 1., 1., 0.])
         self._tstep = tstep
-        self._ts_sources = {b: _param_to_source(self, self._phase, sncosmo.get_bandpass(
+        self._ts_sources = {b: _param_to_source(self, sncosmo.get_bandpass(
             b).wave) for b in np.unique(self.lc['band'])}
 
     def _param_flux(self, phase):
@@ -316,10 +492,7 @@ class PierelSource(sncosmo.Source):
 
     def _flux(self, phase, wave):
 
-        band = [x for x in np.unique(self.lc['band']) if sncosmo.get_bandpass(
-            x).wave[0] <= wave[0] and sncosmo.get_bandpass(x).wave[-1] >= wave[-1]][0]
-
-        src = self._ts_sources[band]
+        src = self._ts_sources[_band_for_wave(self, wave)]
 
         return(src._flux(phase, wave)*(self._param_flux(phase)[:, None]))
 
@@ -342,6 +515,8 @@ class BazinSource(sncosmo.Source):
         wave = np.append([.99*wave[0]], wave)
         wave = np.append(wave, [1.01*wave[-1]])
         self._wave = wave
+        self._band_ranges, self._band_cache = _band_ranges(self.lc), {}
+        self._analytic, self._unit_bandflux = colorCurve is None, {}
         # self._phase=np.arange(-(np.max(data['time'])-np.min(data['time'])),np.max(data['time'])-np.min(data['time']),tstep)
         self._phase = np.arange(-300, 300, 1)
         self._parameters = np.array([1., 0., 30., 15.])
@@ -371,11 +546,14 @@ class BazinSource(sncosmo.Source):
         else:
             temp = (
                 np.exp(-phase/self._parameters[2])/(1+np.exp(-phase/self._parameters[3])))
-        if np.max(temp) == 0:
+        max_temp = np.max(temp)
+        if max_temp == 0:
             return(np.zeros(len(phase)))
+        peak = phase[temp == max_temp]
+        shifted = phase+(peak[0] if len(peak) == 1 else np.median(peak))
 
-        bazinFlux = self._parameters[0]*(np.exp(-(phase+np.median(phase[np.where(temp == np.max(temp))[0]]))/self._parameters[2]) /
-                                         (1+np.exp(-(phase+np.median(phase[np.where(temp == np.max(temp))[0]]))/self._parameters[3])))/np.max(temp) + self._parameters[1]
+        bazinFlux = self._parameters[0]*(np.exp(-shifted/self._parameters[2]) /
+                                         (1+np.exp(-shifted/self._parameters[3])))/max_temp + self._parameters[1]
 
         if np.inf in bazinFlux or np.any(np.isnan(bazinFlux)):
             return(np.zeros(len(phase)))
@@ -383,10 +561,7 @@ class BazinSource(sncosmo.Source):
 
     def _flux(self, phase, wave):
 
-        band = [x for x in np.unique(self.lc['band']) if sncosmo.get_bandpass(
-            x).wave[0] <= wave[0] and sncosmo.get_bandpass(x).wave[-1] >= wave[-1]][0]
-
-        src = self._ts_sources[band]
+        src = self._ts_sources[_band_for_wave(self, wave)]
 
         return(src._flux(phase, wave)*(self._param_flux(phase)[:, None]))
 
@@ -412,6 +587,10 @@ class NewlingSource(sncosmo.Source):
 
         self._parameters = np.array([1., 0., 1., 1., -1.])
         self._tstep = tstep
+        self._band_ranges, self._band_cache = _band_ranges(self.lc), {}
+        self._analytic, self._unit_bandflux = True, {}
+        self._ts_sources = {b: _param_to_source(
+            self, sncosmo.get_bandpass(b).wave) for b in np.unique(self.lc['band'])}
 
     def _param_flux(self, phase):
         # self._parameters[4]=np.min([np.min(phase),self._parameters[4]])
@@ -444,8 +623,9 @@ class NewlingSource(sncosmo.Source):
     def _flux(self, phase, wave):
         # if self._parameters[2]<=self._parameters[3]:
         #    return np.ones((len(phase),len(wave)))*(-9999)
-        mod = _param_to_source(self, phase, wave)
-        return(mod._flux(phase, wave))
+        src = self._ts_sources[_band_for_wave(self, wave)]
+
+        return(src._flux(phase, wave)*(self._param_flux(phase)[:, None]))
 
 
 class KarpenkaSource(sncosmo.Source):
@@ -469,6 +649,10 @@ class KarpenkaSource(sncosmo.Source):
 
         self._parameters = np.array([1., 0., 0., 1., 1., ])
         self._tstep = tstep
+        self._band_ranges, self._band_cache = _band_ranges(self.lc), {}
+        self._analytic, self._unit_bandflux = True, {}
+        self._ts_sources = {b: _param_to_source(
+            self, sncosmo.get_bandpass(b).wave) for b in np.unique(self.lc['band'])}
 
     def _param_flux(self, phase):
         karpenkaFlux = (self._parameters[0]*(1+self._parameters[1]*((phase+self._parameters[2])**2)))*(
@@ -480,32 +664,100 @@ class KarpenkaSource(sncosmo.Source):
     def _flux(self, phase, wave):
         # if self._parameters[2]<=self._parameters[3]:
         #    return np.ones((len(phase),len(wave)))*(-9999)
-        mod = _param_to_source(self, phase, wave)
-        return(mod._flux(phase, wave))
+        src = self._ts_sources[_band_for_wave(self, wave)]
 
+        return(src._flux(phase, wave)*(self._param_flux(phase)[:, None]))
 
-def _removeDupes(data):
-    tempTable = Table(names=data.colnames, dtype=[
-                      data.dtype[x] for x in data.colnames])
-
-    for b in np.unique(data['band']):
-        dupes = [item for item, count in Counter(
-            data['time'][data['band'] == b]).items() if count > 1]
-        duped = []
-        temp = data[data['band'] == b]
-
-        for row in temp:
-            if row['time'] not in dupes:
-                tempTable.add_row(row)
-            else:
-                if row['time'] in duped:
-                    continue
 
-                row['flux'] = np.average(temp['flux'][temp['time'] == row['time']],
-                                         weights=1./(temp['fluxerr'][temp['time'] == row['time']])**2)
-                row['fluxerr'] = np.sqrt(
-                    1./np.sum(1./(temp['fluxerr'][temp['time'] == row['time']])**2))
-                duped.append(row['time'])
-                tempTable.add_row(row)
+class ParametricModel(sncosmo.Model):
+    """
+    An sncosmo Model for the parameterized light curve sources (BazinSource,
+    KarpenkaSource, NewlingSource, PierelSource), whose flux is already an
+    analytic function of phase in each band. With no redshift and no effects,
+    bandflux evaluates that function directly instead of integrating the
+    source SED through each bandpass (the result is the same).
+    """
+
+    def __copy__(self):
+        new = ParametricModel(self._source, effects=self._effects,
+                              effect_names=self._effect_names, effect_frames=self._effect_frames)
+        new._parameters[:] = self._parameters
+        return new
+
+    def bandflux(self, band, time, zp=None, zpsys=None):
+        if self._parameters[0] != 0 or len(self._effects) > 0 or \
+                not getattr(self._source, '_analytic', False):
+            return super(ParametricModel, self).bandflux(band, time, zp=zp, zpsys=zpsys)
+
+        if zp is not None and zpsys is None:
+            raise ValueError('zpsys must be given if zp is not None')
+        if zp is None:
+            time, band = np.broadcast_arrays(time, band)
+        else:
+            time, band, zp, zpsys = np.broadcast_arrays(time, band, zp, zpsys)
+        ndim = time.ndim
+        time = np.atleast_1d(time)
+        band = np.atleast_1d(band)
+
+        bandflux = np.zeros(time.shape, dtype=float)
+        # same grouping by band as sncosmo, since _param_flux depends on the
+        # phases it is given
+        for b in set(band):
+            mask = band == b
+            bandflux[mask] = self._source._param_flux(time[mask]-self._parameters[1]) *\
+                _unit_bandflux(self._source, b)
+            if zp is not None:
+                zpnorm = 10.**(0.4 * np.atleast_1d(zp)[mask])
+                bandzpsys = np.atleast_1d(zpsys)[mask]
+                for ms in set(bandzpsys):
+                    zpnorm[bandzpsys == ms] /= sncosmo.get_magsystem(ms).zpbandflux(b)
+                bandflux[mask] *= zpnorm
+
+        if ndim == 0:
+            return bandflux[0]
+        return bandflux
+
+
+def _unit_bandflux(source, band):
+    # bandflux of a parameterized source's band template, which is constant in phase
+    if band not in source._unit_bandflux:
+        bandpass = sncosmo.get_bandpass(band)
+        if bandpass.minwave() < source.minwave() or bandpass.maxwave() > source.maxwave():
+            raise ValueError('bandpass {0!r:s} [{1:.6g}, .., {2:.6g}] '
+                             'outside spectral range [{3:.6g}, .., {4:.6g}]'
+                             .format(bandpass.name, bandpass.minwave(), bandpass.maxwave(),
+                                     source.minwave(), source.maxwave()))
+        wave, _ = integration_grid(bandpass.minwave(), bandpass.maxwave(),
+                                   MODEL_BANDFLUX_SPACING)
+        source._unit_bandflux[band] = source._ts_sources[_band_for_wave(
+            source, wave)].bandflux(bandpass, 0.)
+    return source._unit_bandflux[band]
+
+
+def _model_for_source(source, effects=None, effect_names=None, effect_frames=None):
+    model_class = ParametricModel if getattr(
+        source, '_analytic', False) else sncosmo.Model
+    return _use_sntd_flux(model_class(source=source, effects=effects, effect_names=effect_names,
+                                      effect_frames=effect_frames))
+
+
+def _removeDupes(data):
+    # one group per (band, time), ordered by band and then first appearance
+    _, band_inds = np.unique(data['band'], return_inverse=True)
+    _, time_inds = np.unique(data['time'], return_inverse=True)
+    _, first, inverse, counts = np.unique(band_inds*(np.max(time_inds)+1)+time_inds,
+                                          return_index=True, return_inverse=True, return_counts=True)
+    order = np.lexsort((first, band_inds[first]))
+
+    weights = 1./np.asarray(data['fluxerr'], dtype=float)**2
+    weight_sum = np.bincount(inverse, weights=weights)
+    flux = np.bincount(inverse, weights=weights *
+                       np.asarray(data['flux'], dtype=float))/weight_sum
+    fluxerr = np.sqrt(1./weight_sum)
+
+    tempTable = data[first[order]]
+    duped = counts[order] > 1
+    tempTable['flux'][duped] = flux[order][duped]
+    tempTable['fluxerr'][duped] = fluxerr[order][duped]
 
     return (tempTable)
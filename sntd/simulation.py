@@ -12,6 +12,7 @@ from sncosmo.utils import alias_map
 from .util import _filedir_
 from .curve_io import image_lc, MISN
 from .ml import *
+from .ml import _use_sntd_flux
 
 __all__ = ['createMultiplyImagedSN']
 
@@ -223,8 +224,8 @@ def createMultiplyImagedSN(
     # as currently constructed, dust has the same effect on all images.
     # Microlensing effects are added separately for each SN image below.
 
-    model = sncosmo.Model(source=sourcename, effects=dust_effect_list,
-                          effect_names=dust_names, effect_frames=dust_frames)
+    model = _use_sntd_flux(sncosmo.Model(source=sourcename, effects=dust_effect_list,
+                                         effect_names=dust_names, effect_frames=dust_frames))
     model.set(z=redshift)
     # set absolute magnitude in b or r band based on literature
     if snType in ['IIP', 'IIL', 'IIn']:
@@ -282,7 +283,6 @@ def createMultiplyImagedSN(
         # can be reflected in the model_i parameters and propagate correctly
         # into realize_lcs for flux uncertainties
         model_i = deepcopy(model)
-        model_i._flux = _mlFlux
         params_i = deepcopy(params)
         if snType == 'Ia':
             params_i['x0'] *= mu
@@ -315,6 +315,7 @@ def createMultiplyImagedSN(
                     time+model_i._source._phase[0], dmag, magformat='multiply')
 
             model_i.add_effect(ml_effect, 'microlensing', 'rest')
+            _use_sntd_flux(model_i)
         else:
             ml_effect = None
 
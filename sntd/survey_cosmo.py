@@ -2,54 +2,68 @@ from matplotlib import pyplot as plt
 import numpy as np
 import scipy
 import math
-from scipy.integrate import quad
 from matplotlib import ticker, rcParams
 from matplotlib.lines import Line2D
-from scipy.misc import derivative as deriv
 import pandas
 
 from copy import deepcopy, copy
 import sncosmo
 import nestle
 import corner
+import pyParz
+import itertools
+from concurrent.futures import Future, ProcessPoolExecutor
 
 
 from .coetools import *
 from .util import *
 
-__all__ = ['Survey', 'Fisher']
+__all__ = ['Survey', 'Fisher', 'survey_sweep']
 
 
-def EA1(z1, z2, cosmo):
-    """The integral of the inverse of the normalized 
-    Hubble parameter, from z1 to z2:  int_z1^z2{1/E(z')dz}
-    Eq 8 of Coe & Moustakas 2009 (for non-flat)"""
+# Gauss-Legendre nodes/weights on [-1,1], 1/E(z) is smooth so this is
+# accurate to ~1e-12 for any realistic redshift range
+_gl_nodes_, _gl_weights_ = np.polynomial.legendre.leggauss(64)
 
+
+def _Ezinv(z, cosmo):
+    """The inverse of the normalized Hubble parameter, 1/E(z). The cosmology
+    values can be arrays, and must broadcast against z."""
     if 'w' in cosmo.keys():
-        def Ez2(z): return (cosmo['Om0']*(1+z)**3 + cosmo['Ok']*(1+z)**2 +
-                            cosmo['Ode0']*(1+z)**(3*(1+cosmo['w'])))
+        Ez2 = (cosmo['Om0']*(1+z)**3 + cosmo['Ok']*(1+z)**2 +
+               cosmo['Ode0']*(1+z)**(3*(1+cosmo['w'])))
     else:
-        def Ez2(z): return (cosmo['Om0']*(1+z)**3 + cosmo['Ok']*(1+z)**2 +
-                            cosmo['Ode0']*(1+z)**(3*(1+cosmo['w0']+cosmo['wa'])) *
-                            np.exp(-3*cosmo['wa']*z/(1+z)))
-
-    def Ezinv(z): return 1 / np.sqrt(Ez2(z))
-    allz = np.append(z1, z2)
-    sort = np.argsort(allz)
-    n1 = len(z1)
-    result = np.zeros(n1*2)
-
-    last = 0
-    for i in range(len(sort)):
-        if i > 0:
-            temp, _ = quad(Ezinv, allz[sort[i-1]], allz[sort[i]])
-        else:
-            temp, _ = quad(Ezinv, 0, allz[sort[i]])
+        Ez2 = (cosmo['Om0']*(1+z)**3 + cosmo['Ok']*(1+z)**2 +
+               cosmo['Ode0']*(1+z)**(3*(1+cosmo['w0']+cosmo['wa'])) *
+               np.exp(-3*cosmo['wa']*z/(1+z)))
+    return 1 / np.sqrt(Ez2)
 
-        result[sort[i]] = last+temp
-        last += temp
 
-    return(result[:n1], result[n1:])
+def _integrate_Ezinv(z1, z2, cosmo):
+    """
+    int_z1^z2{1/E(z')dz} for every pair of redshifts, with a fixed order
+    Gauss-Legendre rule. If the values of cosmo are arrays (e.g. a grid of
+    cosmologies), the result has their (broadcast) shape plus a last axis for
+    the redshift pairs.
+    """
+    z1 = np.asarray(z1, dtype=float)
+    z2 = np.asarray(z2, dtype=float)
+    half = (z2-z1)/2.
+    z = ((z2+z1)/2.)[:, None] + half[:, None]*_gl_nodes_
+    cosmo = {k: np.asarray(v)[..., None, None] for k, v in cosmo.items()}
+    return half*np.sum(_Ezinv(z, cosmo)*_gl_weights_, axis=-1)
+
+
+def EA1(z1, z2, cosmo):
+    """The integral of the inverse of the normalized 
+    Hubble parameter, from 0 to z1 and 0 to z2:  int_0^z{1/E(z')dz}
+    Eq 8 of Coe & Moustakas 2009 (for non-flat)"""
+
+    z1 = np.atleast_1d(np.asarray(z1, dtype=float))
+    z2 = np.atleast_1d(np.asarray(z2, dtype=float))
+    result = _integrate_Ezinv(np.zeros(len(z1)+len(z2)),
+                              np.append(z1, z2), cosmo)
+    return(result[..., :len(z1)], result[..., len(z1):])
 
 
 def EA2(z1, z2, cosmo):
@@ -57,45 +71,33 @@ def EA2(z1, z2, cosmo):
     Hubble parameter, from z1 to z2:  int_z1^z2{1/E(z')dz}
     Eq 8 of Coe & Moustakas 2009. Assumes flat universe. """
 
-    if 'w' in cosmo.keys():
-        def Ez2(z): return (cosmo['Om0']*(1+z)**3 + cosmo['Ok']*(1+z)**2 +
-                            cosmo['Ode0']*(1+z)**(3*(1+cosmo['w'])))
-    else:
-        def Ez2(z): return (cosmo['Om0']*(1+z)**3 + cosmo['Ok']*(1+z)**2 +
-                            cosmo['Ode0']*(1+z)**(3*(1+cosmo['w0']+cosmo['wa'])) *
-                            np.exp(-3*cosmo['wa']*z/(1+z)))
+    return(_integrate_Ezinv(np.atleast_1d(z1), np.atleast_1d(z2), cosmo))
+
 
-    def Ezinv(z): return 1 / np.sqrt(Ez2(z))
-    # if Ez2(z1)>0 and Ez2(z2)>0:
-    return(np.array([quad(Ezinv, z1[i], z2[i])[0] for i in range(len(z1))]))
+def _curvature_distance(D, Ok):
+    # sin/sinh transform of a comoving distance integral for non-flat
+    # universes, written so that Ok can be an array (or complex)
+    closed = np.real(Ok) < -.0001
+    opened = np.real(Ok) > .0001
+    sk = np.sqrt(np.where(closed, -Ok, np.where(opened, Ok, 1.)))
+    return np.where(closed, np.sin(sk*D)/sk, np.where(opened, np.sinh(sk*D)/sk, D))
 
 
 def Eratio(zl, zs, cosmo):
     """The time delay expansion function ratio 
-    (script E, eq 12 in Coe & Moustakas 2009)."""
+    (script E, eq 12 in Coe & Moustakas 2009).
+    The cosmology values can be arrays, in which case the ratio has their
+    shape plus a last axis for the lens/source pairs."""
 
     EL, ES = EA1(zl, zs, cosmo)
-    if cosmo['Ok'] < -.0001:
-        ELS = EA2(zl, zs, cosmo)
-        EL = np.sin(np.sqrt(np.abs(cosmo['Ok']))
-                    * EL)/np.sqrt(np.abs(cosmo['Ok']))
-        ES = np.sin(np.sqrt(np.abs(cosmo['Ok']))
-                    * ES)/np.sqrt(np.abs(cosmo['Ok']))
-        ELS = np.sin(np.sqrt(np.abs(cosmo['Ok']))
-                     * ELS)/np.sqrt(np.abs(cosmo['Ok']))
-    elif cosmo['Ok'] > .0001:
-        ELS = EA2(zl, zs, cosmo)
-        EL = np.sinh(np.sqrt(np.abs(cosmo['Ok']))
-                     * EL)/np.sqrt(np.abs(cosmo['Ok']))
-        ES = np.sinh(np.sqrt(np.abs(cosmo['Ok']))
-                     * ES)/np.sqrt(np.abs(cosmo['Ok']))
-        ELS = np.sinh(np.sqrt(np.abs(cosmo['Ok']))
-                      * ELS)/np.sqrt(np.abs(cosmo['Ok']))
-    else:  # np.abs(cosmo['Ok'])<.001:
-        ELS = ES-EL
+    ELS = ES-EL
+    Ok = np.asarray(cosmo['Ok'])[..., None]
+    EL = _curvature_distance(EL, Ok)
+    ES = _curvature_distance(ES, Ok)
+    ELS = _curvature_distance(ELS, Ok)
 
     Erat = EL * ES / ELS
-    return(Erat/(cosmo['h']*100))
+    return(Erat/(np.asarray(cosmo['h'])[..., None]*100))
 
 
 def Evariance(Erat, dTc):
@@ -108,31 +110,12 @@ def Evariance(Erat, dTc):
     return(Erat**2 * (dTc/100.)**2)
 
 
-def loglikelihoodE(testVars, testPoint, zl, zs, dTc=2, set_cosmo={}, Eratio_true=None,
-                   Om0true=0.3, Oktrue=0, Ode0true=.7, w0true=-1., watrue=0., htrue=.7,
-                   return_ratios=False, P=1):
-    """log(likelihood) for a time delay distance 
-    ratio constraint, comparing 
-    a given test point to the true position. 
-
-    testVars: the test variables
-    testPOint: the test point
-    zl : lens redshift(s)
-    zs : source redshift(s)
-    dTc : percent precision on cosmological distance ratio, combining
-       uncertainty from the time delay measurement + lens modeling
-    set_cosmo: dictionary of constants to set (if not defaults)
-    Eratio_true: The true ratio if computed beforehand for speed
-    Om0true: True value of Om0
-    Oktrue: True value of Ok
-    Ode0true: True value of Ode0
-    w0true: True value of w0
-    watrue: True value of wa
-    htrue: True value of h
-    return_ratios: if true, return the actual ratios in additon to the likelihood
-    P: The probability of each source/lens redshift combo (see C&M 2009 equation 17)
+def _build_cosmo(testVars, testPoint, set_cosmo={}, Om0true=0.3, Oktrue=0, Ode0true=.7,
+                 w0true=-1., watrue=0., htrue=.7):
+    """
+    The test and true cosmology dictionaries for a test point, filling in
+    the parameters that aren't varied. The test point values can be arrays.
     """
-
     cosmo = {testVars[i]: testPoint[i] for i in range(len(testVars))}
     if 'w' not in testVars:
         if 'w0' not in cosmo.keys():
@@ -172,13 +155,45 @@ def loglikelihoodE(testVars, testPoint, zl, zs, dTc=2, set_cosmo={}, Eratio_true
         if 'h' not in cosmo.keys():
             cosmo['h'] = htrue
 
+    return(cosmo, true_cosmo)
+
+
+def loglikelihoodE(testVars, testPoint, zl, zs, dTc=2, set_cosmo={}, Eratio_true=None,
+                   Om0true=0.3, Oktrue=0, Ode0true=.7, w0true=-1., watrue=0., htrue=.7,
+                   return_ratios=False, P=1):
+    """log(likelihood) for a time delay distance 
+    ratio constraint, comparing 
+    a given test point to the true position. 
+
+    testVars: the test variables
+    testPoint: the test point (each value can be an array of test values,
+       in which case the log likelihood has the same shape)
+    zl : lens redshift(s)
+    zs : source redshift(s)
+    dTc : percent precision on cosmological distance ratio, combining
+       uncertainty from the time delay measurement + lens modeling
+    set_cosmo: dictionary of constants to set (if not defaults)
+    Eratio_true: The true ratio if computed beforehand for speed
+    Om0true: True value of Om0
+    Oktrue: True value of Ok
+    Ode0true: True value of Ode0
+    w0true: True value of w0
+    watrue: True value of wa
+    htrue: True value of h
+    return_ratios: if true, return the actual ratios in additon to the likelihood
+    P: The probability of each source/lens redshift combo (see C&M 2009 equation 17)
+    """
+
+    cosmo, true_cosmo = _build_cosmo(testVars, testPoint, set_cosmo, Om0true, Oktrue,
+                                     Ode0true, w0true, watrue, htrue)
+
     if Eratio_true is None:
         Eratio_true = Eratio(zl, zs, true_cosmo)
     Eratio_test = Eratio(zl, zs, cosmo)
 
     # if np.isfinite(Eratio_w0wa):
     loglike = -0.5 * np.sum(P*(Eratio_true-Eratio_test)**2 /
-                            Evariance(Eratio_test, dTc))
+                            Evariance(Eratio_test, dTc), axis=-1)
     if return_ratios:
         return(Eratio_true, Eratio_test, loglike)
     # else:
@@ -212,16 +227,83 @@ def rescale_likelihood(a):
     return(sumabove.reshape(a.shape))
 
 
-def deriv_like(p1, p2, names, zl, zs, dTc, Om0, Ok, Ode0, w0true, watrue, htrue, P):
+def _Eratio_jacobian(testVars, zl, zs, cosmo_truths, dx=1e-6):
+    """
+    Derivatives of the time delay distance ratio with respect to testVars
+    (the other parameters follow from the truths as in loglikelihoodE),
+    at the true cosmology, using complex-step differentiation. Returns
+    the ratio for each lens/source pair and the (len(testVars), npairs)
+    derivatives.
+    """
+    truth = np.array([cosmo_truths[p] for p in testVars], dtype=complex)
+    # row k of the test point steps parameter k by i*dx
+    testPoint = truth[:, None] + 1j*dx*np.eye(len(testVars))
+    cosmo, _ = _build_cosmo(testVars, testPoint, {}, cosmo_truths['Om0'], cosmo_truths['Ok'],
+                            cosmo_truths['Ode0'], cosmo_truths['w0'], cosmo_truths['wa'],
+                            cosmo_truths['h'])
+    Erat = Eratio(zl, zs, cosmo)
+    return(np.real(Erat[0]), np.imag(Erat)/dx)
+
+
+def _fisher_jacobians(params, zl, zs, cosmo_truths, dx=1e-6):
     """
-    helper to calculate fisher matrix
+    The ratio derivatives needed for a Fisher matrix of params: each
+    parameter on its own (diagonal) and each pair together (off-diagonal),
+    matching the parameters held fixed in each case by loglikelihoodE.
     """
-    if p2 is not None:
-        return -2*loglikelihoodE(names, [p1, p2], zl, zs, dTc=dTc, Om0true=Om0, Oktrue=Ok, Ode0true=Ode0,
-                                 w0true=w0true, watrue=watrue, htrue=htrue, P=P)
+    jac = {}
+    for i in range(len(params)):
+        Erat, jac[i, i] = _Eratio_jacobian([params[i]], zl, zs, cosmo_truths, dx)
+        jac[i, i] = np.repeat(jac[i, i], 2, axis=0)
+        for j in range(i+1, len(params)):
+            _, jac[i, j] = _Eratio_jacobian([params[i], params[j]], zl, zs,
+                                            cosmo_truths, dx)
+    return(Erat, jac)
+
+
+def _fisher_from_jacobians(nparams, Erat, jac, dTc, P=1):
+    """
+    Fisher matrix F_ij = sum(P*dE/dp_i*dE/dp_j/(E*dTc/100)**2) over the
+    lens/source pairs (the second derivative of -2ln(L)/2 at the truth).
+    """
+    weights = P/Evariance(Erat, dTc)
+    fisher_matrix = np.zeros((nparams, nparams))
+    for (i, j), grad in jac.items():
+        fisher_matrix[i, j] = fisher_matrix[j, i] = np.dot(
+            grad[0]*weights, grad[1])
+    return(fisher_matrix)
+
+
+def _grid_chunk(all_args):
+    (ind, p1, p2), (vparam_names, zl, zs, loglike_kwargs) = all_args
+    return(ind, loglikelihoodE(vparam_names, [p1, p2], zl, zs, **loglike_kwargs))
+
+
+def _grid_loglikelihood(vparam_names, p1grid, p2grid, zl, zs, loglike_kwargs, chunk_size=None,
+                        npar_cores=1):
+    """
+    The log likelihood over a grid of two parameters, evaluated as array
+    operations on chunks of grid points (optionally spread across cores).
+    """
+    p1 = np.ravel(p1grid)
+    p2 = np.ravel(p2grid)
+    if chunk_size is None:
+        # keep each chunk to ~10^7 evaluations of 1/E(z)
+        chunk_size = int(1e7/(2*len(np.atleast_1d(zl))*len(_gl_nodes_)))
+    chunk_size = int(np.maximum(1, chunk_size))
+    chunks = [[i, p1[i:i+chunk_size], p2[i:i+chunk_size]]
+              for i in range(0, len(p1), chunk_size)]
+    args = [vparam_names, zl, zs, loglike_kwargs]
+    if npar_cores > 1 and len(chunks) > 1:
+        res = pyParz.foreach(chunks, _grid_chunk, args,
+                             numThreads=int(np.minimum(npar_cores, len(chunks))))
     else:
-        return -2*loglikelihoodE(names, [p1], zl, zs, dTc=dTc, Om0true=Om0, Oktrue=Ok,
-                                 Ode0true=Ode0, w0true=w0true, watrue=watrue, htrue=htrue, P=P)
+        res = [_grid_chunk([chunk, args]) for chunk in chunks]
+
+    loglE = np.zeros(len(p1))
+    for ind, chunk_loglE in res:
+        loglE[ind:ind+len(chunk_loglE)] = chunk_loglE
+    return(loglE.reshape(np.shape(p1grid)))
 
 
 class Survey(object):
@@ -299,7 +381,8 @@ class Survey(object):
         return np.sqrt((self.dTL**2 + self.dTT**2) / self.N + self.sys_dTL**2)
 
     def survey_grid(self, vparam_names, bounds={}, npoints=100, grad_param=None, constants={},
-                    grad_param_bounds=None, ngrad=10, grid_param1=None, grid_param2=None, **kwargs):
+                    grad_param_bounds=None, ngrad=10, grid_param1=None, grid_param2=None,
+                    chunk_size=None, npar_cores=1, **kwargs):
         """Calculate cosmological contours by varying 2 parameters in a grid.
 
         Parameters
@@ -322,6 +405,10 @@ class Survey(object):
                 Optional choice of grid param 1 list (default uniform based on bounds)
         grid_param2: iterable
                 Optional choice of grid param 2 list (default uniform based on bounds)
+        chunk_size: int
+                Number of grid points evaluated together (default chosen to bound memory)
+        npar_cores: int
+                Number of cores to spread the grid chunks across
         Returns
         -------
         Adds to class attribute "grid" (a dictionary), with a comma-separated list of 
@@ -355,13 +442,16 @@ class Survey(object):
 
         true_ratio = Eratio(self.zl, self.zs, self.cosmo_truths)
 
+        loglike_kwargs = {'dTc': kwargs.get('dTc', self.dTc), 'Om0true': self.cosmo_truths['Om0'],
+                          'Oktrue': self.cosmo_truths['Ok'], 'Ode0true': self.cosmo_truths['Ode0'],
+                          'w0true': self.cosmo_truths['w0'], 'watrue': self.cosmo_truths['wa'],
+                          'htrue': self.cosmo_truths['h']}
+
         if grad_param is None:
-            loglE = np.array([[loglikelihoodE(vparam_names, [param1_list[i], param2_list[j]],
-                                              self.zl, self.zs,  dTc=kwargs.get('dTc', self.dTc), set_cosmo=constants,
-                                              Om0true=self.cosmo_truths['Om0'], Oktrue=self.cosmo_truths[
-                                                  'Ok'], Eratio_true=true_ratio,
-                                              Ode0true=self.cosmo_truths['Ode0'], w0true=self.cosmo_truths['w0'],
-                                              watrue=self.cosmo_truths['wa'], htrue=self.cosmo_truths['h']) for i in range(len(param1_list))] for j in range(len(param2_list))])[:, :]
+            loglE = _grid_loglikelihood(vparam_names, p1grid, p2grid, self.zl, self.zs,
+                                        dict(loglike_kwargs, set_cosmo=constants,
+                                             Eratio_true=true_ratio),
+                                        chunk_size, npar_cores)
 
             likelihood = np.exp(loglE)
             likelihood[np.isnan(likelihood)] = 0
@@ -383,25 +473,22 @@ class Survey(object):
             grad_param_range = np.linspace(
                 grad_param_bounds[0], grad_param_bounds[1], ngrad)
             for g in grad_param_range:
-                loglE = np.array([[loglikelihoodE(vparam_names, [param1_list[i], param2_list[j]],
-                                                  self.zl, self.zs,  dTc=kwargs.get('dTc', self.dTc), set_cosmo={grad_param: g},
-                                                  Om0true=self.cosmo_truths['Om0'], Oktrue=self.cosmo_truths['Ok'],
-                                                  Ode0true=self.cosmo_truths['Ode0'], w0true=self.cosmo_truths['w0'],
-                                                  watrue=self.cosmo_truths['wa'], htrue=self.cosmo_truths['h']) for i in range(len(param1_list))] for j in range(len(param2_list))])[:, :, 0]
+                loglE = _grid_loglikelihood(vparam_names, p1grid, p2grid, self.zl, self.zs,
+                                            dict(loglike_kwargs, set_cosmo={
+                                                 grad_param: g}),
+                                            chunk_size, npar_cores)
 
                 likelihood = np.exp(loglE)
                 likelihood[np.isnan(likelihood)] = 0
                 like_rescaled = rescale_likelihood(likelihood)
                 all_res[g] = like_rescaled
 
-            self.grid_grad_res = all_res
-            self.grid_grad_param = grad_param
-            self.grid_grad_param_range = grad_param_range
             if self.grid_likelihood is None:
                 self.param1_list = {}
                 self.param2_list = {}
                 self.grid_samples = {}
                 self.grid_likelihood = {}
+            if not isinstance(getattr(self, 'grid_grad_res', None), dict):
                 self.grid_grad_res = {}
                 self.grid_grad_param = {}
                 self.grid_grad_param_range = {}
@@ -411,12 +498,12 @@ class Survey(object):
             self.grid_grad_param_range[','.join(
                 vparam_names)] = grad_param_range
             self.grid_likelihood[','.join(vparam_names)] = np.median(
-                [all_res[g] for g in grad_param_range])
+                [all_res[g] for g in grad_param_range], axis=0)
         self.param1_list[','.join(vparam_names)] = param1_list
         self.param2_list[','.join(vparam_names)] = param2_list
         self.grid_samples[','.join(vparam_names)] = [p1grid, p2grid]
 
-    def survey_nestle(self, vparam_names, bounds, constants={}, npoints=100, **kwargs):
+    def survey_nestle(self, vparam_names, bounds, constants={}, npoints=100, npar_cores=1, **kwargs):
         """Calculate cosmological contours in an MCMC-like fashion.
 
         Parameters
@@ -435,6 +522,9 @@ class Survey(object):
                 Bounds for grad_param, same format as bounds
         ngrad: int
                 Number of grid points to vary grad_param
+        npar_cores: int
+                Number of processes used to evaluate the likelihood (queue_size
+                defaults to this)
 
         Returns
         -------
@@ -455,39 +545,41 @@ class Survey(object):
         ndim = len(vparam_names)  # length of v
 
         def prior_transform(u):
-            d = {}
-            for i in range(npdim):
-                d[iparam_names[i]] = ppflist[i](u[i])
-            v = np.empty(ndim, dtype=np.float)
-            for i in range(ndim):
-                key = vparam_names[i]
-                v[i] = d[key]
-            return v
-
-        def likelihood(parameters):
-            newParams = {}
-            newParams = {iparam_names[i]: parameters[i]
-                         for i in range(len(parameters))}
-            for param in constants.keys():
-                newParams[param] = constants[param]
-
-            return(loglikelihoodE(vparam_names, [newParams[p] for p in iparam_names],
-                                  self.zl, self.zs, dTc=kwargs.get(
-                                      'dTc', self.dTc),
-                                  Om0true=self.cosmo_truths['Om0'], Oktrue=self.cosmo_truths['Ok'],
-                                  Ode0true=self.cosmo_truths['Ode0'], w0true=self.cosmo_truths['w0'],
-                                  watrue=self.cosmo_truths['wa'], htrue=self.cosmo_truths['h']))
-        res = nestle.sample(likelihood, prior_transform, ndim, npdim=npdim,
-                            npoints=npoints, method=kwargs.get('method', 'single'), maxiter=kwargs.get('maxiter', None),
-                            maxcall=kwargs.get('maxcall', None), rstate=kwargs.get('rstate', None),
-                            callback=(nestle.print_progress if kwargs.get('verbose', False) else None), **kwargs)
+            return np.array([ppflist[i](u[i]) for i in range(npdim)])
+
+        dTc = kwargs.pop('dTc', self.dTc)
+        verbose = kwargs.pop('verbose', False)
+        likelihood = _SurveyLikelihood(iparam_names, self.zl, self.zs,
+                                       {'dTc': dTc, 'set_cosmo': constants,
+                                        'Eratio_true': Eratio(self.zl, self.zs, self.cosmo_truths),
+                                        'Om0true': self.cosmo_truths['Om0'], 'Oktrue': self.cosmo_truths['Ok'],
+                                        'Ode0true': self.cosmo_truths['Ode0'], 'w0true': self.cosmo_truths['w0'],
+                                        'watrue': self.cosmo_truths['wa'], 'htrue': self.cosmo_truths['h']})
+        if npar_cores > 1:
+            executor = ProcessPoolExecutor(npar_cores)
+            pool = _BatchPool(executor, npar_cores)
+            queue_size = kwargs.pop('queue_size', npar_cores)
+        else:
+            executor = pool = None
+            queue_size = kwargs.pop('queue_size', None)
+        try:
+            res = nestle.sample(likelihood, prior_transform, ndim, npdim=npdim,
+                                npoints=npoints, method=kwargs.pop('method', 'single'),
+                                maxiter=kwargs.pop('maxiter', None), maxcall=kwargs.pop('maxcall', None),
+                                rstate=kwargs.pop('rstate', None),
+                                callback=(nestle.print_progress if verbose else None),
+                                queue_size=queue_size, pool=pool, **kwargs)
+        finally:
+            if executor is not None:
+                executor.shutdown()
         if self.nestle_result is None:
             self.nestle_result = {}
             self.nestle_cosmology_fit = {}
 
         self.nestle_result[','.join(vparam_names)] = res
-        self.nestle_cosmology_fit[','.join(vparam_names)] = {p: weighted_quantile(
-            res.samples[:, iparam_names.index(p)], [.16, .5, .84], res.weights) for p in iparam_names}
+        quantiles = weighted_quantiles(res.samples, [.16, .5, .84], res.weights)
+        self.nestle_cosmology_fit[','.join(vparam_names)] = {
+            p: quantiles[iparam_names.index(p)] for p in iparam_names}
 
     def survey_fisher(self, params, dx=1e-6):
         """
@@ -498,28 +590,12 @@ class Survey(object):
         params: list
                 List of parameters names to be included in fisher matrix
         dx: float
-                The dx used for calculating numerical derivatives
+                The (complex) step used for calculating derivatives
         """
-        def _take_deriv(p2, p2name, p1, p1name):
-            return deriv(deriv_like, p1, dx=dx,
-                         args=(p2, [p1name, p2name], self.zl, self.zs, self.dTc,
-                               self.cosmo_truths['Om0'], self.cosmo_truths['Ok'],
-                               self.cosmo_truths['Ode0'], self.cosmo_truths['w0'], self.cosmo_truths['wa'],
-                               self.cosmo_truths['h'], self.P))
-
-        fisher_matrix = np.zeros((len(params), len(params)))
-        for i in range(len(params)):
-            for j in range(len(params)):
-                if i == j:
-                    fisher_matrix[i][j] = .5*np.abs(deriv(deriv_like, self.cosmo_truths[params[i]], dx=dx,
-                                                          args=(None, [params[i]], self.zl, self.zs, self.dTc,
-                                                                self.cosmo_truths['Om0'], self.cosmo_truths[
-                                                                    'Ok'], self.cosmo_truths['Ode0'],
-                                                                self.cosmo_truths['w0'], self.cosmo_truths['wa'],
-                                                                self.cosmo_truths['h'], self.P), n=2))
-                else:
-                    fisher_matrix[i][j] = .5*deriv(_take_deriv, self.cosmo_truths[params[i]], dx=dx,
-                                                   args=(params[i], self.cosmo_truths[params[j]], params[j]))
+        Erat, jac = _fisher_jacobians(
+            params, self.zl, self.zs, self.cosmo_truths, dx)
+        fisher_matrix = _fisher_from_jacobians(
+            len(params), Erat, jac, self.dTc, self.P)
 
         self.fisher_matrix = Fisher(
             data=fisher_matrix, params=params, name=self.name, cosmo_truths=self.cosmo_truths)
@@ -549,7 +625,7 @@ class Survey(object):
                   y_lab=math_labels[1])
         ind = -1
         contours = []
-        for g in self.grid_grad_param_range:
+        for g in self.grid_grad_param_range[','.join(params)]:
 
             contours.append(ax.contour(self.grid_samples[','.join(params)][0], self.grid_samples[','.join(params)][1],
                                        self.grid_grad_res[','.join(params)][g], levels=[.4]))
@@ -690,6 +766,191 @@ class Survey(object):
             return(ax, lines, line_name)
 
 
+class _SurveyLikelihood(object):
+    """
+    Picklable survey log likelihood for nestle, with the true ratio already
+    computed. batch evaluates many points with one array computation.
+    """
+
+    def __init__(self, vparam_names, zl, zs, loglike_kwargs):
+        self.vparam_names = vparam_names
+        self.zl = zl
+        self.zs = zs
+        self.loglike_kwargs = loglike_kwargs
+
+    def __call__(self, parameters):
+        return(float(self.batch(np.atleast_2d(parameters))[0]))
+
+    def batch(self, points):
+        points = np.asarray(points, dtype=float)
+        return(loglikelihoodE(self.vparam_names, list(points.T), self.zl, self.zs,
+                              **self.loglike_kwargs))
+
+
+class _BatchPool(object):
+    """
+    The pool interface nestle uses. map evaluates all points (the initial
+    live points) in batches split across the executor's workers, and submit
+    goes to the executor (or runs right away).
+    """
+
+    def __init__(self, executor=None, nworkers=1):
+        self.executor = executor
+        self.nworkers = nworkers
+
+    def submit(self, func, *args):
+        if self.executor is not None:
+            return self.executor.submit(func, *args)
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+    def map(self, func, iterable):
+        points = list(iterable)
+        if not hasattr(func, 'batch') or len(points) == 0:
+            return map(func, points)
+        if self.executor is None:
+            return iter(func.batch(points))
+        chunks = np.array_split(np.asarray(points), self.nworkers)
+        return itertools.chain.from_iterable(
+            self.executor.map(func.batch, [c for c in chunks if len(c)]))
+
+
+def _sweep_redshifts(all_args):
+    # the part of a sweep that only depends on the redshift distribution
+    (ind, zl, zs), (method, params, cosmo_truths, options) = all_args
+    if method == 'fisher':
+        return(ind, _fisher_jacobians(params, zl, zs, cosmo_truths, options['dx']))
+    p1grid, p2grid = np.meshgrid(options['param1_list'], options['param2_list'])
+    # with dTc=100 this is the log likelihood for unit fractional errors,
+    # which just scales by (100/dTc)**2 for any other survey precision
+    return(ind, _grid_loglikelihood(params, p1grid, p2grid, zl, zs,
+                                    {'dTc': 100, 'Eratio_true': Eratio(zl, zs, cosmo_truths),
+                                     'Om0true': cosmo_truths['Om0'], 'Oktrue': cosmo_truths['Ok'],
+                                     'Ode0true': cosmo_truths['Ode0'], 'w0true': cosmo_truths['w0'],
+                                     'watrue': cosmo_truths['wa'], 'htrue': cosmo_truths['h']}))
+
+
+def survey_sweep(params, N=10, dTL=5, dTT=5, sys_dTL=0, redshifts=[(0.3, 0.8)], method='fisher',
+                 fom_params=None, bounds={}, npoints=100, cosmo_truths=None, npar_cores=1, dx=1e-6):
+    """
+    Evaluate many survey configurations at once, for every combination of
+    the given sample sizes, precisions and redshift distributions. Everything
+    that only depends on the redshift distribution (the Fisher derivatives,
+    or the likelihood grid) is computed once per distribution and rescaled
+    for each precision.
+
+    Parameters
+    ----------
+    params: list
+            The cosmological parameters to constrain (exactly 2 for method='grid')
+    N: int or list
+            The number(s) of discovered glSN (overruled by the redshift lists, as in Survey)
+    dTL: float or list
+            The percent precision(s) on each lens model
+    dTT: float or list
+            The percent precision(s) on each time delay measurement
+    sys_dTL: float or list
+            The systematic lens model precision(s)
+    redshifts: list
+            List of redshift distributions, each a tuple of (zl,zs) or (zl,zs,P)
+            in the format of the Survey class
+    method: str
+            'fisher' for Fisher matrix constraints or 'grid' for grid likelihoods
+    fom_params: list
+            The 2 parameters used for the figure of merit (default the first 2 params)
+    bounds: dict
+            Dictionary with param names as keys and bounds as values (grid method)
+    npoints: int
+            The number of grid points along each parameter (grid method)
+    cosmo_truths: dict
+            The true cosmology (default the Survey defaults)
+    npar_cores: int
+            Number of cores to spread the redshift distributions across
+    dx: float
+            The (complex) step used for calculating derivatives (fisher method)
+
+    Returns
+    -------
+    results: :class:`~pandas.DataFrame`
+            One row per configuration, with the configuration (redshifts is the
+            index of the distribution), the combined precision dTc, the figure of
+            merit and either the marginalized uncertainty of each parameter and the
+            fisher matrix, or the (rescaled) grid likelihood. 
+    """
+    if method not in ['fisher', 'grid']:
+        print('Do not recognize method %s, use fisher or grid.' % method)
+        return
+    if cosmo_truths is None:
+        cosmo_truths = Survey().cosmo_truths
+    fom_params = params[:2] if fom_params is None else fom_params
+    options = {'dx': dx}
+    if method == 'grid':
+        if len(params) != 2:
+            print('For grid mode, must provide exactly 2 parameters.')
+            return
+        for p in params:
+            if p not in bounds.keys():
+                print('Must provide bounds for %s.' % p)
+                return
+        options['param1_list'] = np.linspace(
+            bounds[params[0]][0], bounds[params[0]][1], npoints)
+        options['param2_list'] = np.linspace(
+            bounds[params[1]][0], bounds[params[1]][1], npoints)
+
+    configs = [list(x) if isinstance(x, (list, tuple, np.ndarray)) else [x]
+               for x in [N, dTL, dTT, sys_dTL]]
+    surveys = [[Survey(N=n, dTL=l, dTT=t, zl=z[0], zs=z[1], P=z[2] if len(z) > 2 else 1,
+                       sys_dTL=sys) for n, l, t, sys in itertools.product(*configs)]
+               for z in redshifts]
+
+    tasks = [[i, surveys[i][0].zl, surveys[i][0].zs]
+             for i in range(len(redshifts))]
+    args = [method, params, cosmo_truths, options]
+    if npar_cores > 1 and len(tasks) > 1:
+        res = pyParz.foreach(tasks, _sweep_redshifts, args,
+                             numThreads=int(np.minimum(npar_cores, len(tasks))))
+    else:
+        res = [_sweep_redshifts([task, args]) for task in tasks]
+    res = dict(res)
+
+    rows = []
+    fom_inds = [params.index(p) for p in fom_params]
+    for i in range(len(redshifts)):
+        for survey in surveys[i]:
+            row = {'redshifts': i, 'N': survey.N, 'dTL': survey.dTL, 'dTT': survey.dTT,
+                   'sys_dTL': survey.sys_dTL, 'dTc': survey.dTc}
+            if method == 'fisher':
+                fisher_matrix = _fisher_from_jacobians(
+                    len(params), res[i][0], res[i][1], survey.dTc, survey.P)
+                if np.linalg.matrix_rank(fisher_matrix) < len(params):
+                    # not enough lens/source pairs to constrain all params
+                    C = np.full(fisher_matrix.shape, np.nan)
+                else:
+                    C = np.linalg.inv(fisher_matrix)
+                for j, p in enumerate(params):
+                    row['sigma_'+p] = np.sqrt(C[j, j])
+                row['fom'] = 1./np.sqrt(np.linalg.det(C[np.ix_(fom_inds, fom_inds)]))
+                row['fisher_matrix'] = fisher_matrix
+            else:
+                likelihood = np.exp(res[i]*(100./survey.dTc)**2)
+                likelihood[np.isnan(likelihood)] = 0
+                like_rescaled = rescale_likelihood(likelihood)
+                # area of the 95.4% region, as in plot_survey_contour
+                area = np.sum(like_rescaled <= .954) * \
+                    np.diff(options['param1_list'][:2])[0] * \
+                    np.diff(options['param2_list'][:2])[0]
+                row['fom'] = np.pi/area
+                row['grid_likelihood'] = like_rescaled
+            rows.append(row)
+
+    results = pandas.DataFrame(rows)
+    if method == 'grid':
+        results.attrs['param1_list'] = options['param1_list']
+        results.attrs['param2_list'] = options['param2_list']
+    return(results)
+
+
 class Fisher:
     """
     Fisher class is more or less copied from Dan Coe's arxiv paper about Fisher matrices:
@@ -6,6 +6,7 @@ import os
 import traceback
 import shutil
 import unittest
+import tempfile
 from copy import deepcopy
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 import sntd
@@ -73,6 +74,95 @@ class TestFitting(unittest.TestCase):
 
     def setUp(self):
         self.myMISN = sntd.load_example_misn()
+
+    def test_parametric_bandflux(self):
+        from astropy.table import Table
+        from sntd.models import BazinSource, ParametricModel
+        times = np.arange(-20, 80, 5.)
+        data = Table({'time': np.append(times, times), 'band': ['bessellb']*len(times)+['bessellr']*len(times),
+                      'flux': np.ones(2*len(times)), 'fluxerr': np.ones(2*len(times))*.1,
+                      'zp': np.ones(2*len(times))*25, 'zpsys': ['ab']*(2*len(times))})
+        source = BazinSource(data)
+        fast_model = ParametricModel(source)
+        slow_model = sntd.models.sncosmo.Model(source)
+        for mod in [fast_model, slow_model]:
+            mod.set(z=0, t0=3, amplitude=10, B=0, fall=30, rise=5)
+        self.assertTrue(np.allclose(fast_model.bandflux(data['band'], data['time'], zp=26, zpsys='ab'),
+                                    slow_model.bandflux(data['band'], data['time'], zp=26, zpsys='ab')))
+
+    def test_sntd_signature_effect(self):
+        from sntd.models import _model_for_source, _propagate_effects
+        from sntd.ml import _use_sntd_flux
+
+        class HalfEffect(sntd.models.sncosmo.PropagationEffect):
+            _minwave, _maxwave = 1000., 20000.
+
+            def __init__(self):
+                self._param_names, self.param_names_latex = ['scale'], ['scale']
+                self._parameters = np.array([.5])
+
+            def propagate(self, phase, wave, flux):
+                return flux*self._parameters[0]
+        phase, wave = np.linspace(-20, 50, 30), np.linspace(2000, 10000, 100)
+        source = sntd.models.sncosmo.TimeSeriesSource(
+            phase, wave, np.outer(np.exp(-phase**2/200), np.ones(len(wave))))
+        model = _model_for_source(source, effects=[HalfEffect()], effect_names=['half'],
+                                  effect_frames=['obs'])
+        self.assertTrue(np.allclose(deepcopy(model).bandflux('bessellb', [0, 5]),
+                                    .5*_model_for_source(source).bandflux('bessellb', [0, 5])))
+        # a user-built model, as fit_data copies it
+        user_model = sntd.models.sncosmo.Model(source, effects=[HalfEffect()], effect_names=['half'],
+                                               effect_frames=['obs'])
+        self.assertTrue(np.allclose(_use_sntd_flux(deepcopy(user_model)).bandflux('bessellb', [0, 5]),
+                                    model.bandflux('bessellb', [0, 5])))
+        flux = np.ones((2, 3))
+        self.assertTrue(np.allclose(_propagate_effects(user_model, [0], flux, np.array([0., 5.]),
+                                                       np.array([4000., 5000., 6000.])), .5*flux))
+
+    def test_template_model_effects(self):
+        from sntd.fitting import _template_model
+        phase, wave = np.linspace(-20, 50, 30), np.linspace(2000, 10000, 100)
+        sntd.models.sncosmo.register(sntd.models.sncosmo.TimeSeriesSource(
+            phase, wave, np.ones((len(phase), len(wave))), name='sntd-test-template'), force=True)
+        for r_v in [3.1, 1.5]:
+            model = _template_model('sntd-test-template', effects=[sntd.ml._F99Dust(r_v=r_v)],
+                                    effect_names=['host'], effect_frames=['rest'])
+            self.assertEqual(model._effects[0]._r_v, r_v)
+        sntd.models.sncosmo.register(sntd.models.sncosmo.TimeSeriesSource(
+            phase, wave, 2*np.ones((len(phase), len(wave))), name='sntd-test-template'), force=True)
+        self.assertTrue(np.allclose(_template_model('sntd-test-template').flux(0, 5000.),
+                                    2*model.flux(0, 5000.)))
+
+    def test_prior_density(self):
+        from sntd.util import _PosteriorDensity
+        samples = np.random.RandomState(0).normal(size=(2000, 2))
+        for method in ['kde', 'gaussian']:
+            prior = _PosteriorDensity(samples, np.ones(len(samples)), method=method)
+            self.assertTrue(np.abs(prior(0, 0)+np.log(2*np.pi)) < .2)
+            self.assertTrue(np.isfinite(prior(100, 100)))
+
+    def test_fit_stats(self):
+        from sntd.util import _FitStats
+        from sncosmo.utils import Result
+        import time
+        stats = _FitStats()
+        self.assertTrue(np.isnan(stats.summary()['efficiency']))
+        self.assertEqual(stats.time('quality', max, 1, 2), 2)
+        stats.time('nested_sampling', time.sleep, .01)
+        stats.time('nested_sampling', time.sleep, .01)
+        # a stage that raises is still timed
+        with self.assertRaises(ValueError):
+            stats.time('trial_fit', int, 'x')
+        stats.add_sampler(Result(ncall=100, niter=25))
+        stats.add_sampler(Result(ncall=100, niter=25))
+        summary = stats.summary()
+        self.assertEqual(list(summary['stages'].keys()), ['quality', 'nested_sampling', 'trial_fit'])
+        self.assertTrue(summary['stages']['nested_sampling'] >= .02)
+        self.assertTrue(summary['stages']['trial_fit'] >= 0)
+        self.assertTrue(summary['wall_time'] >= sum(summary['stages'].values()))
+        self.assertEqual((summary['ncall'], summary['niter'], summary['nsampler']), (200, 50, 2))
+        self.assertEqual(summary['efficiency'], .25)
+
     @unittest.skipIf(_PARONLY_, "Skipping non-parallel fit.")
     def test_quality_check(self):
         for method in ['parallel', 'series', 'color']:
@@ -88,7 +178,7 @@ class TestFitting(unittest.TestCase):
                                   color_param_ignore=['x1'], use_MLE=False, refImage='image_1', 
                                   method='parallel', microlensing=None, maxcall=None, npoints=25, minsnr=0,
                                   set_from_simMeta={'z': 'z'}, t0_guess={'image_1': 20, 'image_2': 70},verbose=False)
-        
+        self.assertTrue(fitCurves.parallel.fit_stats['ncall'] > 0)
 
     @unittest.skipIf(_PARONLY_, "Skipping non-parallel fit.")
     def test_series_fit(self):
@@ -107,6 +197,41 @@ class TestFitting(unittest.TestCase):
                                   set_from_simMeta={'z': 'z'}, t0_guess={'image_1': 20, 'image_2': 70},verbose=False)
 
     	
+class TestIO(unittest.TestCase):
+    """
+    Test SNTD reading and writing tools.
+    """
+
+    def setUp(self):
+        self.myMISN = sntd.load_example_misn()
+        self.folder = tempfile.mkdtemp()
+
+    def test_binary_roundtrip(self):
+        fname = os.path.join(self.folder, 'example.sntd')
+        sntd.write_data(self.myMISN, fname)
+        newMISN = sntd.read_data(fname)
+        for im in self.myMISN.images.keys():
+            self.assertTrue(np.all(newMISN.images[im].table ==
+                                   self.myMISN.images[im].table))
+        self.assertEqual(newMISN.bands, self.myMISN.bands)
+
+        phot_only = sntd.read_data(fname, groups=['photometry'])
+        self.assertEqual(len(phot_only.table), len(self.myMISN.table))
+        self.assertIsNone(phot_only.images['image_1'].simMeta)
+
+    def test_bulk_read(self):
+        tables = [deepcopy(x) for x in sntd.load_example_data()]
+        for i, table in enumerate(tables):
+            table['band'] = ['bessellb' if b == 'F110W' else 'bessellr' for b in table['band']]
+            table.write(os.path.join(self.folder, 'object_%i.dat' % i), format='ascii')
+        all_misn = list(sntd.read_data_bulk(self.folder, nworkers=2))
+        self.assertEqual([x.object for x in all_misn], ['object_0', 'object_1'])
+        self.assertEqual(len(all_misn[0].images), 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
 class TestCosmology(unittest.TestCase):
     """
     Test SNTD cosmology tools.
@@ -133,6 +258,14 @@ class TestCosmology(unittest.TestCase):
     def test_survey_fisher(self):
         self.test_cosmo.survey_fisher(['w', 'Ode0'])
 
+    def test_survey_sweep(self):
+        sweep = sntd.survey_sweep(['w', 'Ode0'], N=[1, 10], dTL=2, dTT=[.1, 1],
+                                  redshifts=[(.5, 2), ([.3, .5], [1, 2])])
+        self.assertEqual(len(sweep), 8)
+        self.test_cosmo.survey_fisher(['w', 'Ode0'])
+        np.testing.assert_allclose(
+            sweep['fisher_matrix'][0], self.test_cosmo.fisher_matrix.data)
+
 
 class TestBatch(unittest.TestCase):
     def setUp(self):
@@ -163,6 +296,134 @@ class TestBatch(unittest.TestCase):
             pass
 
 
+class TestBatchWorker(unittest.TestCase):
+    """
+    Test the batch job specification and worker without a scheduler
+    """
+
+    def setUp(self):
+        # the example MISN in bands that don't need a download, fit with a
+        # quick Bazin model (the time delay is about 50 days)
+        self.myMISN = sntd.load_example_misn()
+        for im in self.myMISN.images.keys():
+            self.myMISN.images[im].table['band'] = np.where(self.myMISN.images[im].table['band'] == 'F110W',
+                                                            'bessellb', 'bessellr')
+            self.myMISN.images[im].bands = ['bessellb', 'bessellr']
+        self.myMISN.bands = ['bessellb', 'bessellr']
+        self.fit_kwargs = dict(models='bazin', bands=['bessellb', 'bessellr'], params=['t0', 'amplitude'],
+                               bounds={'t0': (-25, 25)}, microlensing=None, minsnr=0, npoints=20,
+                               t0_guess={'image_1': 0, 'image_2': 50}, rstate=np.random.RandomState(0),
+                               verbose=False)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertFit(self, fitCurves):
+        self.assertTrue(np.abs(fitCurves.parallel.time_delays['image_2']-50) < 5)
+
+    def test_run_shard(self):
+        import pickle
+        from sntd.batch import worker
+        spec = worker.make_job_spec(self.fit_kwargs, 'parallel', 3, 2)
+        self.assertEqual(worker.shard_indices(spec, 1), (2, 3))
+        spec_file = worker.write_job_spec(
+            spec, self.folder, curves=[self.myMISN]*3)
+        results = worker.run_shard(spec_file, 1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(str(np.loadtxt(os.path.join(
+            self.folder, 'sntd_fit1.DONE'), dtype=str)), 'TRUE')
+        with open(os.path.join(self.folder, 'sntd_fit1_0.pkl'), 'rb') as f:
+            self.assertFit(pickle.load(f))
+
+
+    def test_inprocess_scheduler(self):
+        import pickle
+        import tarfile
+        cwd = os.getcwd()
+        os.chdir(self.folder)
+        try:
+            sntd.fit_data([self.myMISN]*3, method='parallel', par_or_batch='batch', nbatch_jobs=2,
+                          batch_scheduler='inprocess', **self.fit_kwargs)
+            with tarfile.open(os.path.join('batch_output', 'sntd_fits.tar.gz')) as f:
+                self.assertEqual(len(f.getnames()), 3)
+                for name in f.getnames():
+                    self.assertFit(pickle.load(f.extractfile(name)))
+        finally:
+            os.chdir(cwd)
+
+    def test_task_queue(self):
+        from sntd.batch import taskqueue
+        filename = taskqueue.init_queue(self.folder, 5)
+        self.assertEqual(taskqueue.claim_tasks(filename, 0, 2), [0, 1])
+        self.assertEqual(taskqueue.claim_tasks(filename, 1, 10), [2, 3, 4])
+        self.assertEqual(taskqueue.claim_tasks(filename, 0), [])
+        taskqueue.finish_tasks(filename, [0, 1])
+        self.assertEqual(taskqueue.queue_status(filename),
+                         {'pending': 0, 'running': 3, 'done': 2})
+        # worker 1 was killed, so its claims are requeued and taken by worker 2
+        self.assertEqual(taskqueue.claim_tasks(filename, 2, 10, stale_after=0), [2, 3, 4])
+        self.assertEqual(taskqueue.finish_tasks(filename, [2, 3, 4], worker=1), [])
+        self.assertEqual(taskqueue.finish_tasks(filename, [2, 3, 4], worker=2), [2, 3, 4])
+        self.assertEqual(taskqueue.queue_status(filename),
+                         {'pending': 0, 'running': 0, 'done': 5})
+
+    def test_run_shard_queue(self):
+        import pickle
+        from sntd.batch import worker, taskqueue
+        spec = worker.make_job_spec(self.fit_kwargs, 'parallel', 3, 2, queue=True, queue_timeout=3600)
+        spec_file = worker.write_job_spec(
+            spec, self.folder, curves=[self.myMISN]*3)
+        filename = taskqueue.init_queue(self.folder, 3)
+        # a killed worker's stale claim is picked up by the next worker
+        taskqueue.claim_tasks(filename, 5)
+        con = taskqueue._connect(filename)
+        con.execute('UPDATE tasks SET claimed=0 WHERE id=0')
+        con.close()
+        results = worker.run_shard(spec_file, 0)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(taskqueue.queue_status(filename),
+                         {'pending': 0, 'running': 0, 'done': 3})
+        for i in range(3):
+            with open(os.path.join(self.folder, 'sntd_fitq%i_0.pkl' % i), 'rb') as f:
+                self.assertFit(pickle.load(f))
+
+    def test_queue_replacement_worker(self):
+        import pickle
+        import tarfile
+        from sntd.batch import taskqueue
+        from sntd.batch.scheduler import InProcessScheduler
+
+        class KilledWorkerScheduler(InProcessScheduler):
+            # the first worker claims a MISN and is killed without finishing
+            # it, and its claim only goes stale once the other worker is done
+            def submit(self, shard):
+                self.queue_file = os.path.join(self.folder_name, taskqueue._queue_file_)
+                if shard > 0:
+                    return super(KilledWorkerScheduler, self).submit(shard)
+                self.submitted.append(shard)
+                taskqueue.claim_tasks(self.queue_file, shard)
+
+            def check(self):
+                con = taskqueue._connect(self.queue_file)
+                con.execute("UPDATE tasks SET claimed=0 WHERE worker='0'")
+                con.close()
+        scheduler = KilledWorkerScheduler()
+        cwd = os.getcwd()
+        os.chdir(self.folder)
+        try:
+            sntd.fit_data([self.myMISN]*3, method='parallel', par_or_batch='batch', nbatch_jobs=2,
+                          batch_scheduler=scheduler, batch_queue=True, batch_queue_timeout=3600,
+                          **self.fit_kwargs)
+            self.assertEqual(scheduler.submitted, [0, 1, 2])
+            with tarfile.open(os.path.join('batch_output', 'sntd_fits.tar.gz')) as f:
+                self.assertEqual(len(f.getnames()), 3)
+                for name in f.getnames():
+                    self.assertFit(pickle.load(f.extractfile(name)))
+        finally:
+            os.chdir(cwd)
+
+
 def test_loader(loader):
     suite = unittest.TestSuite()
     for test_class in test_cases:
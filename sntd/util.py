@@ -4,16 +4,19 @@ import glob
 import sys
 import subprocess
 import time
+import math
 import scipy
 import tarfile
 import pickle
-import matplotlib.pyplot as plt
 import numpy as np
 from collections import OrderedDict as odict
 from astropy.io import ascii
 from scipy.interpolate import splrep, splev
 from copy import copy
 from scipy.stats import rv_continuous
+from scipy.spatial import cKDTree
+from scipy.special import logsumexp
+from scipy.linalg import solve_triangular
 
 
 _current_dir_ = os.path.abspath(os.getcwd())
@@ -202,69 +205,98 @@ def check_table_quality(table, min_n_bands=1, min_n_points_per_band=1, clip=Fals
     return table, True
 
 
-def run_sbatch(folder_name, script_name_init, script_name, total_jobs, max_batch_jobs, n_per_node, wait_for_batch, parallelize, ncurves, verbose):
+def run_sbatch(folder_name, script_name_init, script_name, total_jobs, max_batch_jobs, n_per_node, wait_for_batch, parallelize, ncurves, verbose,
+               scheduler=None, queue_timeout=None):
+    if scheduler is None:
+        from .batch.scheduler import SlurmScheduler
+        scheduler = SlurmScheduler(script_name_init=script_name_init, script_name=script_name)
+        scheduler.folder_name = os.path.abspath(folder_name)
+    if queue_timeout is not None:
+        from .batch.taskqueue import requeue_stale, _queue_file_
+        queue_file = os.path.join(os.path.abspath(folder_name), _queue_file_)
     fits_output = tarfile.open(os.path.join(
         os.path.abspath(folder_name), 'sntd_fits.tar.gz'), mode='w')
 
-    result = subprocess.call(['sbatch', os.path.join(os.path.abspath(folder_name),
-                                                     script_name_init)])
     if wait_for_batch:
         printProgressBar(0, total_jobs)
     ndone = 0
     nadded = min(total_jobs, max_batch_jobs)
+    scheduler.submit_initial(nadded)
     saved_fits = 0
     tarfit_ind = 0
-    if parallelize is not None:
-        n_per_file = 1
-    else:
-        n_per_file = n_per_node
-
-    while True:
-        time.sleep(10)  # update every 10 seconds
-        done_files = glob.glob(os.path.join(
-            os.path.abspath(folder_name), 'sntd_fit*.DONE'))
-        if len(done_files) == 0:
-            continue
-        done_file = done_files[0]
-        done = str(np.loadtxt(done_file, dtype=str))
+    # every worker writes one file per MISN
+    n_per_file = 1
 
-        while done == 'FALSE':
-            time.sleep(10)  # update every 10 seconds
+    try:
+        while True:
+            scheduler.check()
+            # the workers holding stale claims were killed, and every other
+            # worker may have already found the queue empty, so start another
+            if queue_timeout is not None and requeue_stale(queue_file, queue_timeout) > 0:
+                scheduler.submit(nadded)
+                nadded += 1
+            done_files = glob.glob(os.path.join(
+                os.path.abspath(folder_name), 'sntd_fit*.DONE'))
+            if len(done_files) == 0:
+                time.sleep(scheduler.poll_interval)
+                continue
+            done_file = done_files[0]
             done = str(np.loadtxt(done_file, dtype=str))
 
-        os.remove(done_file)
-        output = glob.glob(done_file[:-5]+'*.pkl')
-        saved_fits += len(output)
-
-        if len(output) > 0:
-            if int(saved_fits*n_per_file) >= 50000*(tarfit_ind+1):
-                fits_output.close()
-                fits_output = tarfile.open(os.path.join(os.path.abspath(
-                    folder_name), 'sntd_fits_%i.tar.gz' % tarfit_ind), mode='w')
-                tarfit_ind += 1
-            for filename in output:
-                fits_output.add(filename)
-                os.remove(filename)
-
-            if nadded < total_jobs:
-                for i in range(math.ceil(len(output)/(n_per_node/n_per_file))):
-                    if nadded > total_jobs-1:
-                        continue
-                    result = subprocess.call(['sbatch', os.path.join(os.path.abspath(folder_name),
-                                                                     script_name), str(nadded)], stdout=subprocess.DEVNULL)
-                    nadded += 1
-
-            if wait_for_batch:
-                printProgressBar(
-                    saved_fits/(n_per_node/n_per_file), total_jobs)
-        if saved_fits >= ncurves:
-            break
-    fits_output.close()
+            while done == 'FALSE':
+                time.sleep(scheduler.poll_interval)
+                done = str(np.loadtxt(done_file, dtype=str))
+
+            os.remove(done_file)
+            output = glob.glob(done_file[:-5]+'_*.pkl')
+            saved_fits += len(output)
+
+            if len(output) > 0:
+                if int(saved_fits*n_per_file) >= 50000*(tarfit_ind+1):
+                    fits_output.close()
+                    fits_output = tarfile.open(os.path.join(os.path.abspath(
+                        folder_name), 'sntd_fits_%i.tar.gz' % tarfit_ind), mode='w')
+                    tarfit_ind += 1
+                for filename in output:
+                    fits_output.add(filename)
+                    os.remove(filename)
+
+                if nadded < total_jobs:
+                    for i in range(math.ceil(len(output)/(n_per_node/n_per_file))):
+                        if nadded > total_jobs-1:
+                            continue
+                        scheduler.submit(nadded)
+                        nadded += 1
+
+                if wait_for_batch:
+                    printProgressBar(
+                        saved_fits/(n_per_node/n_per_file), total_jobs)
+            if saved_fits >= ncurves:
+                break
+    finally:
+        fits_output.close()
+        scheduler.shutdown()
     if verbose:
         print('Done!')
     return
 
 
+def make_batch_folder():
+    n = 0
+    add = ''
+    while True:
+        try:
+            folder_name = 'batch_output%s' % add
+            os.mkdir(folder_name)
+            return folder_name
+        except:
+            add = str(n)
+            n += 1
+        if n > 50:
+            print('Having trouble making batch output folder.')
+            sys.exit(1)
+
+
 def make_sbatch(partition=None, njobs=None, njobstotal=None, python_path=None, init=False, folder=None, parallelize=None, microlensing_cores=None):
     if njobs is None:
         print("Batch mode requires a number of jobs!")
@@ -272,20 +304,10 @@ def make_sbatch(partition=None, njobs=None, njobstotal=None, python_path=None, i
     if init:
         if njobstotal is None:
             print("Batch mode requires a total number of jobs!")
-        n = 0
-        add = ''
-        done = False
-        while not done:
-            try:
-                folder_name = 'batch_output%s' % add
-                os.mkdir(folder_name)
-                done = True
-            except:
-                add = str(n)
-                n += 1
-            if n > 50:
-                print('Having trouble making batch output folder.')
-                sys.exit(1)
+        if folder is None:
+            folder_name = make_batch_folder()
+        else:
+            folder_name = folder
     else:
         folder_name = folder
 
@@ -295,17 +317,9 @@ def make_sbatch(partition=None, njobs=None, njobstotal=None, python_path=None, i
     if not init:
         with open(os.path.join(_filedir_, 'batch', 'sbatch_job.BATCH')) as f:
             sbatch = f.read()
-        if parallelize is None:
-            pyfile = 'run_sntd.py'
-        else:
-            pyfile = 'run_sntd_par.py'
     else:
         with open(os.path.join(_filedir_, 'batch', 'sbatch_job_init.BATCH')) as f:
             sbatch = f.read()
-        if parallelize is None:
-            pyfile = 'run_sntd_init.py'
-        else:
-            pyfile = 'run_sntd_init_par.py'
 
     sbatch = sbatch.replace(
         'pyjob%j.out', os.path.join(folder_name, 'pyjob%j.out'))
@@ -314,8 +328,8 @@ def make_sbatch(partition=None, njobs=None, njobstotal=None, python_path=None, i
     else:
         sbatch = sbatch.replace('partition', '')
     sbatch = sbatch.replace('myPython', python_path)
-    sbatch = sbatch.replace('run_sntd.py', os.path.join(
-        os.path.abspath(folder_name), pyfile))
+    sbatch = sbatch.replace('sntd_spec.pkl', os.path.join(
+        os.path.abspath(folder_name), 'sntd_spec.pkl'))
     if init:
         sbatch = sbatch.replace('njobstotal', '0-%i' % (njobstotal-1))
         sbatch = sbatch.replace('njobs', '%i' % njobs)
@@ -338,6 +352,7 @@ def make_sbatch(partition=None, njobs=None, njobstotal=None, python_path=None, i
 
 def plot(plot_type, x, y=None, yerr=None, xerr=None, ax=None, x_lab='', y_lab='', fontsize=18, figsize=(12, 12),
          x_name=None, y_name=None, label_name=None, **kwargs):
+    import matplotlib.pyplot as plt
     if ax is None and plot_type != 'joint':
         fig = plt.figure(figsize=figsize)
         ax = fig.gca()
@@ -425,6 +440,50 @@ def weighted_quantile(values, quantiles, sample_weight=None,
     return np.interp(quantiles, weighted_quantiles, values)
 
 
+def weighted_quantiles(samples, quantiles, sample_weight=None, nbins=None):
+    """ weighted_quantile for every column of a samples array at once
+    (one column-wise sort instead of one sort per parameter).
+    :param samples: numpy.array (nsamples,ncolumns) with data
+    :param quantiles: array-like with many quantiles needed
+    :param sample_weight: array-like of the same length as samples
+    :param nbins: if given, the quantiles are instead interpolated from a
+        weighted histogram with this many bins per column, which needs no
+        sorting (for very large sample sets, accurate to the bin width)
+    :return: numpy.array (ncolumns,nquantiles) with computed quantiles.
+    """
+    samples = np.asarray(samples, dtype=float)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    quantiles = np.atleast_1d(quantiles)
+    if sample_weight is None:
+        sample_weight = np.ones(len(samples))
+    sample_weight = np.asarray(sample_weight, dtype=float)
+    assert np.all(quantiles >= 0) and np.all(quantiles <= 1), \
+        'quantiles should be in [0, 1]'
+    ncols = samples.shape[1]
+
+    if nbins is not None:
+        low = np.min(samples, axis=0)
+        width = (np.max(samples, axis=0)-low)/nbins
+        width[width == 0] = 1
+        bins = np.minimum(((samples-low)/width).astype(int), nbins-1)
+        hist = np.bincount((bins+np.arange(ncols)*nbins).ravel(),
+                           np.repeat(sample_weight, ncols), minlength=ncols*nbins).reshape(ncols, nbins)
+        cum = np.cumsum(hist, axis=1)/np.sum(sample_weight)
+        return np.array([np.interp(quantiles, np.append(0, cum[i]), low[i]+width[i]*np.arange(nbins+1))
+                         for i in range(ncols)])
+
+    # one row per column, so that each sort is over contiguous memory
+    samples = np.ascontiguousarray(samples.T)
+    sorter = np.argsort(samples, axis=1)
+    values = np.take_along_axis(samples, sorter, axis=1)
+    weights = sample_weight[sorter]
+    weighted_quantiles = (np.cumsum(weights, axis=1) -
+                          0.5 * weights)/np.sum(sample_weight)
+    return np.array([np.interp(quantiles, weighted_quantiles[i], values[i])
+                     for i in range(ncols)])
+
+
 class posterior(rv_continuous):
     def _pdf(self, x, samples, weights):
         pdf, edges = np.histogram(samples, weights=weights,
@@ -483,6 +542,110 @@ class NDposterior(rv_continuous):
         return True
 
 
+class _FitStats(object):
+    """
+    Wall time per stage and nested sampling counts for one MISN fit,
+    stored as a dictionary on the fit (e.g. MISN.parallel.fit_stats).
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = odict()
+        self.ncall = 0
+        self.niter = 0
+        self.nsampler = 0
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stages[stage] = self.stages.get(
+                stage, 0.)+time.time()-start
+
+    def add_sampler(self, res):
+        self.ncall += int(res.ncall)
+        self.niter += int(res.niter)
+        self.nsampler += 1
+
+    def summary(self):
+        return {'wall_time': time.time()-self.start_time,
+                'stages': dict(self.stages),
+                'ncall': self.ncall,
+                'niter': self.niter,
+                'nsampler': self.nsampler,
+                'efficiency': self.niter/self.ncall if self.ncall > 0 else np.nan}
+
+
+class _PosteriorDensity(object):
+    """
+    Log density of a weighted set of (nested sampling) samples, for using
+    a previous fit as a prior. 'kde' is a gaussian kernel density estimate
+    (Scott's rule bandwidth, in coordinates whitened by the weighted
+    covariance) summed over the samples within a few bandwidths, found
+    with a KD-tree, and
+    'gaussian' is the weighted mean/covariance multivariate normal. Both
+    are finite everywhere.
+
+    Parameters
+    ----------
+    samples: :class:`~numpy.ndarray`
+        The (nsamples,ndim) samples
+    weights: :class:`~numpy.ndarray`
+        The weight of each sample
+    method: str
+        'kde' or 'gaussian'
+    radius: float
+        Kernels further than this many bandwidths away are left out of the kde
+    """
+
+    def __init__(self, samples, weights, method='kde', radius=5.):
+        if method not in ['kde', 'gaussian']:
+            raise RuntimeError(
+                'Do not recognize prior density method %s, use kde or gaussian.' % method)
+        samples = np.array(samples, dtype=float).reshape(len(weights), -1)
+        weights = np.array(weights, dtype=float)/np.sum(weights)
+        # the earliest nested samples carry essentially no weight
+        keep = weights > 1e-8*np.max(weights)
+        samples = samples[keep]
+        weights = weights[keep]/np.sum(weights[keep])
+        self.method = method
+        self.ndim = samples.shape[1]
+
+        self.mean = np.sum(weights[:, None]*samples, axis=0)
+        resid = samples-self.mean
+        cov = np.dot((weights[:, None]*resid).T, resid)
+        cov += np.diag(np.maximum(np.diag(cov)*1e-10, 1e-300))
+        self._chol = np.linalg.cholesky(cov)
+        self._norm = -np.sum(np.log(np.diag(self._chol))) - \
+            .5*self.ndim*np.log(2*np.pi)
+        if method == 'gaussian':
+            return
+
+        # Scott's rule with the effective number of samples
+        self.bandwidth = (1./np.sum(weights**2))**(-1./(self.ndim+4))
+        self._norm -= self.ndim*np.log(self.bandwidth)
+        self._logweights = np.log(weights)
+        self._tree = cKDTree(self._whiten(samples)/self.bandwidth)
+        self._radius = radius
+
+    def _whiten(self, x):
+        return solve_triangular(self._chol, (x-self.mean).T, lower=True).T
+
+    def __call__(self, *x):
+        y = self._whiten(np.atleast_2d(np.array(x, dtype=float)))
+        if self.method == 'gaussian':
+            return(self._norm-.5*np.sum(y**2))
+        y = y[0]/self.bandwidth
+        inds = self._tree.query_ball_point(y, self._radius)
+        if len(inds) == 0:
+            # far from every sample, the nearest one dominates
+            _, inds = self._tree.query(y, k=1)
+        inds = np.atleast_1d(inds)
+        dist2 = np.sum((self._tree.data[inds]-y)**2, axis=1)
+        return(self._norm+logsumexp(self._logweights[inds]-.5*dist2))
+
+
 def guess_magnifications(curves, referenceImage):
     """Guess t0 and amplitude of the model based on the data.
 